@@ -19,6 +19,7 @@
 # limitations under the License.
 
 import logging
+import os
 import sys
 
 try:
@@ -29,7 +30,7 @@ except ImportError:
     from faucet.config_parser import dp_parser
 
 
-def check_config(conf_files):
+def check_config(conf_files, processes=0):
     logname = '/dev/null'
     logger = logging.getLogger('%s.config' % logname)
     logger_handler = logging.StreamHandler(stream=sys.stderr)
@@ -38,7 +39,7 @@ def check_config(conf_files):
     logger.setLevel(logging.DEBUG)
 
     for conf_file in conf_files:
-        parse_result = dp_parser(conf_file, logname)
+        parse_result = dp_parser(conf_file, logname, processes)
         if parse_result is None:
             return False
         else:
@@ -51,7 +52,9 @@ def check_config(conf_files):
     return True
 
 def main():
-    if check_config(sys.argv[1:]):
+    # Parse DPs in this many processes, for configs with many DPs.
+    processes = int(os.getenv('FAUCET_CONFIG_PARSE_PROCESSES', '0'))
+    if check_config(sys.argv[1:], processes):
         sys.exit(0)
     else:
         sys.exit(-1)
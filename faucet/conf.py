@@ -22,6 +22,8 @@ class Conf(object):
 
     defaults = {}
     defaults_types = {}
+    # Config fingerprints by excluded keys, once cached by freeze().
+    _fingerprints = None
 
     def __init__(self, _id, conf=None):
         if conf is None:
@@ -61,6 +63,8 @@ class Conf(object):
         """Return a list of key/values of attributes with dyn attributes/filtered."""
         conf_keys = []
         for k, v in list(conf.__dict__.items()):
+            if k == '_fingerprints':
+                continue
             if k.startswith('dyn') == dyn:
                 conf_keys.append((k, v))
         return sorted(conf_keys)
@@ -82,11 +86,42 @@ class Conf(object):
                 result[k] = self.__dict__[str(k)]
         return result
 
+    def freeze(self):
+        """Cache config fingerprints, once config will not change in place.
+
+        Setting a non dynamic attribute afterwards discards the cache.
+        """
+        self.__dict__['_fingerprints'] = {}
+
+    def __setattr__(self, name, value):
+        if self._fingerprints and not name.startswith('dyn'):
+            self.__dict__['_fingerprints'] = {}
+        super(Conf, self).__setattr__(name, value)
+
+    def conf_fingerprint(self, exclude=()):
+        """Return fingerprint of non dynamic config, to compare with other config.
+
+        Args:
+            exclude (tuple): names of config attributes to leave out.
+        Returns:
+            frozenset: config keys/values, as strings.
+        """
+        fingerprints = self._fingerprints
+        if fingerprints is not None and exclude in fingerprints:
+            return fingerprints[exclude]
+        fingerprint = frozenset([
+            str((k, v)) for k, v in self._conf_keys(self, dyn=False)
+            if k not in exclude])
+        if fingerprints is not None:
+            fingerprints[exclude] = fingerprint
+        return fingerprint
+
     def __hash__(self):
-        return hash(frozenset(list(map(
-            str, self._conf_keys(self, dyn=False)))))
+        return hash(self.conf_fingerprint())
 
     def __eq__(self, other):
+        if isinstance(other, Conf):
+            return self.conf_fingerprint() == other.conf_fingerprint()
         return hash(self) == hash(other)
 
     def __ne__(self, other):
@@ -17,6 +17,9 @@
 # limitations under the License.
 
 import collections
+import concurrent.futures
+import functools
+import multiprocessing
 
 try:
     import config_parser_util
@@ -46,7 +49,17 @@ V2_TOP_CONFS = (
     'vlans')
 
 
-def dp_parser(config_file, logname):
+def dp_parser(config_file, logname, processes=0):
+    """Parse DPs from a config file.
+
+    Args:
+        config_file (str): path to config file.
+        logname (str): logger name.
+        processes (int): if more than 1, construct DPs in this many processes
+            (for offline checking of large configs, not in the controller).
+    Returns:
+        tuple: config file hashes, and list of DPs (None if config is invalid).
+    """
     logger = config_parser_util.get_logger(logname)
     conf = config_parser_util.read_config(config_file, logname)
     config_hashes = None
@@ -57,99 +70,156 @@ def dp_parser(config_file, logname):
         if version != 2:
             logger.fatal('Only config version 2 is supported')
 
-        config_hashes, dps = _config_parser_v2(config_file, logname)
+        config_hashes, dps = _config_parser_v2(config_file, logname, processes)
     return config_hashes, dps
 
 
-def _dp_parser_v2(logger, acls_conf, dps_conf, meters_conf,
-                  routers_conf, vlans_conf):
-    dps = []
-    vid_dp = collections.defaultdict(set)
-
-    def _get_vlan_by_identifier(dp_id, vlan_ident, vlans):
+def _vlan_conf_vid(vlan_ident, vlan_conf):
+    """Return VID a VLAN will have, without constructing it."""
+    vid = None
+    if vlan_conf:
+        vid = vlan_conf.get('vid', None)
+    if vid is None:
+        return vlan_ident
+    return vid
+
+
+def _dp_parse_one(dp_ident, dp_conf, acls_conf, meters_conf,
+                  routers_conf, vlans_conf, vlan_ident_by_vid, acls=None):
+    """Construct a DP, and only the VLANs, ACLs and meters it references.
+
+    Args:
+        dp_ident: DP identifier.
+        dp_conf (dict): DP config.
+        acls_conf (dict): all ACL configs.
+        meters_conf (dict): all meter configs.
+        routers_conf (dict): all router configs.
+        vlans_conf (dict): all VLAN configs.
+        vlan_ident_by_vid (dict): VLAN identifiers by VID.
+        acls (dict): ACLs already constructed for other DPs, which are
+            shared as they are not changed by a DP.
+    Returns:
+        DP: DP with ports, VLANs, routers, ACLs and meters added.
+    """
+    if acls is None:
+        acls = {}
+    dp = DP(dp_ident, dp_conf)
+    dp.sanity_check()
+    dp_id = dp.dp_id
+    vlans = {}
+
+    def _get_vlan_by_identifier(vlan_ident):
         if vlan_ident in vlans:
             return vlans[vlan_ident]
-        for vlan in list(vlans.values()):
-            if int(vlan_ident) == vlan.vid:
-                return vlan
-        try:
-            vid = int(vlan_ident, 0)
-        except ValueError:
-            assert False, 'VLAN VID value (%s) is invalid' % vlan_ident
-
-        return vlans.setdefault(vlan_ident, VLAN(vid, dp_id))
-
-    def _dp_add_vlan(dp, vlan):
-        if vlan not in dp.vlans:
-            dp.add_vlan(vlan)
-            vid_dp[vlan.vid].add(dp.name)
-
-            if len(vid_dp[vlan.vid]) > 1:
-                assert not vlan.bgp_routerid, (
-                    'DPs %s sharing a BGP speaker VLAN is unsupported' % (
-                        str.join(', ', vid_dp[vlan.vid])))
-
-    def _dp_parse_port(dp_id, p_identifier, port_conf, vlans):
+        if vlan_ident in vlans_conf:
+            vlan = VLAN(vlan_ident, dp_id, vlans_conf[vlan_ident])
+        else:
+            try:
+                vid = int(str(vlan_ident), 0)
+            except ValueError:
+                assert False, 'VLAN VID value (%s) is invalid' % vlan_ident
+            if vid in vlan_ident_by_vid:
+                return _get_vlan_by_identifier(vlan_ident_by_vid[vid])
+            vlan = VLAN(vid, dp_id)
+        vlans[vlan_ident] = vlan
+        return vlan
+
+    def _dp_parse_port(p_identifier, port_conf):
         port = Port(p_identifier, port_conf)
 
         if port.mirror is not None:
             # ignore other config
             return port
         if port.native_vlan is not None:
-            v_identifier = port.native_vlan
-            vlan = _get_vlan_by_identifier(dp_id, v_identifier, vlans)
+            vlan = _get_vlan_by_identifier(port.native_vlan)
             vlan.add_untagged(port)
-        for v_identifier in port.tagged_vlans:
-            vlan = _get_vlan_by_identifier(dp_id, v_identifier, vlans)
-            vlan.add_tagged(port)
-        if port.native_vlan is not None:
-            vlan = _get_vlan_by_identifier(dp_id, port.native_vlan, vlans)
             port.native_vlan = vlan
-            _dp_add_vlan(dp, vlan)
+            if vlan not in dp.vlans:
+                dp.add_vlan(vlan)
         if port.tagged_vlans is not None:
             tagged_vlans = []
             for vlan_ident in port.tagged_vlans:
-                vlan = _get_vlan_by_identifier(dp_id, vlan_ident, vlans)
+                vlan = _get_vlan_by_identifier(vlan_ident)
+                vlan.add_tagged(port)
                 tagged_vlans.append(vlan)
-                _dp_add_vlan(dp, vlan)
+                if vlan not in dp.vlans:
+                    dp.add_vlan(vlan)
             port.tagged_vlans = tagged_vlans
         return port
 
-    def _dp_add_ports(dp, dp_conf, dp_id, vlans):
-        ports_conf = dp_conf.pop('interfaces', {})
-        # as users can config port vlan by using vlan name, we store vid in
-        # Port instance instead of vlan name for data consistency
-        for port_num, port_conf in list(ports_conf.items()):
-            port = _dp_parse_port(dp_id, port_num, port_conf, vlans)
-            dp.add_port(port)
+    def _dp_add_acl(acl_ident):
+        if acl_ident in dp.acls or acl_ident not in acls_conf:
+            return
+        if acl_ident not in acls:
+            acls[acl_ident] = ACL(acl_ident, acls_conf[acl_ident])
+        acl = acls[acl_ident]
+        dp.add_acl(acl_ident, acl)
+        for rule_conf in acl.rules:
+            meter_ident = rule_conf.get('actions', {}).get('meter', None)
+            if meter_ident in meters_conf and meter_ident not in dp.meters:
+                dp.meters[meter_ident] = Meter(
+                    meter_ident, meters_conf[meter_ident])
+
+    for router_ident, router_conf in list(routers_conf.items()):
+        router = Router(router_ident, router_conf)
+        dp.add_router(router_ident, router)
+    ports_conf = dp_conf.pop('interfaces', {})
+    # as users can config port vlan by using vlan name, we store vid in
+    # Port instance instead of vlan name for data consistency
+    for port_num, port_conf in list(ports_conf.items()):
+        port = _dp_parse_port(port_num, port_conf)
+        dp.add_port(port)
+    for acl_ident in list(dp.port_acl_in.values()) + list(dp.vlan_acl_in.values()):
+        _dp_add_acl(acl_ident)
+    return dp
 
 
+def _dp_parser_v2(logger, acls_conf, dps_conf, meters_conf,
+                  routers_conf, vlans_conf, processes=0):
+    vlan_ident_by_vid = {}
+    for vlan_ident, vlan_conf in list(vlans_conf.items()):
+        vlan_ident_by_vid.setdefault(
+            _vlan_conf_vid(vlan_ident, vlan_conf), vlan_ident)
     try:
-        for identifier, dp_conf in list(dps_conf.items()):
-            dp = DP(identifier, dp_conf)
-            dp.sanity_check()
-            dp_id = dp.dp_id
-
-            vlans = {}
-            for vlan_ident, vlan_conf in list(vlans_conf.items()):
-                vlans[vlan_ident] = VLAN(vlan_ident, dp_id, vlan_conf)
-            acls = []
-            for acl_ident, acl_conf in list(acls_conf.items()):
-                acls.append((acl_ident, ACL(acl_ident, acl_conf)))
-            for router_ident, router_conf in list(routers_conf.items()):
-                router = Router(router_ident, router_conf)
-                dp.add_router(router_ident, router)
-            for meter_ident, meter_conf in list(meters_conf.items()):
-                dp.meters[meter_ident] = Meter(meter_ident, meter_conf)
-            _dp_add_ports(dp, dp_conf, dp_id, vlans)
-            for acl_ident, acl in acls:
-                dp.add_acl(acl_ident, acl)
-            dps.append(dp)
+        if processes > 1 and len(dps_conf) > 1:
+            dp_parse = functools.partial(
+                _dp_parse_one, acls_conf=acls_conf, meters_conf=meters_conf,
+                routers_conf=routers_conf, vlans_conf=vlans_conf,
+                vlan_ident_by_vid=vlan_ident_by_vid)
+            # Spawn rather than fork processes, which is unsafe with threads.
+            with concurrent.futures.ProcessPoolExecutor(
+                    processes,
+                    mp_context=multiprocessing.get_context('spawn')) as pool:
+                dps = list(pool.map(
+                    dp_parse, list(dps_conf.keys()), list(dps_conf.values())))
+            # Share ACLs between DPs, as when constructed in this process.
+            acls = {}
+            for dp in dps:
+                for acl_ident, acl in list(dp.acls.items()):
+                    dp.acls[acl_ident] = acls.setdefault(acl_ident, acl)
+        else:
+            acls = {}
+            dps = [
+                _dp_parse_one(
+                    dp_ident, dp_conf, acls_conf, meters_conf, routers_conf,
+                    vlans_conf, vlan_ident_by_vid, acls)
+                for dp_ident, dp_conf in list(dps_conf.items())]
+
+        vid_dp = collections.defaultdict(set)
+        for dp in dps:
+            for vlan in list(dp.vlans.values()):
+                vid_dp[vlan.vid].add(dp.name)
+                if len(vid_dp[vlan.vid]) > 1:
+                    assert not vlan.bgp_routerid, (
+                        'DPs %s sharing a BGP speaker VLAN is unsupported' % (
+                            str.join(', ', vid_dp[vlan.vid])))
 
         for dp in dps:
             dp.finalize_config(dps)
         for dp in dps:
             dp.resolve_stack_topology(dps)
+        for dp in dps:
+            dp.freeze()
 
     except AssertionError as err:
         logger.exception('Error in config file: %s', err)
@@ -158,7 +228,7 @@ def _dp_parser_v2(logger, acls_conf, dps_conf, meters_conf,
     return dps
 
 
-def _config_parser_v2(config_file, logname):
+def _config_parser_v2(config_file, logname, processes=0):
     logger = config_parser_util.get_logger(logname)
     config_path = config_parser_util.dp_config_path(config_file)
     top_confs = {}
@@ -179,7 +249,8 @@ def _config_parser_v2(config_file, logname):
             top_confs['dps'],
             top_confs['meters'],
             top_confs['routers'],
-            top_confs['vlans'])
+            top_confs['vlans'],
+            processes)
     return (config_hashes, dps)
 
 
@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import hashlib
 import logging
 import os
@@ -25,20 +26,48 @@ def get_logger(logname):
     return logging.getLogger(logname + '.config')
 
 
+# SHA256 hash, and parsed YAML, by config file.
+_CONFIG_FILE_CACHE = {}
+
+
+def _cached_config_file(config_file):
+    """Return hash and parsed YAML of a config file, parsing only if changed.
+
+    The file is always read and hashed, as modification time and size
+    can be unchanged by an edit (e.g. when copied preserving times), and
+    parsed again only if its content hash has changed.
+
+    Args:
+        config_file (str): config file name.
+    Returns:
+        tuple: SHA256 hash of file content, and parsed YAML (not to be modified).
+    """
+    config_path = os.path.realpath(config_file)
+    with open(config_path, 'r') as stream:
+        content = stream.read()
+    config_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    cached = _CONFIG_FILE_CACHE.get(config_path, None)
+    if cached is not None and cached[0] == config_hash:
+        return cached
+    conf = yaml.safe_load(content)
+    _CONFIG_FILE_CACHE[config_path] = (config_hash, conf)
+    return (config_hash, conf)
+
+
 def read_config(config_file, logname):
     logger = get_logger(logname)
     try:
-        with open(config_file, 'r') as stream:
-            conf = yaml.safe_load(stream)
+        _, conf = _cached_config_file(config_file)
     except yaml.YAMLError as ex:
         logger.error('Error in file %s (%s)', config_file, str(ex))
         return None
-    return conf
+    # Callers consume the config, so give them their own copy.
+    return copy.deepcopy(conf)
 
 
 def config_file_hash(config_file_name):
-    with open(config_file_name) as config_file:
-        return hashlib.sha256(config_file.read().encode('utf-8')).hexdigest()
+    config_hash, _ = _cached_config_file(config_file_name)
+    return config_hash
 
 
 def dp_config_path(config_file, parent_file=None):
@@ -127,6 +156,8 @@ def config_changed(top_config_file, new_top_config_file, config_hashes):
         # Config file loaded but no longer exists = reload.
         if config_hash and not config_file_exists:
             return True
+        if not config_file_exists:
+            continue
         # Config file hash has changed = reload.
         new_config_hash = config_file_hash(config_file)
         if new_config_hash != config_hash:
@@ -61,6 +61,7 @@ class DP(Conf):
     groups = None
     group_table = False
     group_table_routing = False
+    ecmp_routing = None
     max_hosts_per_resolve_cycle = None
     max_host_fib_retry_count = None
     max_resolve_backoff_time = None
@@ -71,9 +72,19 @@ class DP(Conf):
     proactive_learn = None
     pipeline_config_dir = None
     use_idle_timeout = None
+    sort_flowmods = None
+    reconcile_on_connect = None
+    use_shadow_table = None
+    use_bundles = None
+    barrier_interval = None
+    output_queue_size = None
     tables = {}
     tables_by_id = {}
     meters = {}
+    # Define dynamic variables with prefix dyn_ to distinguish from variables set
+    # configuration
+    dyn_stack_paths = None
+    dyn_stack_path_ports = None
 
     # Values that are set to None will be set using set_defaults
     # they are included here for testing and informational purposes
@@ -121,6 +132,8 @@ class DP(Conf):
         # Use GROUP tables for VLAN flooding
         'group_table_routing': False,
         # Use GROUP tables for routing (nexthops)
+        'ecmp_routing': False,
+        # Spread routes with several gateways across them with select groups (needs group_table_routing).
         'max_hosts_per_resolve_cycle': 5,
         # Max hosts to try to resolve per gateway resolution cycle.
         'max_host_fib_retry_count': 10,
@@ -141,6 +154,18 @@ class DP(Conf):
         # where config files for pipeline are stored (if any).
         'use_idle_timeout': False,
         #Turn on/off the use of idle timeout for src_table, default OFF.
+        'sort_flowmods': False,
+        # Send flows in table and priority order, which some hardware installs faster.
+        'reconcile_on_connect': False,
+        # On connect, read flows back from the datapath and send only the difference (needs use_shadow_table).
+        'use_shadow_table': False,
+        # Keep a copy of flows sent to the datapath, so reloads send only the difference.
+        'use_bundles': False,
+        # Install each batch of flows atomically in a bundle, if the datapath supports it.
+        'barrier_interval': 0,
+        # If not using bundles, send a barrier after this many messages in a batch (0 for none).
+        'output_queue_size': 1024,
+        # Batches of flow messages queued to send to the DP, before they are discarded and the DP cold started (0 for no limit).
         }
 
     defaults_types = {
@@ -166,6 +191,7 @@ class DP(Conf):
         'drop_lldp': bool,
         'group_table': bool,
         'group_table_routing': bool,
+        'ecmp_routing': bool,
         'max_hosts_per_resolve_cycle': int,
         'max_host_fib_retry_count': int,
         'max_resolve_backoff_time': int,
@@ -176,6 +202,12 @@ class DP(Conf):
         'proactive_learn': bool,
         'pipeline_config_dir': str,
         'use_idle_timeout': bool,
+        'sort_flowmods': bool,
+        'reconcile_on_connect': bool,
+        'use_shadow_table': bool,
+        'use_bundles': bool,
+        'barrier_interval': int,
+        'output_queue_size': int,
     }
 
     wildcard_table = ValveTable(ofp.OFPTT_ALL, 'all', None, flow_cookie=0)
@@ -198,6 +230,10 @@ class DP(Conf):
         assert str(self.dp_id).isdigit()
         assert not (self.group_table and self.group_table_routing), (
             'groups for routing and other functions simultaneously not supported')
+        assert self.group_table_routing or not self.ecmp_routing, (
+            'ECMP routing requires group_table_routing')
+        assert self.use_shadow_table or not self.reconcile_on_connect, (
+            'reconcile_on_connect requires use_shadow_table')
         for vlan in list(self.vlans.values()):
             assert isinstance(vlan, VLAN)
             assert all(isinstance(p, Port) for p in vlan.get_ports())
@@ -223,7 +259,8 @@ class DP(Conf):
             table_name, restricted_match_types = table_config
             self.tables[table_name] = ValveTable(
                 table_id, table_name, restricted_match_types,
-                self.cookie, notify_flow_removed=self.use_idle_timeout)
+                self.cookie, notify_flow_removed=self.use_idle_timeout,
+                notify_timeouts=self.use_shadow_table)
             self.tables_by_id[table_id] = self.tables[table_name]
 
     def set_defaults(self):
@@ -264,6 +301,15 @@ class DP(Conf):
         """
         return list(self.tables_by_id.values())
 
+    def freeze(self):
+        """Cache config fingerprints of this DP and all config it contains."""
+        for conf in (
+                list(self.ports.values()) + list(self.vlans.values()) +
+                list(self.acls.values()) + list(self.routers.values()) +
+                list(self.meters.values())):
+            conf.freeze()
+        super(DP, self).freeze()
+
     def add_acl(self, acl_ident, acl):
         self.acls[acl_ident] = acl
 
@@ -347,13 +393,43 @@ class DP(Conf):
                 self.stack = {}
             self.stack['root_dp'] = root_dp
             self.stack['graph'] = graph
+            self._resolve_stack_paths()
+
+    def _resolve_stack_paths(self):
+        """Precompute shortest paths, and next hop ports, to all stack DPs."""
+        self.dyn_stack_paths = networkx.single_source_shortest_path(
+            self.stack['graph'], self.name)
+        self.dyn_stack_path_ports = {}
+        for dest_dp, path in list(self.dyn_stack_paths.items()):
+            if len(path) < 2:
+                continue
+            peer_dp = path[1]
+            for port in self.stack_ports:
+                if port.stack['dp'].name == peer_dp:
+                    self.dyn_stack_path_ports[dest_dp] = port
+                    break
+
+    def invalidate_stack_paths(self):
+        """Discard precomputed stack paths, eg. when a stack link changes.
+
+        Paths are recomputed from the stack graph when next needed.
+        """
+        self.dyn_stack_paths = None
+        self.dyn_stack_path_ports = None
+
+    def _stack_paths(self):
+        if self.stack is None or 'graph' not in self.stack:
+            return None
+        if self.dyn_stack_paths is None:
+            self._resolve_stack_paths()
+        return self.dyn_stack_paths
 
     def shortest_path(self, dest_dp):
         """Return shortest path to a DP, as a list of DPs."""
-        if self.stack is None:
+        stack_paths = self._stack_paths()
+        if stack_paths is None:
             return None
-        return networkx.shortest_path(
-            self.stack['graph'], self.name, dest_dp)
+        return stack_paths.get(dest_dp, None)
 
     def shortest_path_to_root(self):
         """Return shortest path to root DP, as list of DPs."""
@@ -365,15 +441,9 @@ class DP(Conf):
 
     def shortest_path_port(self, dest_dp):
         """Return port on our DP, that is the shortest path towards dest DP."""
-        shortest_path = self.shortest_path(dest_dp)
-        if shortest_path is not None:
-            peer_dp = shortest_path[1]
-            peer_dp_ports = []
-            for port in self.stack_ports:
-                if port.stack['dp'].name == peer_dp:
-                    peer_dp_ports.append(port)
-            return peer_dp_ports[0]
-        return None
+        if self._stack_paths() is None:
+            return None
+        return self.dyn_stack_path_ports.get(dest_dp, None)
 
     def finalize_config(self, dps):
 
@@ -414,38 +484,54 @@ class DP(Conf):
                 port.mirror = mirror_destination_port.number
                 mirror_destination_port.mirror_destination = True
 
+        def resolve_names_in_acl_actions(actions):
+            """Return copy of ACL rule actions with port names resolved."""
+            actions = dict(actions)
+            if 'meter' in actions:
+                meter_name = actions['meter']
+                assert meter_name in self.meters
+            if 'mirror' in actions:
+                port_name = actions['mirror']
+                port_no = resolve_port_no(port_name)
+                # in V2 config, we might have an ACL that does
+                # not apply to a DP.
+                if port_no is not None:
+                    actions['mirror'] = port_no
+                    port = self.ports[port_no]
+                    port.mirror_destination = True
+            if 'output' in actions:
+                output_values = dict(actions['output'])
+                if 'port' in output_values:
+                    port_name = output_values['port']
+                    port_no = resolve_port_no(port_name)
+                    if port_no is not None:
+                        output_values['port'] = port_no
+                if 'failover' in output_values:
+                    failover = dict(output_values['failover'])
+                    resolved_ports = []
+                    for port_name in failover['ports']:
+                        port_no = resolve_port_no(port_name)
+                        if port_no is not None:
+                            resolved_ports.append(port_no)
+                    failover['ports'] = resolved_ports
+                    output_values['failover'] = failover
+                actions['output'] = output_values
+            return actions
+
         def resolve_names_in_acls():
-            for acl in list(self.acls.values()):
+            # ACLs are shared between DPs, so those with names to resolve
+            # are copied rather than changed.
+            for acl_ident, acl in list(self.acls.items()):
+                rules = []
                 for rule_conf in acl.rules:
-                    for attrib, attrib_value in list(rule_conf.items()):
-                        if attrib == 'actions':
-                            if 'meter' in attrib_value:
-                                meter_name = attrib_value['meter']
-                                assert meter_name in self.meters
-                            if 'mirror' in attrib_value:
-                                port_name = attrib_value['mirror']
-                                port_no = resolve_port_no(port_name)
-                                # in V2 config, we might have an ACL that does
-                                # not apply to a DP.
-                                if port_no is not None:
-                                    attrib_value['mirror'] = port_no
-                                    port = self.ports[port_no]
-                                    port.mirror_destination = True
-                            if 'output' in attrib_value:
-                                output_values = attrib_value['output']
-                                if 'port' in output_values:
-                                    port_name = output_values['port']
-                                    port_no = resolve_port_no(port_name)
-                                    if port_no is not None:
-                                        output_values['port'] = port_no
-                                if 'failover' in output_values:
-                                    failover = output_values['failover']
-                                    resolved_ports = []
-                                    for port_name in failover['ports']:
-                                        port_no = resolve_port_no(port_name)
-                                        if port_no is not None:
-                                             resolved_ports.append(port_no)
-                                    failover['ports'] = resolved_ports
+                    if 'actions' in rule_conf:
+                        rule_conf = dict(rule_conf)
+                        rule_conf['actions'] = resolve_names_in_acl_actions(
+                            rule_conf['actions'])
+                    rules.append(rule_conf)
+                if rules != acl.rules:
+                    self.acls[acl_ident] = ACL(
+                        acl_ident, [{'rule': rule_conf} for rule_conf in rules])
 
         def resolve_vlan_names_in_routers():
             for router_name in list(self.routers.keys()):
@@ -18,10 +18,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import logging
 import os
 import random
 import signal
+import time
 
 from ryu.base import app_manager
 from ryu.controller.handler import CONFIG_DISPATCHER
@@ -40,6 +42,8 @@ try:
     import faucet_api
     import faucet_bgp
     import faucet_metrics
+    import faucet_output
+    import valve_host
     import valve_packet
     import valve_of
 except ImportError:
@@ -50,6 +54,8 @@ except ImportError:
     from faucet import faucet_api
     from faucet import faucet_bgp
     from faucet import faucet_metrics
+    from faucet import faucet_output
+    from faucet import valve_host
     from faucet import valve_packet
     from faucet import valve_of
 
@@ -79,6 +85,11 @@ class EventFaucetAdvertise(event.EventBase):
     pass
 
 
+class EventFaucetBgpRouteUpdate(event.EventBase):
+    """Event used to trigger applying queued BGP route changes."""
+    pass
+
+
 class EventFaucetAPIRegistered(event.EventBase):
     """Event used to notify that the API is registered with Faucet."""
     pass
@@ -125,6 +136,17 @@ class Faucet(app_manager.RyuApp):
             self.exc_logname, self.exc_logfile, logging.DEBUG, 1)
 
         self.valves = {}
+        # Which DP(s) each host was learned on at the edge, for all DPs.
+        self.edge_hosts = valve_host.EdgeHostIndex()
+        # Replies received so far, by DP, from DPs reconciling on connect.
+        self._reconcile_replies = {}
+        # Batches of flow messages not yet known to be installed.
+        self._flow_batches = faucet_output.FaucetFlowBatches()
+        self._bundle_ids = itertools.count(1)
+        # DPs that have rejected bundles, which are sent unbundled instead.
+        self._bundles_unsupported = set()
+        # Queue of batches of messages to send, with thread sending them, by DP.
+        self._output_queues = {}
 
         # Start Prometheus
         prom_port = int(os.getenv('FAUCET_PROMETHEUS_PORT', '9302'))
@@ -142,7 +164,8 @@ class Faucet(app_manager.RyuApp):
         self._threads = [
             hub.spawn(thread) for thread in (
                 self._gateway_resolve_request, self._host_expire_request,
-                self._metric_update_request, self._advertise_request)]
+                self._metric_update_request, self._advertise_request,
+                self._bgp_route_update_request)]
 
         # Register to API
         api = kwargs['faucet_api']
@@ -154,9 +177,9 @@ class Faucet(app_manager.RyuApp):
 
     @kill_on_exception(exc_logname)
     def _load_configs(self, new_config_file):
+        load_start = time.time()
         self.config_file = new_config_file
-        self.config_hashes, new_dps = dp_parser(
-            new_config_file, self.logname)
+        self.config_hashes, new_dps = dp_parser(new_config_file, self.logname)
         if new_dps is None:
             self.logger.error('new config bad - rejecting')
             return
@@ -188,7 +211,7 @@ class Faucet(app_manager.RyuApp):
                         sorted(list(SUPPORTED_HARDWARE.keys())))
                     continue
                 else:
-                    valve = valve_cl(new_dp, self.logname)
+                    valve = valve_cl(new_dp, self.logname, self.edge_hosts)
                     self.valves[dp_id] = valve
                 self.logger.info('Add new datapath %s', dpid_log(dp_id))
             self.metrics.reset_dpid(dp_id)
@@ -197,10 +220,13 @@ class Faucet(app_manager.RyuApp):
             self.logger.info(
                 'Deleting de-configured %s', dpid_log(deleted_valve_dpid))
             del self.valves[deleted_valve_dpid]
+            self.edge_hosts.expire_dp(deleted_valve_dpid)
             ryu_dp = self.dpset.get(deleted_valve_dpid)
             if ryu_dp is not None:
                 ryu_dp.close()
         self._bgp.reset(self.valves, self.metrics)
+        # pylint: disable=no-member
+        self.metrics.faucet_config_load_time.set(time.time() - load_start)
 
     @kill_on_exception(exc_logname)
     def _send_flow_msgs(self, dp_id, flow_msgs, ryu_dp=None):
@@ -221,14 +247,83 @@ class Faucet(app_manager.RyuApp):
                 return
 
         valve = self.valves[dp_id]
-        reordered_flow_msgs = valve_of.valve_flowreorder(flow_msgs)
+        reordered_flow_msgs = valve_of.valve_flowreorder(
+            flow_msgs, sort_adds=valve.dp.sort_flowmods)
         valve.ofchannel_log(reordered_flow_msgs)
-        for flow_msg in reordered_flow_msgs:
+        valve.shadow_table.apply_ofmsgs(reordered_flow_msgs)
+        self._queue_flow_batch(valve, ryu_dp, reordered_flow_msgs)
+
+    def _queue_flow_batch(self, valve, ryu_dp, flow_msgs, use_bundles=True):
+        """Queue a batch of OpenFlow messages, to be sent by the DP's own thread.
+
+        Never waits for a slow datapath, which would stall handlers for
+        all datapaths. If the DP's queue is full, queued batches are
+        discarded and the DP is cold started, as its flows are no longer
+        known.
+
+        Args:
+            valve (Valve): Valve for the datapath.
+            ryu_dp (ryu.controller.controller.Datapath): datapath.
+            flow_msgs (list): OpenFlow messages to send, in order.
+            use_bundles (bool): True if the batch may be sent in a bundle.
+        """
+        dp_id = ryu_dp.id
+        if dp_id not in self._output_queues:
+            self._output_queues[dp_id] = faucet_output.FaucetOutputQueue(
+                self._send_flow_batch, valve.dp.output_queue_size)
+        output_queue = self._output_queues[dp_id]
+        if not output_queue.put(valve, ryu_dp, flow_msgs, use_bundles):
+            self.logger.warning(
+                'output queue full for %s, cold starting', dpid_log(dp_id))
+            # pylint: disable=no-member
+            self.metrics.of_flowmsgs_queue_overflows.labels(dp_id=hex(dp_id)).inc()
+            self._send_flow_msgs(
+                dp_id,
+                valve.datapath_connect(dp_id, self._discovered_up_port_nums(ryu_dp)),
+                ryu_dp=ryu_dp)
+            return
+        # pylint: disable=no-member
+        self.metrics.of_flowmsgs_queued.labels(
+            dp_id=hex(dp_id)).set(output_queue.qsize())
+
+    def _stop_output_queue(self, dp_id):
+        """Discard messages queued for a DP, and stop its thread."""
+        if dp_id in self._output_queues:
+            self._output_queues.pop(dp_id).stop()
             # pylint: disable=no-member
-            self.metrics.of_flowmsgs_sent.labels(
-                dp_id=hex(dp_id)).inc()
-            flow_msg.datapath = ryu_dp
+            self.metrics.of_flowmsgs_queued.labels(dp_id=hex(dp_id)).set(0)
+
+    @kill_on_exception(exc_logname)
+    def _send_flow_batch(self, valve, ryu_dp, flow_msgs, use_bundles, queued_time):
+        """Send a batch of OpenFlow messages, in a bundle or with barriers.
+
+        Args:
+            valve (Valve): Valve for the datapath.
+            ryu_dp (ryu.controller.controller.Datapath): datapath.
+            flow_msgs (list): OpenFlow messages to send, in order.
+            use_bundles (bool): True if the batch may be sent in a bundle.
+            queued_time (float): time the batch was queued.
+        """
+        dp_id = ryu_dp.id
+        if not ryu_dp.is_active:
+            return
+        # pylint: disable=no-member
+        self.metrics.of_flowmsgs_queue_latency.labels(
+            dp_id=hex(dp_id)).set(time.time() - queued_time)
+        bundle_id = None
+        if (use_bundles and valve.dp.use_bundles and
+                dp_id not in self._bundles_unsupported):
+            bundle_id = next(self._bundle_ids) & 0xffffffff
+        flow_msgs = self._flow_batches.prepare(
+            ryu_dp, flow_msgs, bundle_id, valve.dp.barrier_interval)
+        self.metrics.of_flowmsgs_sent.labels(
+            dp_id=hex(dp_id)).inc(len(flow_msgs))
+        for flow_msg in flow_msgs:
             ryu_dp.send_msg(flow_msg)
+        output_queue = self._output_queues.get(dp_id, None)
+        if output_queue is not None:
+            self.metrics.of_flowmsgs_queued.labels(
+                dp_id=hex(dp_id)).set(output_queue.qsize())
 
     def _get_valve(self, ryu_dp, handler_name, msg=None):
         """Get Valve instance to response to an event.
@@ -283,6 +378,9 @@ class Faucet(app_manager.RyuApp):
     def _advertise_request(self):
         self._thread_reschedule(EventFaucetAdvertise(), 5)
 
+    def _bgp_route_update_request(self):
+        self._thread_reschedule(EventFaucetBgpRouteUpdate(), 1, jitter=0)
+
     @set_ev_cls(EventFaucetResolveGateways, MAIN_DISPATCHER)
     @kill_on_exception(exc_logname)
     def resolve_gateways(self, _):
@@ -315,6 +413,12 @@ class Faucet(app_manager.RyuApp):
             if flowmods:
                 self._send_flow_msgs(dp_id, flowmods)
 
+    @set_ev_cls(EventFaucetBgpRouteUpdate, MAIN_DISPATCHER)
+    @kill_on_exception(exc_logname)
+    def bgp_route_update(self, _):
+        """Handle a request to apply queued BGP route changes."""
+        self._bgp.update_routes()
+
     def get_config(self):
         """FAUCET API: return config for all Valves."""
         return get_config_for_api(self.valves)
@@ -354,19 +458,23 @@ class Faucet(app_manager.RyuApp):
 
         in_port = msg.match['in_port']
         # eth/VLAN header only
-        pkt, vlan_vid = valve_packet.parse_packet_in_pkt(msg.data, max_len=(14 + 4))
-        if pkt is None or vlan_vid is None:
+        _, _, vlan_vid, _ = valve_packet.parse_eth_header(msg.data)
+        if vlan_vid is None:
             self.logger.info(
                 'unparseable packet from %s port %s', dpid_log(dp_id), in_port)
             return
-        pkt_meta = valve.parse_rcv_packet(in_port, vlan_vid, msg.data, pkt)
+        pkt_meta = valve.parse_rcv_packet(in_port, vlan_vid, msg.data)
 
         # pylint: disable=no-member
         self.metrics.of_packet_ins.labels(
             dp_id=hex(dp_id)).inc()
         flowmods = valve.rcv_packet(dp_id, self.valves, pkt_meta)
+        self.metrics.of_packet_in_reparses.labels(
+            dp_id=hex(dp_id)).inc(pkt_meta.reparses)
+        self.metrics.of_packet_in_reparses_avoided.labels(
+            dp_id=hex(dp_id)).inc(pkt_meta.reparses_avoided)
         self._send_flow_msgs(dp_id, flowmods)
-        valve.update_metrics(self.metrics)
+        valve.update_changed_metrics(self.metrics)
 
     @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
@@ -385,6 +493,42 @@ class Faucet(app_manager.RyuApp):
         # pylint: disable=no-member
         self.metrics.of_errors.labels(dp_id=hex(dp_id)).inc()
         self.logger.error('OFError %s from %s', msg, dpid_log(dp_id))
+        # A message was not applied, so flows on the datapath are not known.
+        valve.shadow_table.reset()
+        unbundled_msgs = self._flow_batches.failed_bundle(dp_id, msg.xid)
+        if unbundled_msgs is not None:
+            # The bundle was not committed, so send its messages unbundled.
+            ofp = ryu_dp.ofproto
+            if msg.type == ofp.OFPET_BAD_REQUEST and msg.code in (
+                    ofp.OFPBRC_BAD_EXPERIMENTER, ofp.OFPBRC_BAD_EXP_TYPE):
+                self.logger.info(
+                    'bundles not supported by %s', dpid_log(dp_id))
+                self._bundles_unsupported.add(dp_id)
+            self._queue_flow_batch(
+                valve, ryu_dp, unbundled_msgs, use_bundles=False)
+        if dp_id in self._reconcile_replies:
+            # Flows could not be read back, so cold start instead.
+            discovered_up_port_nums, _, _ = self._reconcile_replies.pop(dp_id)
+            flowmods = valve.datapath_connect(dp_id, discovered_up_port_nums)
+            self._datapath_connected(dp_id, flowmods)
+
+    @set_ev_cls([ofp_event.EventOFPBarrierReply,
+                 ofp_event.EventONFBundleCtrlMsg], MAIN_DISPATCHER) # pylint: disable=no-member
+    @kill_on_exception(exc_logname)
+    def flow_batch_reply_handler(self, ryu_event):
+        """Handle a barrier or bundle commit reply, completing a batch.
+
+        Args:
+            ryu_event (ryu.controller.ofp_event.EventOFPMsgBase): trigger.
+        """
+        msg = ryu_event.msg
+        dp_id = msg.datapath.id
+        batch = self._flow_batches.complete(dp_id, msg.xid)
+        if batch is None:
+            return
+        # pylint: disable=no-member
+        self.metrics.of_flowmsgs_batch_latency.labels(
+            dp_id=hex(dp_id)).observe(time.time() - batch.start_time)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
@@ -403,6 +547,11 @@ class Faucet(app_manager.RyuApp):
         flowmods = valve.switch_features(dp_id, msg)
         self._send_flow_msgs(dp_id, flowmods, ryu_dp=ryu_dp)
 
+    @staticmethod
+    def _discovered_up_port_nums(ryu_dp):
+        return [
+            port.port_no for port in list(ryu_dp.ports.values()) if port.state == 0]
+
     @kill_on_exception(exc_logname)
     def _datapath_connect(self, ryu_dp):
         """Handle any/all re/connection of a datapath.
@@ -414,15 +563,67 @@ class Faucet(app_manager.RyuApp):
         valve = self._get_valve(ryu_dp, '_datapath_connect')
         if valve is None:
             return
-        discovered_up_port_nums = [
-            port.port_no for port in list(ryu_dp.ports.values()) if port.state == 0]
+        discovered_up_port_nums = self._discovered_up_port_nums(ryu_dp)
+        if valve.dp.reconcile_on_connect:
+            # Provision when all replies about flows on the DP have arrived.
+            stats_requests = valve.reconcile_stats_requests()
+            reply_types = set([stats_request.type for stats_request in stats_requests])
+            self._reconcile_replies[dp_id] = (
+                discovered_up_port_nums, reply_types,
+                dict([(reply_type, []) for reply_type in reply_types]))
+            self._send_flow_msgs(dp_id, stats_requests)
+            return
         flowmods = valve.datapath_connect(
             dp_id, discovered_up_port_nums)
+        self._datapath_connected(dp_id, flowmods)
+
+    def _datapath_connected(self, dp_id, flowmods):
+        """Provision a newly connected datapath.
+
+        Args:
+            dp_id (int): datapath ID.
+            flowmods (list): OpenFlow messages to provision datapath.
+        """
         self._send_flow_msgs(dp_id, flowmods)
         # pylint: disable=no-member
         self.metrics.of_dp_connections.labels(dp_id=hex(dp_id)).inc()
         self.metrics.dp_status.labels(dp_id=hex(dp_id)).set(1)
 
+    @set_ev_cls([ofp_event.EventOFPFlowStatsReply,
+                 ofp_event.EventOFPGroupDescStatsReply,
+                 ofp_event.EventOFPMeterConfigStatsReply], MAIN_DISPATCHER) # pylint: disable=no-member
+    @kill_on_exception(exc_logname)
+    def reconcile_reply_handler(self, ryu_event):
+        """Handle a reply about flows, groups or meters on a reconciling datapath.
+
+        Args:
+            ryu_event (ryu.controller.ofp_event.EventOFPStatsReply): trigger.
+        """
+        msg = ryu_event.msg
+        ryu_dp = msg.datapath
+        dp_id = ryu_dp.id
+        if dp_id not in self._reconcile_replies:
+            return
+        valve = self._get_valve(ryu_dp, 'reconcile_reply_handler', msg)
+        if valve is None:
+            return
+        discovered_up_port_nums, reply_types, replies = self._reconcile_replies[dp_id]
+        if msg.type not in reply_types:
+            return
+        ofp = ryu_dp.ofproto
+        replies[msg.type].extend(msg.body)
+        if msg.flags & ofp.OFPMPF_REPLY_MORE:
+            return
+        reply_types.remove(msg.type)
+        if reply_types:
+            return
+        del self._reconcile_replies[dp_id]
+        flowmods = valve.datapath_reconcile(
+            dp_id, discovered_up_port_nums,
+            replies[ofp.OFPMP_FLOW], replies[ofp.OFPMP_GROUP_DESC],
+            replies.get(ofp.OFPMP_METER_CONFIG, []))
+        self._datapath_connected(dp_id, flowmods)
+
     @kill_on_exception(exc_logname)
     def _datapath_disconnect(self, ryu_dp):
         """Handle any/all disconnection of a datapath.
@@ -431,9 +632,13 @@ class Faucet(app_manager.RyuApp):
             ryu_dp (ryu.controller.controller.Datapath): datapath.
         """
         dp_id = ryu_dp.id
+        self._stop_output_queue(dp_id)
         valve = self._get_valve(ryu_dp, '_datapath_disconnect')
         if valve is None:
             return
+        self._reconcile_replies.pop(dp_id, None)
+        self._flow_batches.clear(dp_id)
+        self._bundles_unsupported.discard(dp_id)
         valve.datapath_disconnect(dp_id)
         # pylint: disable=no-member
         self.metrics.of_dp_disconnections.labels(dp_id=hex(dp_id)).inc()
@@ -509,9 +714,7 @@ class Faucet(app_manager.RyuApp):
         valve = self._get_valve(ryu_dp, 'flowremoved_handler', msg)
         if valve is None:
             return
-        ofp = msg.datapath.ofproto
-        reason = msg.reason
-        if reason == ofp.OFPRR_IDLE_TIMEOUT:
-            flowmods = valve.flow_timeout(msg.table_id, msg.match)
-            if flowmods:
-                self._send_flow_msgs(ryu_dp.id, flowmods)
+        flowmods = valve.flow_removed(
+            msg.table_id, msg.priority, msg.match, msg.reason)
+        if flowmods:
+            self._send_flow_msgs(ryu_dp.id, flowmods)
@@ -18,8 +18,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import json
 import ipaddress
+import time
+
 from ryu.services.protocols.bgp.bgpspeaker import BGPSpeaker
 try:
     from valve_util import btos
@@ -33,12 +36,16 @@ class FaucetBgp(object):
         self._dp_bgp_speakers = {}
         self._metrics = None
         self._valves = None
+        self._path_changes = collections.OrderedDict()
         self.logger = logger
         self._send_flow_msgs = send_flow_msgs
 
     def _bgp_route_handler(self, path_change, vlan):
         """Handle a BGP change event.
 
+        The change is queued, to be applied by update_routes(). A change for
+        a prefix replaces any change still queued for it.
+
         Args:
             path_change (ryu.services.protocols.bgp.bgpspeaker.EventPrefix): path change
             vlan (vlan): Valve VLAN this path change was received for.
@@ -46,10 +53,8 @@ class FaucetBgp(object):
         prefix = ipaddress.ip_network(btos(path_change.prefix))
         nexthop = ipaddress.ip_address(btos(path_change.nexthop))
         withdraw = path_change.is_withdraw
-        flowmods = []
         if not self._valves or vlan.dp_id not in self._valves:
             return
-        valve = self._valves[vlan.dp_id]
         if vlan.is_faucet_vip(nexthop):
             self.logger.error(
                 'BGP nexthop %s for prefix %s cannot be us',
@@ -64,13 +69,52 @@ class FaucetBgp(object):
         if withdraw:
             self.logger.info(
                 'BGP withdraw %s nexthop %s', prefix, nexthop)
-            flowmods = valve.del_route(vlan, prefix)
         else:
             self.logger.info(
                 'BGP add %s nexthop %s', prefix, nexthop)
-            flowmods = valve.add_route(vlan, nexthop, prefix)
-        if flowmods:
-            self._send_flow_msgs(vlan.dp_id, flowmods)
+        path_change_key = (vlan.dp_id, vlan.vid, prefix)
+        queued_time = time.time()
+        if path_change_key in self._path_changes:
+            _, _, _, queued_time = self._path_changes.pop(path_change_key)
+        self._path_changes[path_change_key] = (
+            vlan, nexthop, withdraw, queued_time)
+
+    def update_routes(self):
+        """Apply queued BGP changes, sending one batch of flowmods per DP."""
+        if not self._path_changes:
+            return
+        path_changes = self._path_changes
+        self._path_changes = collections.OrderedDict()
+        now = time.time()
+        flowmods_by_dp_id = {}
+        batch_size_by_dp_id = {}
+        queued_time_by_dp_id = {}
+        for path_change_key, path_change in list(path_changes.items()):
+            dp_id, _, prefix = path_change_key
+            vlan, nexthop, withdraw, queued_time = path_change
+            if not self._valves or dp_id not in self._valves:
+                continue
+            valve = self._valves[dp_id]
+            if dp_id not in flowmods_by_dp_id:
+                flowmods_by_dp_id[dp_id] = []
+                batch_size_by_dp_id[dp_id] = 0
+                queued_time_by_dp_id[dp_id] = queued_time
+            if withdraw:
+                flowmods = valve.del_route(vlan, prefix)
+            else:
+                flowmods = valve.add_route(vlan, nexthop, prefix)
+            flowmods_by_dp_id[dp_id].extend(flowmods)
+            batch_size_by_dp_id[dp_id] += 1
+            queued_time_by_dp_id[dp_id] = min(
+                queued_time_by_dp_id[dp_id], queued_time)
+        for dp_id, flowmods in list(flowmods_by_dp_id.items()):
+            # pylint: disable=no-member
+            self._metrics.bgp_route_batch_size.labels(
+                dp_id=hex(dp_id)).set(batch_size_by_dp_id[dp_id])
+            self._metrics.bgp_route_queue_latency.labels(
+                dp_id=hex(dp_id)).set(now - queued_time_by_dp_id[dp_id])
+            if flowmods:
+                self._send_flow_msgs(dp_id, flowmods)
 
     def _create_bgp_speaker_for_vlan(self, vlan):
         """Set up BGP speaker for an individual VLAN if required.
@@ -107,6 +151,8 @@ class FaucetBgp(object):
         """Set up a BGP speaker for every VLAN that requires it."""
         self._valves = valves
         self._metrics = metrics
+        # Speakers are recreated and will resend current paths.
+        self._path_changes = collections.OrderedDict()
         # TODO: port status changes should cause us to withdraw a route.
         for dp_id, valve in list(self._valves.items()):
             if dp_id not in self._dp_bgp_speakers:
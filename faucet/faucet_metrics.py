@@ -18,7 +18,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from prometheus_client import Counter, Gauge
+from prometheus_client import Counter, Gauge, Histogram
 
 try:
     from prom_client import PromClient
@@ -54,9 +54,28 @@ class FaucetMetrics(PromClient):
         self.of_packet_ins = self._dpid_counter(
             'of_packet_ins',
             'number of OF packet_ins received from DP')
+        self.of_packet_in_reparses = self._dpid_counter(
+            'of_packet_in_reparses',
+            'number of times OF packet_ins were parsed beyond the header')
+        self.of_packet_in_reparses_avoided = self._dpid_counter(
+            'of_packet_in_reparses_avoided',
+            'number of OF packet_in parses avoided by reusing an earlier parse')
         self.of_flowmsgs_sent = self._dpid_counter(
             'of_flowmsgs_sent',
             'number of OF flow messages (and packet outs) sent to DP')
+        self.of_flowmsgs_queued = self._dpid_gauge(
+            'of_flowmsgs_queued',
+            'number of batches of OF flow messages queued to send to DP')
+        self.of_flowmsgs_queue_overflows = self._dpid_counter(
+            'of_flowmsgs_queue_overflows',
+            'number of times queued OF flow messages were discarded, and the DP cold started')
+        self.of_flowmsgs_queue_latency = self._dpid_gauge(
+            'of_flowmsgs_queue_latency',
+            'seconds the last batch of OF flow messages was queued before sending')
+        self.of_flowmsgs_batch_latency = Histogram(
+            'of_flowmsgs_batch_latency',
+            'seconds to install a batch of OF flow messages on DP',
+            ['dp_id'])
         self.of_errors = self._dpid_counter(
             'of_errors',
             'number of OF errors received from DP')
@@ -69,6 +88,9 @@ class FaucetMetrics(PromClient):
         self.faucet_config_reload_requests = Counter(
             'faucet_config_reload_requests',
             'number of config reload requests', [])
+        self.faucet_config_load_time = Gauge(
+            'faucet_config_load_time',
+            'seconds to parse and apply the most recent config', [])
         self.faucet_config_reload_warm = self._dpid_counter(
             'faucet_config_reload_warm',
             'number of warm, differences only config reloads executed')
@@ -96,6 +118,12 @@ class FaucetMetrics(PromClient):
         self.bgp_neighbor_routes = Gauge(
             'bgp_neighbor_routes',
             'BGP neighbor route count', ['dp_id', 'vlan', 'neighbor', 'ipv'])
+        self.bgp_route_batch_size = self._dpid_gauge(
+            'bgp_route_batch_size',
+            'number of BGP route changes applied in the last batch')
+        self.bgp_route_queue_latency = self._dpid_gauge(
+            'bgp_route_queue_latency',
+            'seconds oldest BGP route change in the last batch was queued')
         self.learned_macs = Gauge(
             'learned_macs',
             ('max address stored as 64bit number to DP ID, port, VLAN, '
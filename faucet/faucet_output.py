@@ -0,0 +1,192 @@
+"""Queue OpenFlow messages to send to a datapath from its own thread, and track them."""
+
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2017 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import time
+
+from ryu.lib import hub
+
+try:
+    import valve_of
+except ImportError:
+    from faucet import valve_of
+
+
+FlowBatch = collections.namedtuple(
+    'FlowBatch', ['xids', 'start_time', 'ofmsgs', 'bundled'])
+
+
+class FaucetOutputQueue(object):
+    """Batches of OpenFlow messages for one datapath, sent by its own thread.
+
+    Queuing never waits, as all datapaths share one event loop. If the
+    queue is full the datapath is not keeping up, so queued batches are
+    discarded, and the caller must resync the datapath instead.
+    """
+
+    def __init__(self, send_batch, queue_size):
+        """Start the thread sending batches.
+
+        Args:
+            send_batch (callable): called with valve, ryu_dp, flow_msgs,
+                use_bundles and queued_time to send a batch.
+            queue_size (int): most batches queued (0 for no limit).
+        """
+        self._send_batch = send_batch
+        self._queue = hub.Queue(queue_size or None)
+        # Connection batches are queued for; batches for others are discarded.
+        self._ryu_dp = None
+        self._thread = hub.spawn(self._send_batches)
+
+    def put(self, valve, ryu_dp, flow_msgs, use_bundles):
+        """Queue a batch of OpenFlow messages, without waiting.
+
+        Args:
+            valve (Valve): Valve for the datapath.
+            ryu_dp (ryu.controller.controller.Datapath): datapath.
+            flow_msgs (list): OpenFlow messages to send, in order.
+            use_bundles (bool): True if the batch may be sent in a bundle.
+        Returns:
+            bool: False if the queue was full, so this and all queued
+                batches were discarded.
+        """
+        if ryu_dp is not self._ryu_dp:
+            self._discard()
+            self._ryu_dp = ryu_dp
+        if self._queue.full():
+            self._discard()
+            return False
+        self._queue.put_nowait((valve, ryu_dp, flow_msgs, use_bundles, time.time()))
+        return True
+
+    def qsize(self):
+        """Return number of batches waiting to be sent."""
+        return self._queue.qsize()
+
+    def _discard(self):
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def _send_batches(self):
+        while True:
+            batch = self._queue.get()
+            if batch[1] is self._ryu_dp:
+                self._send_batch(*batch)
+
+    def stop(self):
+        """Discard queued batches, and stop the thread."""
+        hub.kill(self._thread)
+
+
+class FaucetFlowBatches(object):
+    """Batches of OpenFlow messages sent to datapaths, not yet known to be installed.
+
+    A batch is complete when the reply to its last bundle commit or
+    barrier is received, and is tracked by the xids of its messages.
+    """
+
+    def __init__(self):
+        # Batches by DP ID and xid.
+        self._batches = {}
+
+    def prepare(self, ryu_dp, flow_msgs, bundle_id, barrier_interval):
+        """Bundle or add barriers to a batch, give it xids, and track it.
+
+        Args:
+            ryu_dp (ryu.controller.controller.Datapath): datapath.
+            flow_msgs (list): OpenFlow messages to send, in order.
+            bundle_id (int): bundle ID, or None to send without a bundle.
+            barrier_interval (int): most messages between barriers if not
+                bundled (0 for none, other than any already present).
+        Returns:
+            list: OpenFlow messages to send.
+        """
+        has_changes = [
+            flow_msg for flow_msg in flow_msgs
+            if valve_of.is_flowmod(flow_msg) or valve_of.is_groupmod(flow_msg)]
+        bundled = False
+        if bundle_id is not None and has_changes:
+            flow_msgs = valve_of.bundle_ofmsgs(flow_msgs, bundle_id)
+            bundled = True
+        elif barrier_interval:
+            flow_msgs = valve_of.barrier_ofmsgs(flow_msgs, barrier_interval)
+        for flow_msg in flow_msgs:
+            flow_msg.datapath = ryu_dp
+            if valve_of.is_bundleadd(flow_msg):
+                flow_msg.message.datapath = ryu_dp
+            if flow_msg.xid is None:
+                ryu_dp.set_xid(flow_msg)
+        if has_changes and (bundled or valve_of.is_barrier(flow_msgs[-1])):
+            # Completion is known from the last commit or barrier reply.
+            # Recorded before sending, as sending may wait for the DP.
+            xids = [
+                flow_msg.xid for flow_msg in flow_msgs
+                if not valve_of.is_packetout(flow_msg)]
+            batch = FlowBatch(xids, time.time(), flow_msgs, bundled)
+            for xid in xids:
+                self._batches[(ryu_dp.id, xid)] = batch
+        return flow_msgs
+
+    def _pop(self, dp_id, batch):
+        for xid in batch.xids:
+            self._batches.pop((dp_id, xid), None)
+
+    def complete(self, dp_id, xid):
+        """Return a batch completed by a reply, which is no longer tracked.
+
+        Args:
+            dp_id (int): datapath ID.
+            xid (int): xid of barrier or bundle commit reply.
+        Returns:
+            FlowBatch: batch completed, or None.
+        """
+        batch = self._batches.get((dp_id, xid), None)
+        if batch is None or xid != batch.xids[-1]:
+            return None
+        self._pop(dp_id, batch)
+        return batch
+
+    def failed_bundle(self, dp_id, xid):
+        """Return messages to send unbundled, from a bundle that failed.
+
+        The bundle is no longer tracked. Its messages are given new xids
+        when sent again, so replies to them are not attributed to it, and
+        end with a barrier so their completion is tracked.
+
+        Args:
+            dp_id (int): datapath ID.
+            xid (int): xid of message in error.
+        Returns:
+            list: OpenFlow messages, or None if xid is not from a bundle.
+        """
+        batch = self._batches.get((dp_id, xid), None)
+        if batch is None or not batch.bundled:
+            return None
+        self._pop(dp_id, batch)
+        flow_msgs = [
+            flow_msg.message for flow_msg in batch.ofmsgs
+            if valve_of.is_bundleadd(flow_msg)]
+        for flow_msg in flow_msgs:
+            flow_msg.xid = None
+        flow_msgs.append(valve_of.barrier())
+        return flow_msgs
+
+    def clear(self, dp_id):
+        """Stop tracking all batches sent to a datapath."""
+        for batch_dp_id, xid in list(self._batches.keys()):
+            if batch_dp_id == dp_id:
+                del self._batches[(batch_dp_id, xid)]
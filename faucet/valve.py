@@ -17,7 +17,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 import logging
 import time
 
@@ -36,6 +35,7 @@ try:
     import valve_of
     import valve_packet
     import valve_route
+    import valve_shadow
     import valve_util
 except ImportError:
     from faucet import tfm_pipeline
@@ -45,37 +45,89 @@ except ImportError:
     from faucet import valve_of
     from faucet import valve_packet
     from faucet import valve_route
+    from faucet import valve_shadow
     from faucet import valve_util
 
 
 class PacketMeta(object):
-    """Original, and parsed Ethernet packet metadata."""
+    """Original, and parsed Ethernet packet metadata.
 
-    def __init__(self, data, pkt, eth_pkt, port, vlan, eth_src, eth_dst):
+    A ryu packet is only built from the original packet data when pkt is
+    first needed (eg. to handle a control plane packet). Parses and protocol
+    lookups are memoized, so the packet is parsed again only if a deeper
+    parse is requested.
+    """
+
+    _ip_header_lens = {}
+
+    def __init__(self, data, pkt, eth_pkt, port, vlan, eth_src, eth_dst,
+                 eth_type=None):
         self.data = data
-        self.pkt = pkt
-        self.eth_pkt = eth_pkt
+        self._pkt = pkt
+        self._eth_pkt = eth_pkt
+        self._parsed_len = None
+        self._protocols = {}
         self.port = port
         self.vlan = vlan
         self.eth_src = eth_src
         self.eth_dst = eth_dst
+        self.eth_type = eth_type
+        self.reparses = 0
+        self.reparses_avoided = 0
+
+    @property
+    def pkt(self):
+        """Return ryu packet, parsing the Ethernet/VLAN header if needed."""
+        if self._pkt is None:
+            self.reparse(valve_packet.ETH_VLAN_HEADER_SIZE)
+        return self._pkt
+
+    @property
+    def eth_pkt(self):
+        """Return ryu Ethernet packet, parsing the header if needed."""
+        if self._eth_pkt is None:
+            self._eth_pkt = valve_packet.parse_pkt(self.pkt)
+        return self._eth_pkt
+
+    def get_protocol(self, protocol):
+        """Return (memoized) first protocol of a type in the parsed packet.
+
+        Args:
+            protocol (ryu.lib.packet.packet_base.PacketBase): protocol class.
+        Returns:
+            protocol instance or None, if not present in the parsed packet.
+        """
+        if protocol not in self._protocols:
+            self._protocols[protocol] = self.pkt.get_protocol(protocol)
+        return self._protocols[protocol]
 
     def reparse(self, max_len):
+        data_len = len(self.data)
+        if not max_len or max_len > data_len:
+            max_len = data_len
+        if self._parsed_len is not None and self._parsed_len >= max_len:
+            self.reparses_avoided += 1
+            return
+        self.reparses += 1
         pkt, vlan_vid = valve_packet.parse_packet_in_pkt(
             self.data, max_len)
         if pkt is None or vlan_vid is None:
             return
-        self.pkt = pkt
-        self.eth_pkt = valve_packet.parse_pkt(self.pkt)
+        self._pkt = pkt
+        self._eth_pkt = None
+        self._parsed_len = max_len
+        self._protocols = {}
 
     def reparse_all(self):
         self.reparse(0)
 
     def reparse_ip(self, eth_type, payload=0):
-        ip_header = valve_packet.build_pkt_header(
-            1, mac.BROADCAST_STR, mac.BROADCAST_STR, eth_type)
-        ip_header.serialize()
-        self.reparse(len(ip_header.data) + payload)
+        if eth_type not in self._ip_header_lens:
+            ip_header = valve_packet.build_pkt_header(
+                1, mac.BROADCAST_STR, mac.BROADCAST_STR, eth_type)
+            ip_header.serialize()
+            self._ip_header_lens[eth_type] = len(ip_header.data)
+        self.reparse(self._ip_header_lens[eth_type] + payload)
 
 
 class ValveLogger(object):
@@ -111,14 +163,20 @@ class Valve(object):
     DEC_TTL = True
     L3 = False
 
-    def __init__(self, dp, logname):
+    def __init__(self, dp, logname, edge_hosts=None):
         self.dp = dp
+        if edge_hosts is None:
+            edge_hosts = valve_host.EdgeHostIndex()
+        self.edge_hosts = edge_hosts
         self.logger = ValveLogger(
             logging.getLogger(logname + '.valve'), self.dp.dp_id)
         self.ofchannel_logger = None
         self._packet_in_count_sec = 0
         self._last_packet_in_sec = 0
         self._last_advertise_sec = 0
+        self._learned_macs_exported = {}
+        # Flows and groups sent to the datapath, maintained by the caller.
+        self.shadow_table = valve_shadow.ValveShadowTable(self.dp.use_shadow_table)
         # TODO: functional flow managers require too much state.
         # Should interface with a common composer class.
         self.route_manager_by_ipv = {}
@@ -132,7 +190,7 @@ class Valve(object):
                 fib_table, self.dp.tables['vip'], self.dp.tables['eth_src'],
                 self.dp.tables['eth_dst'], self.dp.tables['flood'],
                 self.dp.highest_priority, self.dp.routers,
-                self.dp.group_table_routing, self.dp.groups)
+                self.dp.group_table_routing, self.dp.groups, self.dp.ecmp_routing)
             self.route_manager_by_ipv[route_manager.IPV] = route_manager
         self.flood_manager = valve_flood.ValveFloodManager(
             self.dp.tables['flood'], self.dp.low_priority,
@@ -142,7 +200,7 @@ class Valve(object):
             self.logger, self.dp.tables['eth_src'], self.dp.tables['eth_dst'],
             self.dp.timeout, self.dp.learn_jitter, self.dp.learn_ban_timeout,
             self.dp.low_priority, self.dp.highest_priority,
-            self.dp.use_idle_timeout)
+            self.dp.use_idle_timeout, self.dp.dp_id, self.edge_hosts)
 
     def switch_features(self, dp_id, msg):
         """Send configuration flows necessary for the switch implementation.
@@ -299,8 +357,6 @@ class Valve(object):
         # add mirror destination ports.
         for port in vlan.mirror_destination_ports():
             all_port_nums.add(port.number)
-        # install eth_dst_table flood ofmsgs
-        ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
         # add acl rules
         ofmsgs.extend(self._add_vlan_acl(vlan.vid))
         # add controller IPs if configured.
@@ -344,6 +400,10 @@ class Valve(object):
         ofmsgs.extend(self.ports_add(
             self.dp.dp_id, all_port_nums, cold_start=True))
 
+        # install eth_dst_table flood ofmsgs, now ports are up.
+        for vlan in list(self.dp.vlans.values()):
+            ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
+
         return ofmsgs
 
     def port_status_handler(self, dp_id, port_no, reason, port_status):
@@ -384,6 +444,61 @@ class Valve(object):
         """
         if self._ignore_dpid(dp_id):
             return []
+        # Flows already on the datapath are not known until all are deleted.
+        self.shadow_table.reset()
+        return self._cold_start(discovered_up_port_nums)
+
+    def reconcile_stats_requests(self):
+        """Return requests for flows, groups and meters already on the datapath.
+
+        Returns:
+            list: OpenFlow multipart requests to send to datapath.
+        """
+        ofmsgs = [
+            valve_of.flow_stats_request(self.dp.cookie),
+            valve_of.group_desc_stats_request()]
+        if self.dp.meters or self.dp.packetin_pps:
+            ofmsgs.append(valve_of.meter_config_stats_request())
+        return ofmsgs
+
+    def datapath_reconcile(self, dp_id, discovered_up_port_nums,
+                           flow_stats, group_descs, meter_configs):
+        """Handle Ryu datapath connection event, without a cold start.
+
+        The pipeline is provisioned by sending only the difference from
+        flows, groups and meters read back from the datapath, and hosts
+        learned in those flows are restored to the host cache.
+
+        Args:
+            dp_id (int): datapath ID.
+            discovered_up_port_nums (list): datapath ports that are up as ints.
+            flow_stats (list): ryu.ofproto.ofproto_v1_3_parser.OFPFlowStats.
+            group_descs (list): ryu.ofproto.ofproto_v1_3_parser.OFPGroupDescStats.
+            meter_configs (list): ryu.ofproto.ofproto_v1_3_parser.OFPMeterConfigStats.
+        Returns:
+            list: OpenFlow messages to send to datapath.
+        """
+        if self._ignore_dpid(dp_id):
+            return []
+        self.logger.info(
+            'Reconciling DP from %u flows, %u groups' % (
+                len(flow_stats), len(group_descs)))
+        self.shadow_table.load_stats(flow_stats, group_descs, meter_configs)
+        for vlan in list(self.dp.vlans.values()):
+            self.host_manager.clear_hosts_on_vlan(vlan)
+        ofmsgs = self._cold_start(discovered_up_port_nums)
+        ofmsgs.extend(self.host_manager.restore_hosts(
+            self.dp, flow_stats, time.time()))
+        return self.shadow_table.diff_ofmsgs(ofmsgs)
+
+    def _cold_start(self, discovered_up_port_nums):
+        """Provision pipeline from scratch.
+
+        Args:
+            discovered_up_port_nums (list): datapath ports that are up as ints.
+        Returns:
+            list: OpenFlow messages to send to datapath.
+        """
         self.logger.info('Cold start configuring DP')
         ofmsgs = []
         ofmsgs.extend(self._add_default_flows())
@@ -400,6 +515,7 @@ class Valve(object):
         """
         if not self._ignore_dpid(dp_id):
             self.dp.running = False
+            self.shadow_table.reset()
             self.logger.warning('datapath down')
 
     def _port_add_acl(self, port_num, cold_start=False):
@@ -553,7 +669,7 @@ class Valve(object):
         # Only update flooding rules if not cold starting.
         if not cold_start:
             for vlan in vlans_with_ports_added:
-                ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
+                ofmsgs.extend(self.flood_manager.update_flood_rules(vlan))
 
         return ofmsgs
 
@@ -601,10 +717,10 @@ class Valve(object):
             port_vlans = port.tagged_vlans + untagged_vlans_with_port
             for vlan in port_vlans:
                 vlans_with_deleted_ports.add(vlan)
+                self.host_manager.clear_hosts_on_vlan_port(vlan, port)
 
         for vlan in vlans_with_deleted_ports:
-            ofmsgs.extend(self.flood_manager.build_flood_rules(
-                vlan, modify=True))
+            ofmsgs.extend(self.flood_manager.update_flood_rules(vlan))
 
         return ofmsgs
 
@@ -624,6 +740,10 @@ class Valve(object):
         if (pkt_meta.eth_dst == pkt_meta.vlan.faucet_mac or
                 not valve_packet.mac_addr_is_unicast(pkt_meta.eth_dst)):
             for route_manager in list(self.route_manager_by_ipv.values()):
+                # Parse only for the route manager that handles this EtherType.
+                if (pkt_meta.eth_type is not None and
+                        pkt_meta.eth_type not in route_manager.CONTROL_ETH_TYPES):
+                    continue
                 pkt_meta.reparse_ip(route_manager.ETH_TYPE)
                 ofmsgs = route_manager.control_plane_handler(pkt_meta)
                 if ofmsgs:
@@ -679,15 +799,19 @@ class Valve(object):
         # has already learned this host (if any).
         eth_src = pkt_meta.eth_src
         vlan_vid = pkt_meta.vlan.vid
-        for other_dpid, other_valve in list(valves.items()):
+        for other_dpid in self.edge_hosts.dp_ids(vlan_vid, eth_src):
             if other_dpid == dp_id:
                 continue
-            other_dp = other_valve.dp
-            other_dp_host_cache = other_dp.vlans[vlan_vid].host_cache
-            if eth_src in other_dp_host_cache:
-                host = other_dp_host_cache[eth_src]
-                if host.edge:
-                    return other_dp
+            if other_dpid in valves:
+                other_dp = valves[other_dpid].dp
+                if vlan_vid in other_dp.vlans:
+                    other_dp_host_cache = other_dp.vlans[vlan_vid].host_cache
+                    if eth_src in other_dp_host_cache:
+                        host = other_dp_host_cache[eth_src]
+                        if host.edge:
+                            return other_dp
+            # Index entry is stale (eg. VLAN state reset by a reload).
+            self.edge_hosts.expire(vlan_vid, eth_src, other_dpid)
         return None
 
     def _learn_host(self, valves, dp_id, pkt_meta):
@@ -710,6 +834,9 @@ class Valve(object):
                 return ofmsgs
 
             learn_port = self.dp.shortest_path_port(edge_dp.name)
+            # Edge DP may not be reachable over the stack.
+            if learn_port is None:
+                return ofmsgs
             self.logger.info(
                 'host learned via stack port to %s' % edge_dp.name)
 
@@ -718,23 +845,30 @@ class Valve(object):
 
         return ofmsgs
 
-    def parse_rcv_packet(self, in_port, vlan_vid, data, pkt):
+    def parse_rcv_packet(self, in_port, vlan_vid, data, pkt=None):
         """Parse a received packet into a PacketMeta instance.
 
         Args:
             in_port (int): port packet was received on.
             vlan_vid (int): VLAN VID of port packet was received on.
             data (bytes): Raw packet data.
-            pkt (ryu.lib.packet.packet): parsed packet received.
+            pkt (ryu.lib.packet.packet): parsed packet received, if any
+                (otherwise parsed from data only when needed).
         Returns:
             PacketMeta instance.
         """
-        eth_pkt = valve_packet.parse_pkt(pkt)
-        eth_src = eth_pkt.src
-        eth_dst = eth_pkt.dst
+        if pkt is None:
+            eth_pkt = None
+            eth_dst, eth_src, _, eth_type = valve_packet.parse_eth_header(data)
+        else:
+            eth_pkt = valve_packet.parse_pkt(pkt)
+            eth_src = eth_pkt.src
+            eth_dst = eth_pkt.dst
+            eth_type = None
         vlan = self.dp.vlans[vlan_vid]
         port = self.dp.ports[in_port]
-        return PacketMeta(data, pkt, eth_pkt, port, vlan, eth_src, eth_dst)
+        return PacketMeta(
+            data, pkt, eth_pkt, port, vlan, eth_src, eth_dst, eth_type)
 
     def _port_learn_ban_rules(self, pkt_meta):
         """Limit learning to a maximum configured on this port.
@@ -754,6 +888,7 @@ class Valve(object):
             ofmsgs.append(self.host_manager.temp_ban_host_learning_on_port(
                 port))
             port.learn_ban_count += 1
+            self.host_manager.note_host_change(pkt_meta.vlan, port)
             self.logger.info(
                 'max hosts %u reached on port %u, '
                 'temporarily banning learning on this port, '
@@ -781,6 +916,7 @@ class Valve(object):
             ofmsgs.append(self.host_manager.temp_ban_host_learning_on_vlan(
                 vlan))
             vlan.learn_ban_count += 1
+            self.host_manager.note_host_change(vlan, pkt_meta.port)
             self.logger.info(
                 'max hosts %u reached on vlan %u, '
                 'temporarily banning learning on this vlan, '
@@ -800,47 +936,95 @@ class Valve(object):
             metrics.faucet_config_table_names.labels(
                 dp_id=hex(self.dp.dp_id), name=table.name).set(table_id)
 
+    def _hosts_on_vlan_port(self, vlan, port_num):
+        """Return MACs learned on a port on a VLAN, as sorted integers."""
+        eth_srcs = sorted(vlan.cached_hosts_on_port(port_num))
+        return [int(eth_src.replace(':', ''), 16) for eth_src in eth_srcs]
+
+    def _update_learned_macs(self, metrics, vid, port_num, mac_ints):
+        """Export MACs learned on a port, zeroing any no longer present.
+
+        Args:
+            metrics (FaucetMetrics): container of Prometheus metrics.
+            vid (int): VLAN VID.
+            port_num (int): port number.
+            mac_ints (list): MACs learned on the port, as integers.
+        """
+        dp_id = hex(self.dp.dp_id)
+        key = (vid, port_num)
+        for i, mac_int in enumerate(mac_ints):
+            metrics.learned_macs.labels(
+                dp_id=dp_id, vlan=vid, port=port_num, n=i).set(mac_int)
+        for i in range(len(mac_ints), self._learned_macs_exported.get(key, 0)):
+            metrics.learned_macs.labels(
+                dp_id=dp_id, vlan=vid, port=port_num, n=i).set(0)
+        if mac_ints:
+            self._learned_macs_exported[key] = len(mac_ints)
+        elif key in self._learned_macs_exported:
+            del self._learned_macs_exported[key]
+
+    def _update_vlan_metrics(self, metrics, vlan):
+        dp_id = hex(self.dp.dp_id)
+        hosts_count = self.host_manager.hosts_learned_on_vlan_count(
+            vlan)
+        metrics.vlan_hosts_learned.labels(
+            dp_id=dp_id, vlan=vlan.vid).set(hosts_count)
+        metrics.vlan_learn_bans.labels(
+            dp_id=dp_id, vlan=vlan.vid).set(vlan.learn_ban_count)
+        for ipv in vlan.ipvs():
+            neigh_cache_size = len(vlan.neigh_cache_by_ipv(ipv))
+            metrics.vlan_neighbors.labels(
+                dp_id=dp_id, vlan=vlan.vid, ipv=ipv).set(neigh_cache_size)
+
     def update_metrics(self, metrics):
-        """Update Gauge/metrics.
+        """Update all Gauge/metrics, re-exporting all learned hosts.
+
+        This walks every host on every VLAN, so should be called
+        periodically or on demand rather than per packet in.
 
         metrics (FaucetMetrics or None): container of Prometheus metrics.
         """
-        # Clear the exported MAC learning.
         dp_id = hex(self.dp.dp_id)
-        for _, label_dict, _ in metrics.learned_macs.collect()[0].samples:
-            if label_dict['dp_id'] == dp_id:
-                metrics.learned_macs.labels(
-                    dp_id=label_dict['dp_id'], vlan=label_dict['vlan'],
-                    port=label_dict['port'], n=label_dict['n']).set(0)
-
+        self.host_manager.pop_changed_vlan_ports()
+        stale_vlan_ports = set(self._learned_macs_exported.keys())
         for vlan in list(self.dp.vlans.values()):
-            hosts_count = self.host_manager.hosts_learned_on_vlan_count(
-                vlan)
-            metrics.vlan_hosts_learned.labels(
-                dp_id=dp_id, vlan=vlan.vid).set(hosts_count)
-            metrics.vlan_learn_bans.labels(
-                dp_id=dp_id, vlan=vlan.vid).set(vlan.learn_ban_count)
-            for ipv in vlan.ipvs():
-                neigh_cache_size = len(vlan.neigh_cache_by_ipv(ipv))
-                metrics.vlan_neighbors.labels(
-                    dp_id=dp_id, vlan=vlan.vid, ipv=ipv).set(neigh_cache_size)
-            # Repopulate MAC learning.
+            self._update_vlan_metrics(metrics, vlan)
             hosts_on_port = {}
             for eth_src, host_cache_entry in sorted(list(vlan.host_cache.items())):
-                port_num = str(host_cache_entry.port.number)
+                port_num = host_cache_entry.port.number
                 mac_int = int(eth_src.replace(':', ''), 16)
                 if port_num not in hosts_on_port:
                     hosts_on_port[port_num] = []
                 hosts_on_port[port_num].append(mac_int)
-            for port_num, hosts in list(hosts_on_port.items()):
-                for i, mac_int in enumerate(hosts):
-                    metrics.learned_macs.labels(
-                        dp_id=dp_id, vlan=vlan.vid,
-                        port=port_num, n=i).set(mac_int)
-            for port in list(self.dp.ports.values()):
-                metrics.port_learn_bans.labels(
-                    dp_id=dp_id, port=port.number).set(port.learn_ban_count)
+            for port_num, mac_ints in list(hosts_on_port.items()):
+                stale_vlan_ports.discard((vlan.vid, port_num))
+                self._update_learned_macs(metrics, vlan.vid, port_num, mac_ints)
+        for vid, port_num in stale_vlan_ports:
+            self._update_learned_macs(metrics, vid, port_num, [])
+        for port in list(self.dp.ports.values()):
+            metrics.port_learn_bans.labels(
+                dp_id=dp_id, port=port.number).set(port.learn_ban_count)
+
+    def update_changed_metrics(self, metrics):
+        """Update Gauge/metrics only for VLANs/ports with changed hosts.
 
+        metrics (FaucetMetrics or None): container of Prometheus metrics.
+        """
+        dp_id = hex(self.dp.dp_id)
+        changed_vlans = set()
+        for vid, port_num in self.host_manager.pop_changed_vlan_ports():
+            mac_ints = []
+            if vid in self.dp.vlans:
+                vlan = self.dp.vlans[vid]
+                changed_vlans.add(vlan)
+                mac_ints = self._hosts_on_vlan_port(vlan, port_num)
+            self._update_learned_macs(metrics, vid, port_num, mac_ints)
+            if port_num in self.dp.ports:
+                metrics.port_learn_bans.labels(
+                    dp_id=dp_id, port=port_num).set(
+                        self.dp.ports[port_num].learn_ban_count)
+        for vlan in changed_vlans:
+            self._update_vlan_metrics(metrics, vlan)
 
     def rcv_packet(self, dp_id, valves, pkt_meta):
         """Handle a packet from the dataplane (eg to re/learn a host).
@@ -898,6 +1082,10 @@ class Valve(object):
         # by control plane.
         if self.L3 and not control_plane_handled:
             for route_manager in list(self.route_manager_by_ipv.values()):
+                # Parse only for the route manager that handles this EtherType.
+                if (pkt_meta.eth_type is not None and
+                        pkt_meta.eth_type != route_manager.ETH_TYPE):
+                    continue
                 ofmsgs.extend(route_manager.add_host_fib_route_from_pkt(pkt_meta))
 
         return ofmsgs
@@ -921,9 +1109,7 @@ class Valve(object):
             for vlan in [port.native_vlan] + port.tagged_vlans:
                 if vlan is None:
                     continue
-                for eth_src, host_cache_entry in list(vlan.host_cache.items()):
-                    if host_cache_entry.port.number == port_no:
-                        old_eth_srcs.append(eth_src)
+                old_eth_srcs.extend(vlan.cached_hosts_on_port(port_no))
         return old_eth_srcs
 
     def _get_acl_config_changes(self, new_dp):
@@ -968,10 +1154,9 @@ class Valve(object):
             else:
                 old_vlan = self.dp.vlans[vid]
                 if old_vlan != new_vlan:
-                    old_vlan_new_ports = copy.deepcopy(old_vlan)
-                    old_vlan_new_ports.tagged = new_vlan.tagged
-                    old_vlan_new_ports.untagged = new_vlan.untagged
-                    if old_vlan_new_ports != new_vlan:
+                    ports_keys = ('tagged', 'untagged')
+                    if (old_vlan.conf_fingerprint(exclude=ports_keys) !=
+                            new_vlan.conf_fingerprint(exclude=ports_keys)):
                         changed_vlans.add(vid)
                         self.logger.info('VLAN %s config changed' % vid)
                 else:
@@ -1012,10 +1197,10 @@ class Valve(object):
                 old_port = self.dp.ports[port_no]
                 # An existing port has configs changed
                 if new_port != old_port:
-                    old_port_ignore_acl = copy.deepcopy(old_port)
-                    old_port_ignore_acl.acl_in = new_port.acl_in
+                    acl_keys = ('acl_in',)
                     # Did config other than ACL change
-                    if new_port != old_port_ignore_acl:
+                    if (new_port.conf_fingerprint(exclude=acl_keys) !=
+                            old_port.conf_fingerprint(exclude=acl_keys)):
                         changed_ports.add(port_no)
                         self.logger.info('port %s reconfigured' % port_no)
                     else:
@@ -1094,7 +1279,7 @@ class Valve(object):
 
         if all_ports_changed:
             self.dp = new_dp
-            ofmsgs.extend(self.datapath_connect(self.dp.dp_id, changed_ports))
+            ofmsgs.extend(self._cold_start(changed_ports))
         else:
             cold_start = False
             if deleted_ports:
@@ -1107,6 +1292,10 @@ class Valve(object):
                     ofmsgs.extend(self._del_vlan(vlan))
             if changed_ports:
                 ofmsgs.extend(self.ports_delete(self.dp.dp_id, changed_ports))
+            # Ports not changed keep their state.
+            for port_num, port in list(new_dp.ports.items()):
+                if port_num in self.dp.ports:
+                    port.phys_up = self.dp.ports[port_num].phys_up
             self.dp = new_dp
             if changed_vlans:
                 self.logger.info('VLANs changed/added: %s' % changed_vlans)
@@ -1114,6 +1303,7 @@ class Valve(object):
                     vlan = self.dp.vlans[vid]
                     ofmsgs.extend(self._del_vlan(vlan))
                     ofmsgs.extend(self._add_vlan(vlan, set()))
+                    ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
             if changed_ports:
                 self.logger.info('ports changed/added: %s' % changed_ports)
                 ofmsgs.extend(self.ports_add(self.dp.dp_id, changed_ports))
@@ -1143,9 +1333,14 @@ class Valve(object):
         """
         if self.dp.running:
             self.logger.info('reload configuration')
-            return self._apply_config_changes(
+            cold_start, ofmsgs = self._apply_config_changes(
                 new_dp,
                 self._get_config_changes(new_dp))
+            if self.shadow_table.enabled != self.dp.use_shadow_table:
+                self.shadow_table = valve_shadow.ValveShadowTable(
+                    self.dp.use_shadow_table)
+            # Send only what differs from flows already on the datapath.
+            return (cold_start, self.shadow_table.diff_ofmsgs(ofmsgs))
         self.logger.info('skipping configuration because datapath not up')
         return (False, [])
 
@@ -1203,6 +1398,24 @@ class Valve(object):
             'acls': acls_dict,
             }
 
+    def flow_removed(self, table_id, priority, match, reason):
+        """Handle a flow removed by the datapath.
+
+        Args:
+            table_id (int): table of removed flow.
+            priority (int): priority of removed flow.
+            match (ryu.ofproto.ofproto_v1_3_parser.OFPMatch): match of removed flow.
+            reason (int): OFPRR reason flow was removed.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        if reason in (ofp.OFPRR_IDLE_TIMEOUT, ofp.OFPRR_HARD_TIMEOUT):
+            self.shadow_table.flow_removed(table_id, priority, match)
+        # Only host flows of tables using idle timeouts are refreshed.
+        if reason == ofp.OFPRR_IDLE_TIMEOUT and self.dp.use_idle_timeout:
+            return self.flow_timeout(table_id, match)
+        return []
+
     def flow_timeout(self, table_id, match):
         ofmsgs = []
         if table_id in (self.dp.tables['eth_src'].table_id, self.dp.tables['eth_dst'].table_id):
@@ -48,6 +48,8 @@ class ValveFloodManager(object):
         self.stack = dp_stack
         self.use_group_table = use_group_table
         self.groups = groups
+        # Flood group buckets and flows last sent for each VLAN, by VID.
+        self._vlan_flood_state = {}
         self.stack_ports = [
             port for port in list(dp_ports.values()) if port.stack is not None]
         self.towards_root_stack_ports = []
@@ -60,39 +62,57 @@ class ValveFloodManager(object):
                 self.away_from_root_stack_ports.append(port)
             elif peer_root_distance < my_root_distance:
                 self.towards_root_stack_ports.append(port)
-
-    def _build_flood_port_outputs(self, ports, in_port):
-        flood_acts = []
-        for port in ports:
-            if port == in_port:
-                if port.hairpin:
-                    flood_acts.append(valve_of.output_in_port())
-            else:
-                flood_acts.append(valve_of.output_port(port.number))
-        return flood_acts
-
-    def _build_flood_local_rule_actions(self, vlan, exclude_unicast, in_port):
-        flood_acts = []
+        self._away_from_root_vector = self._build_flood_vector(
+            self.away_from_root_stack_ports)
+        self._towards_root_vector = self._build_flood_vector(
+            self.towards_root_stack_ports)
+
+    @staticmethod
+    def _build_flood_vector(ports):
+        """Return output actions flooding to ports, and each port's action index."""
+        flood_acts = [valve_of.output_port(port.number) for port in ports]
+        port_index = dict([(port.number, i) for i, port in enumerate(ports)])
+        return (flood_acts, port_index)
+
+    @staticmethod
+    def _flood_vector_except(flood_vector, in_port):
+        """Return actions from a flood vector, not flooding back to in_port unless hairpin."""
+        flood_acts, port_index = flood_vector
+        i = port_index.get(in_port.number, None)
+        if i is None:
+            return flood_acts
+        if in_port.hairpin:
+            return flood_acts[:i] + [valve_of.output_in_port()] + flood_acts[i + 1:]
+        return flood_acts[:i] + flood_acts[i + 1:]
+
+    def _build_vlan_flood_vectors(self, vlan, exclude_unicast):
+        """Return the ports a VLAN floods to, and flood vectors for its tagged and untagged ports."""
         tagged_ports = vlan.tagged_flood_ports(exclude_unicast)
-        flood_acts.extend(self._build_flood_port_outputs(
-            tagged_ports, in_port))
         untagged_ports = vlan.untagged_flood_ports(exclude_unicast)
-        if untagged_ports:
+        return (
+            tagged_ports + untagged_ports,
+            self._build_flood_vector(tagged_ports),
+            self._build_flood_vector(untagged_ports))
+
+    def _build_flood_local_rule_actions(self, vlan_flood_vectors, in_port):
+        _, tagged_vector, untagged_vector = vlan_flood_vectors
+        flood_acts = []
+        flood_acts.extend(self._flood_vector_except(tagged_vector, in_port))
+        if untagged_vector[0]:
             flood_acts.append(valve_of.pop_vlan())
-            flood_acts.extend(self._build_flood_port_outputs(
-                untagged_ports, in_port))
+            flood_acts.extend(self._flood_vector_except(untagged_vector, in_port))
         return flood_acts
 
     def _port_is_dp_local(self, port):
-        if (port in self.away_from_root_stack_ports or
-                port in self.towards_root_stack_ports):
+        if (port.number in self._away_from_root_vector[1] or
+                port.number in self._towards_root_vector[1]):
             return False
         return True
 
     def _dp_is_root(self):
         return self.stack is not None and 'priority' in self.stack
 
-    def _build_flood_rule_actions(self, vlan, exclude_unicast, in_port):
+    def _build_flood_rule_actions(self, vlan_flood_vectors, in_port):
         """Calculate flooding destinations based on this DP's position.
 
         If a standalone switch, then flood to local VLAN ports.
@@ -140,16 +160,23 @@ class ValveFloodManager(object):
         4: 5(s)
         5: 1 2 3 4
         """
-        local_flood_actions = self._build_flood_local_rule_actions(
-            vlan, exclude_unicast, in_port)
         # If we're a standalone switch, then flood local VLAN
         if self.stack is None:
-            return local_flood_actions
-
-        away_flood_actions = self._build_flood_port_outputs(
-            self.away_from_root_stack_ports, in_port)
-        toward_flood_actions = self._build_flood_port_outputs(
-            self.towards_root_stack_ports, in_port)
+            return self._build_flood_local_rule_actions(
+                vlan_flood_vectors, in_port)
+
+        toward_flood_actions = self._flood_vector_except(
+            self._towards_root_vector, in_port)
+        # If input port local or from a further away switch on a non root
+        # switch, flood only towards the root.
+        if (not self._dp_is_root() and
+                in_port.number not in self._towards_root_vector[1]):
+            return toward_flood_actions
+
+        away_flood_actions = self._flood_vector_except(
+            self._away_from_root_vector, in_port)
+        local_flood_actions = self._build_flood_local_rule_actions(
+            vlan_flood_vectors, in_port)
         flood_all_except_self = away_flood_actions + local_flood_actions
 
         # If we're the root of a distributed switch..
@@ -163,56 +190,54 @@ class ValveFloodManager(object):
         # We are not the root of the distributed switch
         # If input port was connected to a switch closer to the root,
         # then flood outwards (local VLAN and stacks further than us)
-        if in_port in self.towards_root_stack_ports:
-            return flood_all_except_self
-        # If input port local or from a further away switch, flood
-        # towards the root.
-        return toward_flood_actions
+        return flood_all_except_self
 
     def _build_flood_rule_for_port(self, vlan, eth_dst, eth_dst_mask,
-                                   exclude_unicast, command, flood_priority,
+                                   vlan_flood_vectors, flood_priority,
                                    port, preflood_acts):
         ofmsgs = []
         match = self.flood_table.match(
             vlan=vlan, in_port=port.number,
             eth_dst=eth_dst, eth_dst_mask=eth_dst_mask)
         flood_acts = self._build_flood_rule_actions(
-            vlan, exclude_unicast, port)
+            vlan_flood_vectors, port)
         ofmsgs.append(self.flood_table.flowmod(
             match=match,
-            command=command,
             inst=[valve_of.apply_actions(preflood_acts + flood_acts)],
             priority=flood_priority))
         return ofmsgs
 
     def _build_unmirrored_flood_rules(self, vlan, eth_dst, eth_dst_mask,
-                                      exclude_unicast, command, flood_priority):
+                                      vlan_flood_vectors, flood_priority):
         ofmsgs = []
         vlan_all_ports = []
-        vlan_all_ports.extend(vlan.flood_ports(vlan.get_ports(), exclude_unicast))
+        vlan_all_ports.extend(vlan_flood_vectors[0])
         vlan_all_ports.extend(self.away_from_root_stack_ports)
         vlan_all_ports.extend(self.towards_root_stack_ports)
         for port in vlan_all_ports:
             ofmsgs.extend(self._build_flood_rule_for_port(
                 vlan, eth_dst, eth_dst_mask,
-                exclude_unicast, command, flood_priority,
+                vlan_flood_vectors, flood_priority,
                 port, []))
         return ofmsgs
 
     def _build_mirrored_flood_rules(self, vlan, eth_dst, eth_dst_mask,
-                                    exclude_unicast, command, flood_priority):
+                                    vlan_flood_vectors, flood_priority):
         ofmsgs = []
         mirrored_ports = vlan.mirrored_ports()
         for port in mirrored_ports:
             mirror_acts = [valve_of.output_port(port.mirror)]
             ofmsgs.extend(self._build_flood_rule_for_port(
                 vlan, eth_dst, eth_dst_mask,
-                exclude_unicast, command, flood_priority,
+                vlan_flood_vectors, flood_priority,
                 port, mirror_acts))
         return ofmsgs
 
     def _build_group_buckets(self, vlan, unicast_flood):
         buckets = []
+        for port in self.away_from_root_stack_ports:
+            buckets.append(valve_of.bucket(
+                actions=[valve_of.output_port(port.number)]))
         for port in vlan.tagged_flood_ports(unicast_flood):
             buckets.append(valve_of.bucket(
                 actions=[valve_of.output_port(port.number)]))
@@ -223,7 +248,45 @@ class ValveFloodManager(object):
                     valve_of.output_port(port.number)]))
         return buckets
 
-    def _build_group_flood_rules(self, vlan, modify, command):
+    def _build_group_flood_actions(self, vlan_flood_vectors, in_port,
+                                   flood_group, towards_root_group):
+        """Calculate flooding actions for a port, using groups.
+
+        Follows the same strategy as _build_flood_rule_actions(). The
+        flood group has the local VLAN ports and ports away from the root,
+        and the switch drops output to in_port, so only reflection back
+        to in_port needs actions of its own.
+
+        Args:
+            vlan_flood_vectors (tuple): VLAN's flood ports and vectors.
+            in_port (Port): input port, or None for a local non hairpin port.
+            flood_group (ValveGroupEntry): group flooding locally and away from root.
+            towards_root_group (ValveGroupEntry): group flooding towards root.
+        Returns:
+            list: flood actions.
+        """
+        flood_all_except_self = [valve_of.group_act(flood_group.group_id)]
+        if self.stack is not None:
+            if self._dp_is_root():
+                if in_port is not None and not self._port_is_dp_local(in_port):
+                    return flood_all_except_self + [valve_of.output_in_port()]
+            elif in_port is not None and in_port.number in self._towards_root_vector[1]:
+                return flood_all_except_self
+            else:
+                return [valve_of.group_act(towards_root_group.group_id)]
+        if in_port is not None and in_port.hairpin:
+            _, tagged_vector, untagged_vector = vlan_flood_vectors
+            if in_port.number in tagged_vector[1]:
+                return flood_all_except_self + [valve_of.output_in_port()]
+            if in_port.number in untagged_vector[1]:
+                return flood_all_except_self + [
+                    valve_of.pop_vlan(), valve_of.output_in_port()]
+        return flood_all_except_self
+
+    def _build_group_flood_rules(self, vlan):
+        """Return groups and flows flooding via groups, so that only ports with
+        different flooding (such as stack, hairpin and mirrored ports) need their own flows.
+        """
         flood_priority = self.flood_priority
         broadcast_group = self.groups.get_entry(
             vlan.vid,
@@ -231,55 +294,145 @@ class ValveFloodManager(object):
         unicast_group = self.groups.get_entry(
             vlan.vid + valve_of.VLAN_GROUP_OFFSET,
             self._build_group_buckets(vlan, vlan.unicast_flood))
+        flood_groups = [broadcast_group, unicast_group]
+        towards_root_group = None
+        if self.stack is not None and not self._dp_is_root():
+            towards_root_group = self.groups.get_entry(
+                vlan.vid + valve_of.STACK_GROUP_OFFSET,
+                [valve_of.bucket(actions=[valve_of.output_port(port.number)])
+                 for port in self.towards_root_stack_ports])
+            flood_groups.append(towards_root_group)
         ofmsgs = []
-        if modify:
-            ofmsgs.append(broadcast_group.modify())
-            ofmsgs.append(unicast_group.modify())
-        else:
-            ofmsgs.extend(broadcast_group.add())
-            ofmsgs.extend(unicast_group.add())
+        exception_ports = []
+        exception_ports.extend(vlan.get_ports())
+        exception_ports.extend(self.away_from_root_stack_ports)
+        exception_ports.extend(self.towards_root_stack_ports)
+        vlan_flood_vectors = {}
         for unicast_eth_dst, eth_dst, eth_dst_mask in self.FLOOD_DSTS:
             if unicast_eth_dst and not vlan.unicast_flood:
                 continue
+            if unicast_eth_dst not in vlan_flood_vectors:
+                vlan_flood_vectors[unicast_eth_dst] = self._build_vlan_flood_vectors(
+                    vlan, unicast_eth_dst)
             group = broadcast_group
             if not eth_dst:
                 group = unicast_group
+            flood_acts = self._build_group_flood_actions(
+                vlan_flood_vectors[unicast_eth_dst], None, group, towards_root_group)
             match = self.flood_table.match(
                 vlan=vlan, eth_dst=eth_dst, eth_dst_mask=eth_dst_mask)
             ofmsgs.append(self.flood_table.flowmod(
                 match=match,
-                command=command,
-                inst=[valve_of.apply_actions([valve_of.group_act(group.group_id)])],
+                inst=[valve_of.apply_actions(flood_acts)],
                 priority=flood_priority))
-            flood_priority += 1
-        return ofmsgs
-
-    def _build_multiout_flood_rules(self, vlan, command):
+            for port in exception_ports:
+                port_flood_acts = self._build_group_flood_actions(
+                    vlan_flood_vectors[unicast_eth_dst], port, group, towards_root_group)
+                if port.mirror:
+                    port_flood_acts = [
+                        valve_of.output_port(port.mirror)] + port_flood_acts
+                elif str(port_flood_acts) == str(flood_acts):
+                    continue
+                match = self.flood_table.match(
+                    vlan=vlan, in_port=port.number,
+                    eth_dst=eth_dst, eth_dst_mask=eth_dst_mask)
+                ofmsgs.append(self.flood_table.flowmod(
+                    match=match,
+                    inst=[valve_of.apply_actions(port_flood_acts)],
+                    priority=flood_priority + 1))
+            flood_priority += 2
+        return (flood_groups, ofmsgs)
+
+    def _build_multiout_flood_rules(self, vlan):
         flood_priority = self.flood_priority
         ofmsgs = []
+        # Flood outputs are the same for every input port but for that
+        # port, so build them once for each kind of flood destination.
+        vlan_flood_vectors = {}
         for unicast_eth_dst, eth_dst, eth_dst_mask in self.FLOOD_DSTS:
             if unicast_eth_dst and not vlan.unicast_flood:
                 continue
+            if unicast_eth_dst not in vlan_flood_vectors:
+                vlan_flood_vectors[unicast_eth_dst] = self._build_vlan_flood_vectors(
+                    vlan, unicast_eth_dst)
             ofmsgs.extend(self._build_unmirrored_flood_rules(
                 vlan, eth_dst, eth_dst_mask,
-                unicast_eth_dst, command, flood_priority))
+                vlan_flood_vectors[unicast_eth_dst], flood_priority))
             flood_priority += 1
             ofmsgs.extend(self._build_mirrored_flood_rules(
                 vlan, eth_dst, eth_dst_mask,
-                unicast_eth_dst, command, flood_priority))
+                vlan_flood_vectors[unicast_eth_dst], flood_priority))
             flood_priority += 1
         return ofmsgs
 
-    def build_flood_rules(self, vlan, modify=False):
-        """Add flows to flood packets to unknown destinations on a VLAN."""
+    def _build_flood_rules(self, vlan):
+        """Return groups and flows to flood packets to unknown destinations on a VLAN."""
         # TODO: group table support is still fairly uncommon, so
         # group tables are currently optional.
-        command = ofp.OFPFC_ADD
-        if modify:
-            command = ofp.OFPFC_MODIFY_STRICT
         if self.use_group_table:
-            hairpin_ports = [port for port in vlan.get_ports() if port.hairpin]
-            # TODO: group tables for stacking and hairpin flooding modes.
-            if self.stack is None and not hairpin_ports:
-                return self._build_group_flood_rules(vlan, modify, command)
-        return self._build_multiout_flood_rules(vlan, command)
+            return self._build_group_flood_rules(vlan)
+        return ([], self._build_multiout_flood_rules(vlan))
+
+    @staticmethod
+    def _flood_state(groups, flowmods):
+        """Return group buckets and flow instructions, by group ID and flow."""
+        group_state = {}
+        for group in groups:
+            group_state[group.group_id] = valve_of.serialized(group.buckets)
+        flow_state = {}
+        for flowmod in flowmods:
+            flow_key = (flowmod.priority, tuple(flowmod.match.items()))
+            flow_state[flow_key] = (valve_of.serialized(flowmod.instructions), flowmod)
+        return (group_state, flow_state)
+
+    def build_flood_rules(self, vlan):
+        """Add flows to flood packets to unknown destinations on a VLAN."""
+        groups, flowmods = self._build_flood_rules(vlan)
+        self._vlan_flood_state[vlan.vid] = self._flood_state(groups, flowmods)
+        ofmsgs = []
+        for group in groups:
+            ofmsgs.extend(group.add())
+        ofmsgs.extend(flowmods)
+        return ofmsgs
+
+    def update_flood_rules(self, vlan):
+        """Update flooding on a VLAN after its ports have changed state.
+
+        Only groups and flows that differ from those last sent are changed,
+        so a single port going up or down costs a group modify (or a few
+        flow modifies if not using groups) rather than rebuilding all of
+        the VLAN's flooding.
+
+        Args:
+            vlan (VLAN): VLAN to update flooding for.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        if vlan.vid not in self._vlan_flood_state:
+            return self.build_flood_rules(vlan)
+        old_group_state, old_flow_state = self._vlan_flood_state[vlan.vid]
+        groups, flowmods = self._build_flood_rules(vlan)
+        group_state, flow_state = self._flood_state(groups, flowmods)
+        self._vlan_flood_state[vlan.vid] = (group_state, flow_state)
+        ofmsgs = []
+        for group in groups:
+            if group.group_id not in old_group_state:
+                ofmsgs.extend(group.add())
+            elif group_state[group.group_id] != old_group_state[group.group_id]:
+                ofmsgs.append(group.modify())
+        for flow_key, (inst_buf, flowmod) in list(flow_state.items()):
+            if flow_key not in old_flow_state:
+                ofmsgs.append(flowmod)
+            elif inst_buf != old_flow_state[flow_key][0]:
+                ofmsgs.append(self.flood_table.flowmod(
+                    match=flowmod.match,
+                    command=ofp.OFPFC_MODIFY_STRICT,
+                    inst=flowmod.instructions,
+                    priority=flowmod.priority))
+        for flow_key, (_, flowmod) in list(old_flow_state.items()):
+            if flow_key not in flow_state:
+                ofmsgs.extend(self.flood_table.flowdel(
+                    match=flowmod.match,
+                    priority=flowmod.priority,
+                    strict=True))
+        return ofmsgs
@@ -20,6 +20,8 @@
 import time
 import random
 
+from ryu.ofproto import ofproto_v1_3 as ofp
+
 try:
     import valve_of
 except ImportError:
@@ -37,11 +39,47 @@ class HostCacheEntry(object):
         self.expired = expired
 
 
+class EdgeHostIndex(object):
+    """Index of which DPs have learned a host on an edge (non stack) port.
+
+    Shared by all Valves, so that a DP learning a host via a stack port can
+    find the edge DP without searching every DP's host cache.
+    """
+
+    def __init__(self):
+        self._dp_ids_by_host = {}
+
+    def learn(self, vid, eth_src, dp_id):
+        """Record that a DP learned a host on an edge port."""
+        host = (vid, eth_src)
+        if host not in self._dp_ids_by_host:
+            self._dp_ids_by_host[host] = set()
+        self._dp_ids_by_host[host].add(dp_id)
+
+    def expire(self, vid, eth_src, dp_id):
+        """Record that a DP no longer has a host learned on an edge port."""
+        host = (vid, eth_src)
+        dp_ids = self._dp_ids_by_host.get(host, None)
+        if dp_ids is not None:
+            dp_ids.discard(dp_id)
+            if not dp_ids:
+                del self._dp_ids_by_host[host]
+
+    def expire_dp(self, dp_id):
+        """Remove all hosts learned by a DP (eg. when the DP is deleted)."""
+        for vid, eth_src in list(self._dp_ids_by_host.keys()):
+            self.expire(vid, eth_src, dp_id)
+
+    def dp_ids(self, vid, eth_src):
+        """Return DP IDs that have learned a host on an edge port."""
+        return list(self._dp_ids_by_host.get((vid, eth_src), set()))
+
+
 class ValveHostManager(object):
 
     def __init__(self, logger, eth_src_table, eth_dst_table,
                  learn_timeout, learn_jitter, learn_ban_timeout, low_priority, host_priority,
-                 use_idle_timeout):
+                 use_idle_timeout, dp_id, edge_hosts):
         self.logger = logger
         self.eth_src_table = eth_src_table
         self.eth_dst_table = eth_dst_table
@@ -51,6 +89,32 @@ class ValveHostManager(object):
         self.low_priority = low_priority
         self.host_priority = host_priority
         self.use_idle_timeout = use_idle_timeout
+        self.dp_id = dp_id
+        self.edge_hosts = edge_hosts
+        self.changed_vlan_ports = set()
+
+    def note_host_change(self, vlan, port):
+        """Record that hosts learned on a VLAN/port have changed."""
+        self.changed_vlan_ports.add((vlan.vid, port.number))
+
+    def _expire_cache_host(self, vlan, eth_src):
+        host_cache_entry = vlan.expire_cache_host(eth_src)
+        if host_cache_entry is not None:
+            self.note_host_change(vlan, host_cache_entry.port)
+            if host_cache_entry.edge:
+                self.edge_hosts.expire(vlan.vid, eth_src, self.dp_id)
+
+    def clear_hosts_on_vlan_port(self, vlan, port):
+        """Remove all hosts learned on a port on a VLAN from the cache."""
+        for eth_src in list(vlan.cached_hosts_on_port(port.number)):
+            self._expire_cache_host(vlan, eth_src)
+        self.note_host_change(vlan, port)
+
+    def pop_changed_vlan_ports(self):
+        """Return (and clear) VLAN VID/port numbers with changed hosts."""
+        changed_vlan_ports = self.changed_vlan_ports
+        self.changed_vlan_ports = set()
+        return changed_vlan_ports
 
     def temp_ban_host_learning_on_port(self, port):
         return self.eth_src_table.flowdrop(
@@ -94,24 +158,99 @@ class ValveHostManager(object):
 
     def expire_hosts_from_vlan(self, vlan, now):
         expired_hosts = []
-        for eth_src, host_cache_entry in list(vlan.host_cache.items()):
-            if not host_cache_entry.permanent:
-                host_cache_entry_age = now - host_cache_entry.cache_time
-                if host_cache_entry_age > self.learn_timeout:
-                    if not self.use_idle_timeout or host_cache_entry.expired:
-                        expired_hosts.append(eth_src)
+        # Only hosts whose learn timeout has passed are visited.
+        for eth_src, host_cache_entry in vlan.cache_hosts_due(now):
+            if not self.use_idle_timeout or host_cache_entry.expired:
+                expired_hosts.append(eth_src)
         if expired_hosts:
             for eth_src in expired_hosts:
-                del vlan.host_cache[eth_src]
+                self._expire_cache_host(vlan, eth_src)
                 self.logger.info(
                     'expiring host %s from VLAN %u' % (eth_src, vlan.vid))
             self.logger.info(
                 '%u recently active hosts on VLAN %u' % (
                     self.hosts_learned_on_vlan_count(vlan), vlan.vid))
 
+    def _schedule_host_expiry(self, vlan, eth_src, host_cache_entry):
+        if not host_cache_entry.permanent:
+            vlan.schedule_cache_host_expiry(
+                eth_src, host_cache_entry,
+                host_cache_entry.cache_time + self.learn_timeout)
+
     def hosts_learned_on_vlan_count(self, vlan):
         return len(vlan.host_cache)
 
+    def _cache_host(self, vlan, port, eth_src, cache_time):
+        host_cache_entry = HostCacheEntry(
+            eth_src,
+            port,
+            port.stack is None,
+            port.permanent_learn,
+            cache_time)
+        vlan.add_cache_host(eth_src, host_cache_entry)
+        self._schedule_host_expiry(vlan, eth_src, host_cache_entry)
+        self.note_host_change(vlan, port)
+        if host_cache_entry.edge:
+            self.edge_hosts.learn(vlan.vid, eth_src, self.dp_id)
+        else:
+            self.edge_hosts.expire(vlan.vid, eth_src, self.dp_id)
+
+    def clear_hosts_on_vlan(self, vlan):
+        """Remove all hosts learned on a VLAN from the cache."""
+        for eth_src in list(vlan.host_cache.keys()):
+            self._expire_cache_host(vlan, eth_src)
+
+    def restore_hosts(self, dp, flow_stats, now):
+        """Rebuild host cache from learned host flows read from the datapath.
+
+        Args:
+            dp (DP): datapath configuration.
+            flow_stats (list): ryu.ofproto.ofproto_v1_3_parser.OFPFlowStats.
+            now (float): current time.
+        Returns:
+            list: OpenFlow adds for the flows of restored hosts, relearned
+                if some of their flows have already timed out.
+        """
+        host_flow_stats = {}
+        learned_hosts = []
+        for flow_stat in flow_stats:
+            match = dict(flow_stat.match.items())
+            vlan_vid = match.get('vlan_vid', None)
+            if not isinstance(vlan_vid, int):
+                continue
+            vid = vlan_vid & ~ofp.OFPVID_PRESENT
+            if flow_stat.table_id == self.eth_src_table.table_id and 'eth_src' in match:
+                host = (vid, match['eth_src'])
+                if flow_stat.priority == self.host_priority - 1 and 'in_port' in match:
+                    learned_hosts.append((host, match['in_port'], flow_stat))
+            elif flow_stat.table_id == self.eth_dst_table.table_id and 'eth_dst' in match:
+                host = (vid, match['eth_dst'])
+            else:
+                continue
+            if host not in host_flow_stats:
+                host_flow_stats[host] = []
+            host_flow_stats[host].append(flow_stat)
+        ofmsgs = []
+        for host, in_port, flow_stat in learned_hosts:
+            vid, eth_src = host
+            vlan = dp.vlans.get(vid, None)
+            port = dp.ports.get(in_port, None)
+            if vlan is None or port is None:
+                continue
+            if port.stack is None and port not in vlan.get_ports():
+                continue
+            if not [host_flow_stat for host_flow_stat in host_flow_stats[host]
+                    if host_flow_stat.table_id == self.eth_dst_table.table_id and
+                    host_flow_stat.priority == self.host_priority]:
+                # The host's eth_dst flow has expired, so add all its flows again.
+                ofmsgs.extend(self.learn_host_on_vlan_port(
+                    port, vlan, eth_src, clear=False))
+                continue
+            self._cache_host(vlan, port, eth_src, now - flow_stat.duration_sec)
+            for host_flow_stat in host_flow_stats[host]:
+                ofmsgs.append(valve_of.flowmod_from_flow_stats(host_flow_stat))
+        return ofmsgs
+
     def learn_host_on_vlan_port(self, port, vlan, eth_src, clear=True):
         now = time.time()
         in_port = port.number
@@ -126,6 +265,8 @@ class ValveHostManager(object):
                 cache_age = now - host_cache_entry.cache_time
                 if cache_age < 2:
                     return ofmsgs
+            else:
+                self.note_host_change(vlan, host_cache_entry.port)
 
         # hosts learned on this port never relearned
         if port.permanent_learn:
@@ -185,13 +326,7 @@ class ValveHostManager(object):
                 inst=self.build_port_out_inst(vlan, port, port_number=valve_of.OFP_IN_PORT),
                 idle_timeout=learn_timeout))
 
-        host_cache_entry = HostCacheEntry(
-            eth_src,
-            port,
-            port.stack is None,
-            port.permanent_learn,
-            now)
-        vlan.host_cache[eth_src] = host_cache_entry
+        self._cache_host(vlan, port, eth_src, now)
 
         self.logger.info(
             'learned %s on %s on VLAN %u (%u hosts total)' % (
@@ -211,6 +346,8 @@ class ValveHostManager(object):
             host_cache_entry = vlan.host_cache[eth_src]
             if host_cache_entry.port.number == in_port:
                 host_cache_entry.expired = True
+                # Recheck this host, as it may already have been due.
+                self._schedule_host_expiry(vlan, eth_src, host_cache_entry)
                 self.logger.info('expired src_rule for host %s' % eth_src)
         return ofmsgs
 
@@ -17,6 +17,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import functools
 import ipaddress
 
 from ryu.lib import ofctl_v1_3 as ofctl
@@ -27,7 +29,10 @@ from ryu.ofproto import ofproto_v1_3 as ofp
 from ryu.ofproto import ofproto_v1_3_parser as parser
 
 VLAN_GROUP_OFFSET = 4096
-ROUTE_GROUP_OFFSET = VLAN_GROUP_OFFSET * 2
+STACK_GROUP_OFFSET = VLAN_GROUP_OFFSET * 3
+# Route groups are allocated above all flooding group IDs.
+ROUTE_GROUP_OFFSET = VLAN_GROUP_OFFSET * 4
+ROUTE_GROUP_MAX = ofp.OFPG_MAX
 OFP_VERSIONS = [ofp.OFP_VERSION]
 OFP_IN_PORT = ofp.OFPP_IN_PORT
 
@@ -44,6 +49,23 @@ def ignore_port(port_num):
     return port_num > 0xF0000000
 
 
+def serialized(ofp_objs):
+    """Return OpenFlow wire format of instructions, buckets or bands.
+
+    ryu sets length fields on these objects when sending them, so they
+    are compared by wire format rather than by value.
+
+    Args:
+        ofp_objs (list): ryu.ofproto.ofproto_v1_3_parser instructions, buckets or bands.
+    Returns:
+        bytes: wire format of ofp_objs.
+    """
+    buf = bytearray()
+    for ofp_obj in ofp_objs:
+        ofp_obj.serialize(buf, len(buf))
+    return bytes(buf)
+
+
 def is_flowmod(ofmsg):
     """Return True if flow message is a FlowMod.
 
@@ -109,6 +131,39 @@ def is_groupadd(ofmsg):
     return False
 
 
+def is_barrier(ofmsg):
+    """Return True if OF message is a barrier request.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a barrier request.
+    """
+    return isinstance(ofmsg, parser.OFPBarrierRequest)
+
+
+def is_packetout(ofmsg):
+    """Return True if OF message is a PacketOut.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a PacketOut.
+    """
+    return isinstance(ofmsg, parser.OFPPacketOut)
+
+
+def is_bundleadd(ofmsg):
+    """Return True if OF message adds a message to a bundle.
+
+    Args:
+        ofmsg: ryu.ofproto.ofproto_v1_3_parser message.
+    Returns:
+        bool: True if is a bundle add.
+    """
+    return isinstance(ofmsg, parser.ONFBundleAddMsg)
+
+
 def apply_meter(meter_id):
     """Return instruction to apply a meter."""
     return parser.OFPInstructionMeter(meter_id, ofp.OFPIT_METER)
@@ -286,6 +341,47 @@ def table_features(body):
         datapath=None, body=body)
 
 
+def flow_stats_request(cookie):
+    """Return OpenFlow request for all flows with a cookie.
+
+    Args:
+        cookie (int): cookie of flows to return.
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPFlowStatsRequest: flow stats request.
+    """
+    return parser.OFPFlowStatsRequest(
+        datapath=None,
+        table_id=ofp.OFPTT_ALL,
+        out_port=ofp.OFPP_ANY,
+        out_group=ofp.OFPG_ANY,
+        cookie=cookie,
+        cookie_mask=0xffffffffffffffff)
+
+
+def group_desc_stats_request():
+    """Return OpenFlow request for all group descriptions."""
+    return parser.OFPGroupDescStatsRequest(datapath=None)
+
+
+def meter_config_stats_request():
+    """Return OpenFlow request for all meter configurations."""
+    return parser.OFPMeterConfigStatsRequest(datapath=None)
+
+
+def flowmod_from_flow_stats(flow_stat):
+    """Return OpenFlow add that would create a flow read from a datapath.
+
+    Args:
+        flow_stat (ryu.ofproto.ofproto_v1_3_parser.OFPFlowStats): flow.
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPFlowMod: flow add.
+    """
+    return flowmod(
+        flow_stat.cookie, ofp.OFPFC_ADD, flow_stat.table_id,
+        flow_stat.priority, 0, 0, flow_stat.match, flow_stat.instructions,
+        flow_stat.hard_timeout, flow_stat.idle_timeout, flow_stat.flags)
+
+
 def match(match_fields):
     """Return OpenFlow matches from dict.
 
@@ -297,6 +393,46 @@ def match(match_fields):
     return parser.OFPMatch(**match_fields)
 
 
+def match_order(match_types):
+    """Return match types in the order OFPMatch would put them.
+
+    Args:
+        match_types (iterable): match field names.
+    Returns:
+        tuple: match field names, in OpenFlow order.
+    """
+    def _oxm_num(match_type):
+        num = ofp.oxm_get_field_info_by_name(match_type)[0]
+        if isinstance(num, tuple):
+            return num[0]
+        return num
+    return tuple(sorted(match_types, key=_oxm_num))
+
+
+@functools.lru_cache(maxsize=65536)
+def _match_field(match_type, value):
+    """Return a match field and value, normalized as OFPMatch would."""
+    return ofp.oxm_to_user(*ofp.oxm_from_user(
+        *ofp.oxm_normalize_user(match_type, value)))
+
+
+def match_from_template(ordered_match_types, match_fields):
+    """Return OpenFlow matches from dict, with fields in a known order.
+
+    Equivalent to match(), but avoids converting recurring values
+    (such as VLANs, ports and recently used addresses) more than once.
+
+    Args:
+        ordered_match_types (tuple): match_fields keys, from match_order().
+        match_fields (dict): match fields and values.
+    Returns:
+        ryu.ofproto.ofproto_v1_3_parser.OFPMatch: matches.
+    """
+    return parser.OFPMatch(_ordered_fields=[
+        _match_field(match_type, match_fields[match_type])
+        for match_type in ordered_match_types])
+
+
 def valve_match_vid(value):
     return to_match_vid(value, ofp.OFPVID_PRESENT)
 
@@ -575,44 +711,180 @@ def controller_pps_meterdel(datapath=None):
         meter_id=ofp.OFPM_CONTROLLER)
 
 
-def valve_flowreorder(input_ofmsgs):
-    """Reorder flows for better OFA performance."""
+def valve_flowcoalesce(input_ofmsgs):
+    """Remove messages in a batch made redundant by later messages.
+
+    A FlowMod add is removed if a later add replaces it, or a later delete
+    removes it exactly. A strict delete is removed if a later add replaces
+    the same flow anyway. Repeated deletes are sent only once.
+
+    Args:
+        input_ofmsgs (list): ryu.ofproto.ofproto_v1_3_parser messages.
+    Returns:
+        list: messages in original order, without redundant messages.
+    """
+    output_ofmsgs = []
+    # (table_id, match, priority) of flows replaced or deleted later,
+    # with priority None for non strict deletes which remove any priority.
+    covered_keys = set()
+    # (table_id, match, priority) of flows added later.
+    added_keys = set()
+    delete_keys = set()
+    for ofmsg in reversed(input_ofmsgs):
+        if is_flowmod(ofmsg):
+            match_key = (ofmsg.table_id, tuple(ofmsg.match.items()))
+            if ofmsg.command == ofp.OFPFC_ADD:
+                flow_key = match_key + (ofmsg.priority,)
+                if (flow_key in covered_keys or
+                        match_key + (None,) in covered_keys):
+                    continue
+                covered_keys.add(flow_key)
+                added_keys.add(flow_key)
+            elif is_flowdel(ofmsg):
+                priority = None
+                if ofmsg.command == ofp.OFPFC_DELETE_STRICT:
+                    priority = ofmsg.priority
+                    if match_key + (priority,) in added_keys:
+                        continue
+                delete_key = match_key + (
+                    priority, ofmsg.out_port, ofmsg.out_group,
+                    ofmsg.cookie, ofmsg.cookie_mask)
+                if delete_key in delete_keys:
+                    continue
+                delete_keys.add(delete_key)
+                # Deletes filtered by output or cookie might not remove the flow.
+                if (ofmsg.table_id != ofp.OFPTT_ALL and
+                        ofmsg.out_port == ofp.OFPP_ANY and
+                        ofmsg.out_group == ofp.OFPG_ANY and
+                        not ofmsg.cookie_mask):
+                    covered_keys.add(match_key + (priority,))
+        elif is_groupdel(ofmsg):
+            if ofmsg.group_id in delete_keys:
+                continue
+            delete_keys.add(ofmsg.group_id)
+        output_ofmsgs.append(ofmsg)
+    output_ofmsgs.reverse()
+    return output_ofmsgs
+
+
+def _flowadd_sort_key(ofmsg):
+    # Later tables first, so goto_table targets are populated before the
+    # flows that reach them, then higher priority first, which TCAM based
+    # switches can insert without moving existing entries.
+    return (-ofmsg.table_id, -ofmsg.priority)
+
+
+def valve_flowreorder(input_ofmsgs, sort_adds=False):
+    """Reorder flows for better OFA performance.
+
+    Args:
+        input_ofmsgs (list): ryu.ofproto.ofproto_v1_3_parser messages.
+        sort_adds (bool): send FlowMods in table and priority order.
+    Returns:
+        list: reordered messages, with barriers.
+    """
     # Move all deletes to be first, and add one barrier,
     # while preserving order. Platforms that do parallel delete
     # will perform better and platforms that don't will have
     # at most only one barrier to deal with.
-    # TODO: further optimizations may be possible - for example,
-    # reorder adds to be in priority order.
     delete_ofmsgs = []
-    groupadd_ofmsgs = []
+    groupadd_ofmsgs = collections.OrderedDict()
     nondelete_ofmsgs = []
-    for ofmsg in input_ofmsgs:
+    flowmod_ofmsgs = []
+    for ofmsg in valve_flowcoalesce(input_ofmsgs):
         if is_flowdel(ofmsg) or is_groupdel(ofmsg):
             delete_ofmsgs.append(ofmsg)
         elif is_groupadd(ofmsg):
             # The same group_id may be deleted/added multiple times
-            # To avoid group_mod_failed/group_exists error, if the
-            # same group_id is already in groupadd_ofmsgs I replace
-            # it instead of appending it (the last groupadd in
-            # input_ofmsgs is the only one sent to the switch)
-            # TODO: optimize the provisioning to avoid having the
-            # same group_id multiple times in input_ofmsgs
-            new_group_id = True
-            for i, groupadd_ofmsg in enumerate(groupadd_ofmsgs):
-                if groupadd_ofmsg.group_id == ofmsg.group_id:
-                    groupadd_ofmsgs[i] = ofmsg
-                    new_group_id = False
-                    break
-            if new_group_id:
-                groupadd_ofmsgs.append(ofmsg)
+            # To avoid group_mod_failed/group_exists error, only
+            # the last groupadd for a group_id in input_ofmsgs is
+            # sent to the switch, in place of the first.
+            groupadd_ofmsgs[ofmsg.group_id] = ofmsg
+        elif sort_adds and is_flowmod(ofmsg):
+            flowmod_ofmsgs.append(ofmsg)
         else:
             nondelete_ofmsgs.append(ofmsg)
+    if flowmod_ofmsgs:
+        flowmod_ofmsgs.sort(key=_flowadd_sort_key)
+        nondelete_ofmsgs.extend(flowmod_ofmsgs)
     output_ofmsgs = []
     if delete_ofmsgs:
         output_ofmsgs.extend(delete_ofmsgs)
         output_ofmsgs.append(barrier())
     if groupadd_ofmsgs:
-        output_ofmsgs.extend(groupadd_ofmsgs)
+        output_ofmsgs.extend(list(groupadd_ofmsgs.values()))
         output_ofmsgs.append(barrier())
     output_ofmsgs.extend(nondelete_ofmsgs)
     return output_ofmsgs
+
+
+def bundle_ofmsgs(input_ofmsgs, bundle_id):
+    """Wrap flow and group messages in an atomic, ordered bundle.
+
+    Uses the ONF bundle extension to OpenFlow 1.3 (as in OpenFlow 1.4).
+    Messages that cannot be bundled are sent before the bundle, except
+    packet outs, which are sent after it is committed. This includes
+    meter mods, which the extension does not allow in a bundle, so the
+    batch is not atomic if it has any: meters are added before the flows
+    that use them, and are not removed if the bundle fails.
+
+    Args:
+        input_ofmsgs (list): ryu.ofproto.ofproto_v1_3_parser messages.
+        bundle_id (int): bundle ID, unique to the datapath.
+    Returns:
+        list: messages with flow and group messages in a bundle.
+    """
+    flags = ofp.ONF_BF_ATOMIC | ofp.ONF_BF_ORDERED
+    before_ofmsgs = []
+    bundle_add_ofmsgs = []
+    after_ofmsgs = []
+    for ofmsg in input_ofmsgs:
+        if is_flowmod(ofmsg) or is_groupmod(ofmsg):
+            bundle_add_ofmsgs.append(parser.ONFBundleAddMsg(
+                None, bundle_id, flags, ofmsg, []))
+        elif is_barrier(ofmsg):
+            # Ordered bundles do not need (and cannot contain) barriers.
+            continue
+        elif is_packetout(ofmsg):
+            after_ofmsgs.append(ofmsg)
+        else:
+            before_ofmsgs.append(ofmsg)
+    if not bundle_add_ofmsgs:
+        return input_ofmsgs
+    output_ofmsgs = before_ofmsgs
+    output_ofmsgs.append(parser.ONFBundleCtrlMsg(
+        None, bundle_id, ofp.ONF_BCT_OPEN_REQUEST, flags, []))
+    output_ofmsgs.extend(bundle_add_ofmsgs)
+    output_ofmsgs.append(parser.ONFBundleCtrlMsg(
+        None, bundle_id, ofp.ONF_BCT_COMMIT_REQUEST, flags, []))
+    output_ofmsgs.extend(after_ofmsgs)
+    return output_ofmsgs
+
+
+def barrier_ofmsgs(input_ofmsgs, interval):
+    """Add barriers so there are at most interval messages between barriers.
+
+    A batch that changes flows or groups also ends with a barrier, so its
+    completion can be detected.
+
+    Args:
+        input_ofmsgs (list): ryu.ofproto.ofproto_v1_3_parser messages.
+        interval (int): maximum messages between barriers.
+    Returns:
+        list: messages with barriers.
+    """
+    output_ofmsgs = []
+    since_barrier = 0
+    for ofmsg in input_ofmsgs:
+        if is_barrier(ofmsg):
+            since_barrier = 0
+        elif since_barrier == interval:
+            output_ofmsgs.append(barrier())
+            since_barrier = 1
+        else:
+            since_barrier += 1
+        output_ofmsgs.append(ofmsg)
+    if [ofmsg for ofmsg in input_ofmsgs if is_flowmod(ofmsg) or is_groupmod(ofmsg)]:
+        if output_ofmsgs and not is_barrier(output_ofmsgs[-1]):
+            output_ofmsgs.append(barrier())
+    return output_ofmsgs
@@ -17,10 +17,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import ipaddress
+import struct
 
-from ryu.lib import mac
-from ryu.lib.packet import arp, ethernet, icmp, icmpv6, ipv4, ipv6, stream_parser, packet, vlan
+from ryu.lib import addrconv, mac
+from ryu.lib.packet import arp, ethernet, icmp, icmpv6, ipv4, ipv6, stream_parser, packet, packet_utils, vlan
 from ryu.ofproto import ether
 from ryu.ofproto import inet
 
@@ -35,6 +37,25 @@ IPV6_ALL_ROUTERS_MCAST = '33:33:00:00:00:02'
 IPV6_LINK_LOCAL = ipaddress.IPv6Network(btos('fe80::/10'))
 IPV6_ALL_NODES = ipaddress.IPv6Address(btos('ff02::1'))
 IPV6_MAX_HOP_LIM = 255
+ETH_HEADER_SIZE = 14
+ETH_VLAN_HEADER_SIZE = ETH_HEADER_SIZE + 4
+ETH_HEADER_STRUCT = struct.Struct('!12BH')
+ETH_ADDR_FORMAT = ':'.join(['%02x'] * 6)
+VLAN_HEADER_STRUCT = struct.Struct('!HH')
+VLAN_VID_MASK = 0x0fff
+ARP_TPA_OFFSET = 24
+ARP_THA_OFFSET = 18
+IPV6_HEADER_SIZE = 40
+IPV6_DST_OFFSET = 24
+IPV6_PSEUDO_HEADER_STRUCT = struct.Struct('!16s16sI3xB')
+ICMPV6_CSUM_OFFSET = 2
+ND_TARGET_OFFSET = 8
+ARP_TEMPLATE_IP = ipaddress.IPv4Address(btos('0.0.0.0'))
+ND_TEMPLATE_IP = ipaddress.IPv6Address(btos('::'))
+# Serialized packets by (builder, VID, MAC, VIP, ...), see _pkt_template(),
+# least recently used first.
+_PKT_TEMPLATES = collections.OrderedDict()
+_PKT_TEMPLATES_MAX = 1024
 
 
 def parse_pkt(pkt):
@@ -82,6 +103,38 @@ def parse_packet_in_pkt(data, max_len):
     return (pkt, vlan_vid)
 
 
+def parse_eth_header(data):
+    """Parse the Ethernet (and 802.1Q) header of a packet from the dataplane.
+
+    Unlike parse_packet_in_pkt(), no ryu packet is built; fields are
+    unpacked directly from the packet data. Only these headers are parsed
+    here: the EtherType selects which route manager, if any, needs the
+    packet's L3 header, which PacketMeta then parses (once) with ryu.
+
+    Args:
+        data (bytearray): packet data from dataplane.
+    Returns:
+        str: destination Ethernet MAC address (None if header too short).
+        str: source Ethernet MAC address.
+        int: VLAN VID (None if untagged).
+        int: EtherType of the VLAN payload (or of the Ethernet payload if untagged).
+    """
+    if len(data) < ETH_HEADER_SIZE:
+        return (None, None, None, None)
+    eth_header = ETH_HEADER_STRUCT.unpack_from(data)
+    eth_type = eth_header[-1]
+    vlan_vid = None
+    if eth_type == ether.ETH_TYPE_8021Q and len(data) >= ETH_VLAN_HEADER_SIZE:
+        vlan_tci, eth_type = VLAN_HEADER_STRUCT.unpack_from(
+            data, ETH_HEADER_SIZE)
+        vlan_vid = vlan_tci & VLAN_VID_MASK
+    return (
+        ETH_ADDR_FORMAT % eth_header[:6],
+        ETH_ADDR_FORMAT % eth_header[6:12],
+        vlan_vid,
+        eth_type)
+
+
 def mac_addr_is_unicast(mac_addr):
     """Returns True if mac_addr is a unicast Ethernet address.
 
@@ -119,7 +172,7 @@ def build_pkt_header(vid, eth_src, eth_dst, dl_type):
     return pkt_header
 
 
-def arp_request(vid, eth_src, src_ip, dst_ip):
+def _build_arp_request(vid, eth_src, src_ip, dst_ip):
     """Return an ARP request packet.
 
     Args:
@@ -139,7 +192,7 @@ def arp_request(vid, eth_src, src_ip, dst_ip):
     return pkt
 
 
-def arp_reply(vid, eth_src, eth_dst, src_ip, dst_ip):
+def _build_arp_reply(vid, eth_src, eth_dst, src_ip, dst_ip):
     """Return an ARP reply packet.
 
     Args:
@@ -160,6 +213,108 @@ def arp_reply(vid, eth_src, eth_dst, src_ip, dst_ip):
     return pkt
 
 
+def _eth_header_size(vid):
+    if vid is None:
+        return ETH_HEADER_SIZE
+    return ETH_VLAN_HEADER_SIZE
+
+
+def _pkt_template(key, builder, *args):
+    """Return serialized packet from builder, built only once per key.
+
+    Only the most recently used templates are kept, so templates for
+    VLANs and VIPs removed by config changes do not accumulate.
+    """
+    template = _PKT_TEMPLATES.get(key, None)
+    if template is None:
+        template = bytes(builder(*args).data)
+        _PKT_TEMPLATES[key] = template
+        if len(_PKT_TEMPLATES) > _PKT_TEMPLATES_MAX:
+            _PKT_TEMPLATES.popitem(last=False)
+    else:
+        _PKT_TEMPLATES.move_to_end(key)
+    return template
+
+
+def _pkt_from_data(data):
+    """Return a (serialized only) ryu packet with data."""
+    pkt = packet.Packet()
+    pkt.data = data
+    return pkt
+
+
+def _ip_packed(ipa, ip_class):
+    if isinstance(ipa, ip_class):
+        return ipa.packed
+    return ip_class(btos(str(ipa))).packed
+
+
+def _set_eth_dst(data, eth_dst):
+    data[:6] = addrconv.mac.text_to_bin(eth_dst)
+
+
+def _set_icmpv6_csum(data, vid, dst_ip):
+    """Set IPv6 destination, and recalculate ICMPv6 checksum."""
+    ipv6_offset = _eth_header_size(vid)
+    icmpv6_offset = ipv6_offset + IPV6_HEADER_SIZE
+    dst_offset = ipv6_offset + IPV6_DST_OFFSET
+    data[dst_offset:dst_offset + 16] = _ip_packed(dst_ip, ipaddress.IPv6Address)
+    payload_len = struct.unpack_from('!H', data, ipv6_offset + 4)[0]
+    csum_offset = icmpv6_offset + ICMPV6_CSUM_OFFSET
+    data[csum_offset:csum_offset + 2] = b'\x00\x00'
+    pseudo_header = IPV6_PSEUDO_HEADER_STRUCT.pack(
+        bytes(data[ipv6_offset + 8:ipv6_offset + 24]),
+        bytes(data[dst_offset:dst_offset + 16]),
+        payload_len, inet.IPPROTO_ICMPV6)
+    csum = packet_utils.checksum(
+        pseudo_header + bytes(data[icmpv6_offset:icmpv6_offset + payload_len]))
+    struct.pack_into('!H', data, csum_offset, csum)
+
+
+def arp_request(vid, eth_src, src_ip, dst_ip):
+    """Return an ARP request packet.
+
+    Args:
+        vid (int or None): VLAN VID to use (or None).
+        eth_src (str): Ethernet source address.
+        src_ip (ipaddress.IPv4Address): source IPv4 address.
+        dst_ip (ipaddress.IPv4Address): requested IPv4 address.
+    Returns:
+        ryu.lib.packet.packet: serialized ARP request packet.
+    """
+    data = bytearray(_pkt_template(
+        ('arp_request', vid, eth_src, str(src_ip)),
+        _build_arp_request, vid, eth_src, src_ip, ARP_TEMPLATE_IP))
+    tpa_offset = _eth_header_size(vid) + ARP_TPA_OFFSET
+    data[tpa_offset:tpa_offset + 4] = _ip_packed(dst_ip, ipaddress.IPv4Address)
+    return _pkt_from_data(data)
+
+
+def arp_reply(vid, eth_src, eth_dst, src_ip, dst_ip):
+    """Return an ARP reply packet.
+
+    Args:
+        vid (int or None): VLAN VID to use (or None).
+        eth_src (str): Ethernet source address.
+        eth_dst (str): destination Ethernet MAC address.
+        src_ip (ipaddress.IPv4Address): source IPv4 address.
+        dst_ip (ipaddress.IPv4Address): destination IPv4 address.
+    Returns:
+        ryu.lib.packet.packet: serialized ARP reply packet.
+    """
+    data = bytearray(_pkt_template(
+        ('arp_reply', vid, eth_src, str(src_ip)),
+        _build_arp_reply, vid, eth_src, mac.DONTCARE_STR, src_ip,
+        ARP_TEMPLATE_IP))
+    _set_eth_dst(data, eth_dst)
+    arp_offset = _eth_header_size(vid)
+    tha_offset = arp_offset + ARP_THA_OFFSET
+    data[tha_offset:tha_offset + 6] = data[:6]
+    tpa_offset = arp_offset + ARP_TPA_OFFSET
+    data[tpa_offset:tpa_offset + 4] = _ip_packed(dst_ip, ipaddress.IPv4Address)
+    return _pkt_from_data(data)
+
+
 def echo_reply(vid, eth_src, eth_dst, src_ip, dst_ip, data):
     """Return an ICMP echo reply packet.
 
@@ -221,7 +376,7 @@ def ipv6_solicited_node_from_ucast(ucast):
     return link_mcast
 
 
-def nd_request(vid, eth_src, src_ip, dst_ip):
+def _build_nd_request(vid, eth_src, src_ip, dst_ip):
     """Return IPv6 neighbor discovery request packet.
 
     Args:
@@ -248,7 +403,7 @@ def nd_request(vid, eth_src, src_ip, dst_ip):
     return pkt
 
 
-def nd_advert(vid, eth_src, eth_dst, src_ip, dst_ip):
+def _build_nd_advert(vid, eth_src, eth_dst, src_ip, dst_ip):
     """Return IPv6 neighbor avertisement packet.
 
     Args:
@@ -278,6 +433,49 @@ def nd_advert(vid, eth_src, eth_dst, src_ip, dst_ip):
     return pkt
 
 
+def nd_request(vid, eth_src, src_ip, dst_ip):
+    """Return IPv6 neighbor discovery request packet.
+
+    Args:
+        vid (int or None): VLAN VID to use (or None).
+        eth_src (str): source Ethernet MAC address.
+        src_ip (ipaddress.IPv6Address): source IPv6 address.
+        dst_ip (ipaddress.IPv6Address): requested IPv6 address.
+    Returns:
+        ryu.lib.packet.packet: Serialized IPv6 neighbor discovery packet.
+    """
+    data = bytearray(_pkt_template(
+        ('nd_request', vid, eth_src, str(src_ip)),
+        _build_nd_request, vid, eth_src, src_ip, ND_TEMPLATE_IP))
+    _set_eth_dst(data, ipv6_link_eth_mcast(dst_ip))
+    target_offset = (
+        _eth_header_size(vid) + IPV6_HEADER_SIZE + ND_TARGET_OFFSET)
+    data[target_offset:target_offset + 16] = dst_ip.packed
+    _set_icmpv6_csum(data, vid, ipv6_solicited_node_from_ucast(dst_ip))
+    return _pkt_from_data(data)
+
+
+def nd_advert(vid, eth_src, eth_dst, src_ip, dst_ip):
+    """Return IPv6 neighbor avertisement packet.
+
+    Args:
+        vid (int or None): VLAN VID to use (or None).
+        eth_src (str): source Ethernet MAC address.
+        eth_dst (str): destination Ethernet MAC address.
+        src_ip (ipaddress.IPv6Address): source IPv6 address.
+        dst_ip (ipaddress.IPv6Address): destination IPv6 address.
+    Returns:
+        ryu.lib.packet.packet: Serialized IPv6 neighbor discovery packet.
+    """
+    data = bytearray(_pkt_template(
+        ('nd_advert', vid, eth_src, str(src_ip)),
+        _build_nd_advert, vid, eth_src, mac.DONTCARE_STR, src_ip,
+        ND_TEMPLATE_IP))
+    _set_eth_dst(data, eth_dst)
+    _set_icmpv6_csum(data, vid, dst_ip)
+    return _pkt_from_data(data)
+
+
 def icmpv6_echo_reply(vid, eth_src, eth_dst, src_ip, dst_ip, hop_limit,
                       id_, seq, data):
     """Return IPv6 ICMP echo reply packet.
@@ -311,8 +509,8 @@ def icmpv6_echo_reply(vid, eth_src, eth_dst, src_ip, dst_ip, hop_limit,
     return pkt
 
 
-def router_advert(_vlan, vid, eth_src, eth_dst, src_ip, dst_ip,
-                  vips, pi_flags=0x6):
+def _build_router_advert(_vlan, vid, eth_src, eth_dst, src_ip, dst_ip,
+                         vips, pi_flags=0x6):
     """Return IPv6 ICMP echo reply packet.
 
     Args:
@@ -355,3 +553,28 @@ def router_advert(_vlan, vid, eth_src, eth_dst, src_ip, dst_ip,
     pkt.add_protocol(icmpv6_ra_pkt)
     pkt.serialize()
     return pkt
+
+
+def router_advert(_vlan, vid, eth_src, eth_dst, src_ip, dst_ip,
+                  vips, pi_flags=0x6):
+    """Return IPv6 ICMP Router Advert packet.
+
+    Args:
+        _vlan (VLAN): VLAN instance.
+        vid (int or None): VLAN VID to use (or None).
+        eth_src (str): source Ethernet MAC address.
+        eth_dst (str): dest Ethernet MAC address.
+        src_ip (ipaddress.IPv6Address): source IPv6 address.
+        vips (list): prefixes (ipaddress.IPv6Address) to advertise.
+        pi_flags (int): flags to set in prefix information field (default set A and L)
+    Returns:
+        ryu.lib.packet.packet: Serialized IPv6 ICMP RA packet.
+    """
+    data = bytearray(_pkt_template(
+        ('router_advert', vid, eth_src, str(src_ip),
+         tuple([str(vip) for vip in vips]), pi_flags),
+        _build_router_advert, _vlan, vid, eth_src, mac.DONTCARE_STR, src_ip,
+        ND_TEMPLATE_IP, vips, pi_flags))
+    _set_eth_dst(data, eth_dst)
+    _set_icmpv6_csum(data, vid, dst_ip)
+    return _pkt_from_data(data)
@@ -0,0 +1,124 @@
+"""Valve routing information base (RIB)."""
+
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2017 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class RouteTable(object):
+    """Routes for one IP version on a VLAN.
+
+    Routes are kept by destination, and by gateway, so that routes via a
+    gateway can be found without visiting every route. Routes are never
+    looked up by longest prefix match, which only the datapath's FIB
+    tables do.
+
+    Supports the same read/write operations as a dict of destination
+    (ipaddress.ip_network) to gateway (ipaddress.ip_address). A route may
+    have further gateways (for ECMP), added with add_ip_gw(); the dict
+    operations see only its primary, most recently added, gateway.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._ip_gws_by_route = {}
+        self._routes_by_ip_gw = {}
+
+    def _index_route(self, ip_dst, ip_gw):
+        if ip_gw not in self._routes_by_ip_gw:
+            self._routes_by_ip_gw[ip_gw] = set()
+        self._routes_by_ip_gw[ip_gw].add(ip_dst)
+
+    def _unindex_route(self, ip_dst, ip_gw):
+        ip_dsts = self._routes_by_ip_gw[ip_gw]
+        ip_dsts.discard(ip_dst)
+        if not ip_dsts:
+            del self._routes_by_ip_gw[ip_gw]
+
+    def __setitem__(self, ip_dst, ip_gw):
+        if ip_dst in self._routes:
+            for old_ip_gw in self._ip_gws_by_route[ip_dst]:
+                self._unindex_route(ip_dst, old_ip_gw)
+        self._routes[ip_dst] = ip_gw
+        self._ip_gws_by_route[ip_dst] = (ip_gw,)
+        self._index_route(ip_dst, ip_gw)
+
+    def __delitem__(self, ip_dst):
+        del self._routes[ip_dst]
+        for ip_gw in self._ip_gws_by_route.pop(ip_dst):
+            self._unindex_route(ip_dst, ip_gw)
+
+    def __getitem__(self, ip_dst):
+        return self._routes[ip_dst]
+
+    def __contains__(self, ip_dst):
+        return ip_dst in self._routes
+
+    def __iter__(self):
+        return iter(self._routes)
+
+    def __len__(self):
+        return len(self._routes)
+
+    def get(self, ip_dst, default=None):
+        return self._routes.get(ip_dst, default)
+
+    def items(self):
+        return self._routes.items()
+
+    def keys(self):
+        return self._routes.keys()
+
+    def values(self):
+        return self._routes.values()
+
+    def add_ip_gw(self, ip_dst, ip_gw):
+        """Add a gateway to a route, adding the route if not present.
+
+        Args:
+            ip_dst (ipaddress.ip_network): destination IP network.
+            ip_gw (ipaddress.ip_address): gateway, which becomes the primary.
+        """
+        if ip_dst not in self._routes:
+            self[ip_dst] = ip_gw
+            return
+        ip_gws = self._ip_gws_by_route[ip_dst]
+        if ip_gw not in ip_gws:
+            self._ip_gws_by_route[ip_dst] = ip_gws + (ip_gw,)
+            self._index_route(ip_dst, ip_gw)
+        self._routes[ip_dst] = ip_gw
+
+    def route_ip_gws(self, ip_dst):
+        """Return all gateways of a route.
+
+        Args:
+            ip_dst (ipaddress.ip_network): destination IP network.
+        Returns:
+            tuple: ipaddress.ip_address gateways, in the order added.
+        """
+        return self._ip_gws_by_route.get(ip_dst, ())
+
+    def ip_gws(self):
+        """Return set of gateways used by routes in this table."""
+        return set(self._routes_by_ip_gw.keys())
+
+    def routes_via(self, ip_gw):
+        """Return set of route destinations with a gateway.
+
+        Args:
+            ip_gw (ipaddress.ip_address): gateway.
+        Returns:
+            set: ipaddress.ip_network destinations.
+        """
+        return self._routes_by_ip_gw.get(ip_gw, set())
@@ -25,6 +25,7 @@ from ryu.lib import mac
 from ryu.lib.packet import arp, icmp, icmpv6, ipv4, ipv6
 from ryu.ofproto import ether
 from ryu.ofproto import inet
+from ryu.ofproto import ofproto_v1_3 as ofp
 
 try:
     import valve_of
@@ -51,6 +52,7 @@ class ValveRouteManager(object):
 
     IPV = None
     ETH_TYPE = None
+    CONTROL_ETH_TYPES = ()
     ICMP_TYPE = None
     MAX_LEN = 96
 
@@ -58,7 +60,7 @@ class ValveRouteManager(object):
                  max_hosts_per_resolve_cycle, max_host_fib_retry_count,
                  max_resolve_backoff_time, proactive_learn, dec_ttl,
                  fib_table, vip_table, eth_src_table, eth_dst_table, flood_table,
-                 route_priority, routers, use_group_table, groups):
+                 route_priority, routers, use_group_table, groups, use_ecmp=False):
         self.logger = logger
         self.arp_neighbor_timeout = arp_neighbor_timeout
         self.max_hosts_per_resolve_cycle = max_hosts_per_resolve_cycle
@@ -75,6 +77,9 @@ class ValveRouteManager(object):
         self.routers = routers
         self.use_group_table = use_group_table
         self.groups = groups
+        self.use_ecmp = use_group_table and use_ecmp
+        # Keys of groups used by each route, by VLAN VID and destination.
+        self._route_groups = {}
 
     @staticmethod
     def _vlan_vid(vlan, port):
@@ -95,9 +100,79 @@ class ValveRouteManager(object):
             return nexthop_cache[ip_gw]
         return None
 
-    def _group_id_from_ip_gw(self, vlan, resolved_ip_gw):
-        return self.groups.group_id_from_str(
-            ''.join((str(vlan), str(resolved_ip_gw))))
+    @staticmethod
+    def _nexthop_group_key(vlan, ip_gw):
+        return (vlan.vid, ip_gw)
+
+    def _route_group_keys(self, vlan, ip_gw, ip_dst):
+        """Return keys of the groups a route's flow uses, the one it outputs to last.
+
+        With ECMP, a route with more than one resolved gateway outputs to a
+        select group chaining to each gateway's nexthop group. Routes with
+        the same gateways share the select group.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            ip_gw (ipaddress.ip_address): gateway being resolved.
+            ip_dst (ipaddress.ip_network): destination IP network.
+        Returns:
+            tuple: group keys.
+        """
+        nexthop_group_key = self._nexthop_group_key(vlan, ip_gw)
+        if not self.use_ecmp:
+            return (nexthop_group_key,)
+        routes = self._vlan_routes(vlan)
+        ip_gws = [ip_gw]
+        for other_ip_gw in routes.route_ip_gws(ip_dst):
+            if (other_ip_gw != ip_gw and
+                    self._cached_nexthop_eth_dst(vlan, other_ip_gw) is not None and
+                    self.groups.find_group_id(
+                        self._nexthop_group_key(vlan, other_ip_gw)) is not None):
+                ip_gws.append(other_ip_gw)
+        if len(ip_gws) == 1:
+            return (nexthop_group_key,)
+        ip_gws = sorted(ip_gws)
+        group_keys = [self._nexthop_group_key(vlan, ecmp_ip_gw) for ecmp_ip_gw in ip_gws]
+        group_keys.append((vlan.vid, tuple(ip_gws)))
+        return tuple(group_keys)
+
+    def _ecmp_group(self, group_keys):
+        """Return messages adding a select group over nexthop groups, if not present."""
+        group_id = self.groups.group_id(group_keys[-1])
+        if group_id in self.groups.entries:
+            return []
+        buckets = [
+            valve_of.bucket(
+                weight=1, actions=[valve_of.group_act(self.groups.group_id(group_key))])
+            for group_key in group_keys[:-1]]
+        return self.groups.get_entry(group_id, buckets, ofp.OFPGT_SELECT).add()
+
+    def _route_group_id(self, vlan, ip_gw, ip_dst):
+        """Return a route's output group ID (None if none left), and messages updating its groups."""
+        ofmsgs = []
+        route_key = (vlan.vid, ip_dst)
+        group_keys = self._route_group_keys(vlan, ip_gw, ip_dst)
+        old_group_keys = self._route_groups.get(route_key, ())
+        if group_keys != old_group_keys:
+            group_ids = [self.groups.ref(group_key) for group_key in group_keys]
+            if None in group_ids:
+                for group_key, group_id in reversed(list(zip(group_keys, group_ids))):
+                    if group_id is not None:
+                        ofmsgs.extend(self.groups.unref(group_key))
+                return (None, ofmsgs)
+            self._route_groups[route_key] = group_keys
+            if len(group_keys) > 1:
+                ofmsgs.extend(self._ecmp_group(group_keys))
+            # Delete a select group before the nexthop groups it chains to.
+            for group_key in reversed(old_group_keys):
+                ofmsgs.extend(self.groups.unref(group_key))
+        return (self.groups.group_id(group_keys[-1]), ofmsgs)
+
+    def _unref_route_groups(self, vlan, ip_dst):
+        ofmsgs = []
+        for group_key in reversed(self._route_groups.pop((vlan.vid, ip_dst), ())):
+            ofmsgs.extend(self.groups.unref(group_key))
+        return ofmsgs
 
     def _neighbor_resolver_pkt(self, vlan, vid, faucet_vip, ip_gw):
         pass
@@ -186,8 +261,15 @@ class ValveRouteManager(object):
                 'Adding new route %s via %s (%s) on VLAN %u' % (
                     ip_dst, ip_gw, eth_dst, vlan.vid))
         if self.use_group_table:
+            group_id, group_ofmsgs = self._route_group_id(vlan, ip_gw, ip_dst)
+            ofmsgs.extend(group_ofmsgs)
+            if group_id is None:
+                self.logger.error(
+                    'No group IDs left for route %s via %s on VLAN %u' % (
+                        ip_dst, ip_gw, vlan.vid))
+                return ofmsgs
             inst = [valve_of.apply_actions([valve_of.group_act(
-                group_id=self._group_id_from_ip_gw(vlan, ip_gw))])]
+                group_id=group_id)])]
         else:
             inst = [valve_of.apply_actions(self._nexthop_actions(eth_dst, vlan)),
                     valve_of.goto_table(self.eth_dst_table)]
@@ -211,9 +293,12 @@ class ValveRouteManager(object):
         buckets = [valve_of.bucket(actions=actions)]
         return buckets
 
-    def _update_nexthop_group(self, is_updated, resolved_ip_gw,
-                              vlan, port, eth_src):
-        group_id = self._group_id_from_ip_gw(vlan, resolved_ip_gw)
+    def _update_nexthop_group(self, resolved_ip_gw, vlan, port, eth_src):
+        group_id = self.groups.group_id(
+            self._nexthop_group_key(vlan, resolved_ip_gw))
+        if group_id is None:
+            return []
+        is_updated = group_id in self.groups.entries
         buckets = self._nexthop_group_buckets(vlan, port, eth_src)
         nexthop_group = self.groups.get_entry(
             group_id, buckets)
@@ -240,17 +325,22 @@ class ValveRouteManager(object):
 
         if cached_eth_dst != eth_src:
             is_updated = cached_eth_dst is not None
-
-            if self.use_group_table:
+            routes = self._vlan_routes(vlan)
+            ip_dsts = list(routes.routes_via(resolved_ip_gw))
+            if not self.use_ecmp:
+                # Without ECMP, routes use only their primary gateway.
+                ip_dsts = [
+                    ip_dst for ip_dst in ip_dsts if routes[ip_dst] == resolved_ip_gw]
+
+            # Only nexthops that routes use get a group, which is
+            # deleted when the last route using it is.
+            if self.use_group_table and ip_dsts:
                 ofmsgs.extend(
                     self._update_nexthop_group(
-                        is_updated, resolved_ip_gw,
-                        vlan, port, eth_src))
-            routes = self._vlan_routes(vlan)
-            for ip_dst, ip_gw in list(routes.items()):
-                if ip_gw == resolved_ip_gw:
-                    ofmsgs.extend(self._add_resolved_route(
-                        vlan, ip_gw, ip_dst, eth_src, is_updated))
+                        resolved_ip_gw, vlan, port, eth_src))
+            for ip_dst in ip_dsts:
+                ofmsgs.extend(self._add_resolved_route(
+                    vlan, resolved_ip_gw, ip_dst, eth_src, is_updated))
 
         self._update_nexthop_cache(vlan, eth_src, resolved_ip_gw)
         return ofmsgs
@@ -265,7 +355,7 @@ class ValveRouteManager(object):
         """
         routes = self._vlan_routes(vlan)
         ip_gws = []
-        for ip_gw in set(routes.values()):
+        for ip_gw in routes.ip_gws():
             for faucet_vip in vlan.faucet_vips_by_ipv(self.IPV):
                 if ip_gw in faucet_vip.network:
                     ip_gws.append((ip_gw, faucet_vip))
@@ -327,13 +417,13 @@ class ValveRouteManager(object):
             True if a host FIB route (and not used as a gateway).
         """
         routes = self._vlan_routes(vlan)
-        in_fib = False
-        for ip_dst, ip_gw in list(routes.items()):
-            if ip_gw == host_ip:
-                in_fib = True
-                if ip_dst.prefixlen < ip_dst.max_prefixlen:
-                    return False
-        return in_fib
+        ip_dsts = routes.routes_via(host_ip)
+        if not ip_dsts:
+            return False
+        for ip_dst in ip_dsts:
+            if ip_dst.prefixlen < ip_dst.max_prefixlen:
+                return False
+        return True
 
     def advertise(self, vlan):
         return []
@@ -461,6 +551,13 @@ class ValveRouteManager(object):
 
         routes[ip_dst] = ip_gw
         cached_eth_dst = self._cached_nexthop_eth_dst(vlan, ip_gw)
+        if (cached_eth_dst is not None and self.use_group_table and
+                self.groups.find_group_id(
+                    self._nexthop_group_key(vlan, ip_gw)) is None):
+            # The nexthop has no group as no routes used it, and the
+            # port needed to build one isn't cached, so resolve it again.
+            self._update_nexthop_cache(vlan, None, ip_gw)
+            cached_eth_dst = None
         if cached_eth_dst is not None:
             ofmsgs.extend(self._add_resolved_route(
                 vlan=vlan,
@@ -494,11 +591,11 @@ class ValveRouteManager(object):
         host_route = ipaddress.ip_network(host_ip.exploded)
         return self.del_route(vlan, host_route)
 
-    def _ip_pkt(self, pkt):
+    def _ip_pkt(self, pkt_meta):
         """Return an IP packet from an Ethernet packet.
 
         Args:
-            pkt: ryu.lib.packet from host.
+            pkt_meta (PacketMeta): packet from host.
         Returns:
             IP ryu.lib.packet parsed from pkt.
         """
@@ -522,7 +619,7 @@ class ValveRouteManager(object):
         Returns:
             list: OpenFlow messages.
         """
-        ip_pkt = self._ip_pkt(pkt_meta.pkt)
+        ip_pkt = self._ip_pkt(pkt_meta)
         ofmsgs = []
         if ip_pkt:
             src_ip = ipaddress.ip_address(btos(ip_pkt.src))
@@ -564,7 +661,7 @@ class ValveRouteManager(object):
         if ip_dst in routes:
             del routes[ip_dst]
             ofmsgs.extend(self._del_route_flows(vlan, ip_dst))
-            # TODO: need to delete nexthop group if groups are in use.
+            ofmsgs.extend(self._unref_route_groups(vlan, ip_dst))
         return ofmsgs
 
     def control_plane_handler(self, pkt_meta):
@@ -576,6 +673,7 @@ class ValveIPv4RouteManager(ValveRouteManager):
 
     IPV = 4
     ETH_TYPE = ether.ETH_TYPE_IP
+    CONTROL_ETH_TYPES = (ether.ETH_TYPE_IP, ether.ETH_TYPE_ARP)
     ICMP_TYPE = inet.IPPROTO_ICMP
 
     def _vlan_nexthop_cache_limit(self, vlan):
@@ -585,8 +683,8 @@ class ValveIPv4RouteManager(ValveRouteManager):
         return valve_packet.arp_request(
             vid, vlan.faucet_mac, faucet_vip.ip, ip_gw)
 
-    def _ip_pkt(self, pkt):
-        return pkt.get_protocol(ipv4.ipv4)
+    def _ip_pkt(self, pkt_meta):
+        return pkt_meta.get_protocol(ipv4.ipv4)
 
     def _add_faucet_vip_nd(self, vlan, priority, faucet_vip, faucet_vip_host):
         ofmsgs = []
@@ -613,7 +711,7 @@ class ValveIPv4RouteManager(ValveRouteManager):
     def _control_plane_arp_handler(self, pkt_meta):
         ofmsgs = []
         pkt_meta.reparse_ip(ether.ETH_TYPE_ARP)
-        arp_pkt = pkt_meta.pkt.get_protocol(arp.arp)
+        arp_pkt = pkt_meta.get_protocol(arp.arp)
         if arp_pkt is None:
             return ofmsgs
         src_ip = ipaddress.IPv4Address(btos(arp_pkt.src_ip))
@@ -656,7 +754,7 @@ class ValveIPv4RouteManager(ValveRouteManager):
             if ipv4_pkt.proto != inet.IPPROTO_ICMP:
                 return ofmsgs
             pkt_meta.reparse_all()
-            icmp_pkt = pkt_meta.pkt.get_protocol(icmp.icmp)
+            icmp_pkt = pkt_meta.get_protocol(icmp.icmp)
             if icmp_pkt is None:
                 return ofmsgs
             if icmp_pkt.type == icmp.ICMP_ECHO_REQUEST:
@@ -670,7 +768,7 @@ class ValveIPv4RouteManager(ValveRouteManager):
         return ofmsgs
 
     def control_plane_handler(self, pkt_meta):
-        ipv4_pkt = pkt_meta.pkt.get_protocol(ipv4.ipv4)
+        ipv4_pkt = pkt_meta.get_protocol(ipv4.ipv4)
         if ipv4_pkt is None:
             return self._control_plane_arp_handler(pkt_meta)
         else:
@@ -690,6 +788,7 @@ class ValveIPv6RouteManager(ValveRouteManager):
 
     IPV = 6
     ETH_TYPE = ether.ETH_TYPE_IPV6
+    CONTROL_ETH_TYPES = (ether.ETH_TYPE_IPV6,)
     ICMP_TYPE = inet.IPPROTO_ICMPV6
     MAX_LEN = 128
 
@@ -700,8 +799,8 @@ class ValveIPv6RouteManager(ValveRouteManager):
         return valve_packet.nd_request(
             vid, vlan.faucet_mac, faucet_vip.ip, ip_gw)
 
-    def _ip_pkt(self, pkt):
-        return pkt.get_protocol(ipv6.ipv6)
+    def _ip_pkt(self, pkt_meta):
+        return pkt_meta.get_protocol(ipv6.ipv6)
 
     def _add_faucet_vip_nd(self, vlan, priority, faucet_vip, faucet_vip_host):
         faucet_vip_host_nd_mcast = valve_packet.ipv6_link_eth_mcast(
@@ -754,7 +853,7 @@ class ValveIPv6RouteManager(ValveRouteManager):
             if dst_ip == valve_packet.IPV6_ALL_NODES:
                 return ofmsgs
             pkt_meta.reparse_ip(self.ETH_TYPE, payload=32)
-            icmpv6_pkt = pkt_meta.pkt.get_protocol(icmpv6.icmpv6)
+            icmpv6_pkt = pkt_meta.get_protocol(icmpv6.icmpv6)
             if icmpv6_pkt is None:
                 return ofmsgs
             icmpv6_type = icmpv6_pkt.type_
@@ -815,8 +914,7 @@ class ValveIPv6RouteManager(ValveRouteManager):
         return ofmsgs
 
     def control_plane_handler(self, pkt_meta):
-        pkt = pkt_meta.pkt
-        ipv6_pkt = pkt.get_protocol(ipv6.ipv6)
+        ipv6_pkt = pkt_meta.get_protocol(ipv6.ipv6)
         if ipv6_pkt is not None:
             icmp_replies = self._control_plane_icmpv6_handler(
                 pkt_meta, ipv6_pkt)
@@ -0,0 +1,403 @@
+"""Controller side copy of flows and groups sent to a datapath."""
+
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2017 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+
+try:
+    import valve_of
+except ImportError:
+    from faucet import valve_of
+
+
+def _flow_outputs(flowmod):
+    """Return ports and groups a flow outputs to directly."""
+    ports = set()
+    groups = set()
+    for inst in flowmod.instructions:
+        if inst.type in (ofp.OFPIT_APPLY_ACTIONS, ofp.OFPIT_WRITE_ACTIONS):
+            for action in inst.actions:
+                if action.type == ofp.OFPAT_OUTPUT:
+                    ports.add(action.port)
+                elif action.type == ofp.OFPAT_GROUP:
+                    groups.add(action.group_id)
+    return ports, groups
+
+
+def _match_covers(del_match, flow_match):
+    """Return True if a non strict delete match could remove a flow.
+
+    Where a field is masked in either and values differ, the flow is
+    assumed removed, as re-adding a flow is safer than missing one.
+    """
+    for field, del_value in list(del_match.items()):
+        if field not in flow_match:
+            return False
+        flow_value = flow_match[field]
+        if flow_value != del_value:
+            if not (isinstance(del_value, tuple) or isinstance(flow_value, tuple)):
+                return False
+    return True
+
+
+class ValveShadowTable(object):
+    """Flows, groups and meters Valve has sent to a datapath.
+
+    Used to send only the difference between what a datapath already has
+    and a new set of messages, such as on cold start after a reload.
+    Messages are applied as in section 6.4 of the OpenFlow 1.3 specification.
+    """
+
+    def __init__(self, enabled=True):
+        # If not enabled, nothing is recorded and messages are not diffed.
+        self.enabled = enabled
+        self.flows_by_table = {}
+        # Flow keys by match field and value, by table, so non strict
+        # deletes find flows they cover without a scan (value None for
+        # flows matching the field with a mask).
+        self.flow_keys_by_match = {}
+        self.flow_keys_by_group = {}
+        self.groups = {}
+        self.meters = {}
+        # True once all flows have been deleted, so the datapath is known
+        # to have only the flows recorded here.
+        self.synced = False
+
+    def reset(self):
+        """Forget all state, when datapath state is no longer known."""
+        self.__init__(self.enabled)
+
+    def load_stats(self, flow_stats, group_descs, meter_configs):
+        """Replace state with flows, groups and meters read from the datapath.
+
+        Args:
+            flow_stats (list): ryu.ofproto.ofproto_v1_3_parser.OFPFlowStats.
+            group_descs (list): ryu.ofproto.ofproto_v1_3_parser.OFPGroupDescStats.
+            meter_configs (list): ryu.ofproto.ofproto_v1_3_parser.OFPMeterConfigStats.
+        """
+        self.reset()
+        if not self.enabled:
+            return
+        for group_desc in group_descs:
+            self._apply_groupmod(valve_of.groupadd(
+                type_=group_desc.type, group_id=group_desc.group_id,
+                buckets=group_desc.buckets))
+        for meter_config in meter_configs:
+            self._apply_metermod(parser.OFPMeterMod(
+                datapath=None, command=ofp.OFPMC_ADD, flags=meter_config.flags,
+                meter_id=meter_config.meter_id, bands=meter_config.bands))
+        for flow_stat in flow_stats:
+            self._apply_flowmod(valve_of.flowmod_from_flow_stats(flow_stat))
+        self.synced = True
+
+    def copy(self):
+        """Return a copy, that can have messages applied independently."""
+        shadow = ValveShadowTable()
+        shadow.flows_by_table = dict(
+            [(table_id, dict(flows)) for table_id, flows in list(
+                self.flows_by_table.items())])
+        shadow.flow_keys_by_match = dict(
+            [(table_id, dict(
+                [(field_value, set(flow_keys)) for field_value, flow_keys in list(
+                    flow_keys_by_match.items())]))
+             for table_id, flow_keys_by_match in list(
+                 self.flow_keys_by_match.items())])
+        shadow.flow_keys_by_group = dict(
+            [(group_id, set(flow_keys)) for group_id, flow_keys in list(
+                self.flow_keys_by_group.items())])
+        shadow.groups = dict(self.groups)
+        shadow.meters = dict(self.meters)
+        shadow.synced = self.synced
+        return shadow
+
+    @staticmethod
+    def flow_key(flowmod):
+        """Return key identifying a flow in a table.
+
+        Args:
+            flowmod (ryu.ofproto.ofproto_v1_3_parser.OFPFlowMod): flow.
+        Returns:
+            tuple: table_id, priority and match.
+        """
+        return (flowmod.table_id, flowmod.priority, tuple(flowmod.match.items()))
+
+    def flows(self):
+        """Return dict of all flow keys to flows."""
+        all_flows = {}
+        for flows in list(self.flows_by_table.values()):
+            all_flows.update(flows)
+        return all_flows
+
+    @staticmethod
+    def _match_index_keys(flow_key):
+        for field, value in flow_key[2]:
+            if isinstance(value, tuple):
+                value = None
+            yield (field, value)
+
+    def _add_flow(self, flow_key, flowmod):
+        self._del_flow(flow_key)
+        table_id = flow_key[0]
+        if table_id not in self.flows_by_table:
+            self.flows_by_table[table_id] = {}
+            self.flow_keys_by_match[table_id] = {}
+        self.flows_by_table[table_id][flow_key] = flowmod
+        flow_keys_by_match = self.flow_keys_by_match[table_id]
+        for index_key in self._match_index_keys(flow_key):
+            if index_key not in flow_keys_by_match:
+                flow_keys_by_match[index_key] = set()
+            flow_keys_by_match[index_key].add(flow_key)
+        for group_id in _flow_outputs(flowmod)[1]:
+            if group_id not in self.flow_keys_by_group:
+                self.flow_keys_by_group[group_id] = set()
+            self.flow_keys_by_group[group_id].add(flow_key)
+
+    def _del_flow(self, flow_key):
+        flows = self.flows_by_table.get(flow_key[0], {})
+        flowmod = flows.pop(flow_key, None)
+        if flowmod is not None:
+            flow_keys_by_match = self.flow_keys_by_match[flow_key[0]]
+            for index_key in self._match_index_keys(flow_key):
+                flow_keys = flow_keys_by_match[index_key]
+                flow_keys.discard(flow_key)
+                if not flow_keys:
+                    del flow_keys_by_match[index_key]
+            for group_id in _flow_outputs(flowmod)[1]:
+                self.flow_keys_by_group.get(group_id, set()).discard(flow_key)
+
+    @staticmethod
+    def _filter_matches(del_flowmod, flowmod):
+        if del_flowmod.cookie_mask:
+            if ((del_flowmod.cookie & del_flowmod.cookie_mask) !=
+                    (flowmod.cookie & del_flowmod.cookie_mask)):
+                return False
+        if (del_flowmod.out_port == ofp.OFPP_ANY and
+                del_flowmod.out_group == ofp.OFPG_ANY):
+            return True
+        ports, groups = _flow_outputs(flowmod)
+        if del_flowmod.out_port != ofp.OFPP_ANY and del_flowmod.out_port not in ports:
+            return False
+        if del_flowmod.out_group != ofp.OFPG_ANY and del_flowmod.out_group not in groups:
+            return False
+        return True
+
+    def _covered_flow_keys(self, table_id, del_match):
+        """Return keys of flows in a table that a non strict delete may cover."""
+        flow_keys_by_match = self.flow_keys_by_match.get(table_id, {})
+        candidates = None
+        for field, del_value in list(del_match.items()):
+            if isinstance(del_value, tuple):
+                continue
+            field_candidates = (
+                flow_keys_by_match.get((field, del_value), set()),
+                flow_keys_by_match.get((field, None), set()))
+            if candidates is None or (
+                    sum([len(flow_keys) for flow_keys in field_candidates]) <
+                    sum([len(flow_keys) for flow_keys in candidates])):
+                candidates = field_candidates
+        if candidates is None:
+            return list(self.flows_by_table.get(table_id, {}).keys())
+        return list(candidates[0]) + list(candidates[1])
+
+    def _matching_flows(self, flowmod, strict):
+        if flowmod.table_id == ofp.OFPTT_ALL:
+            tables = list(self.flows_by_table.items())
+        else:
+            tables = [(flowmod.table_id, self.flows_by_table.get(flowmod.table_id, {}))]
+        if strict:
+            _, priority, match = self.flow_key(flowmod)
+            for table_id, flows in tables:
+                flow_key = (table_id, priority, match)
+                if flow_key in flows:
+                    yield flow_key, flows[flow_key]
+            return
+        del_match = dict(flowmod.match.items())
+        for table_id, flows in tables:
+            for flow_key in self._covered_flow_keys(table_id, del_match):
+                if _match_covers(del_match, dict(flow_key[2])):
+                    yield flow_key, flows[flow_key]
+
+    def _apply_flowmod(self, flowmod):
+        command = flowmod.command
+        if command == ofp.OFPFC_ADD:
+            self._add_flow(self.flow_key(flowmod), flowmod)
+            return
+        strict = command in (ofp.OFPFC_DELETE_STRICT, ofp.OFPFC_MODIFY_STRICT)
+        if (command == ofp.OFPFC_DELETE and
+                flowmod.table_id == ofp.OFPTT_ALL and
+                not flowmod.match.items() and
+                flowmod.out_port == ofp.OFPP_ANY and
+                flowmod.out_group == ofp.OFPG_ANY and
+                not flowmod.cookie_mask):
+            self.flows_by_table = {}
+            self.flow_keys_by_match = {}
+            self.flow_keys_by_group = {}
+            self.synced = True
+            return
+        for flow_key, table_flowmod in list(self._matching_flows(flowmod, strict)):
+            if command in (ofp.OFPFC_DELETE, ofp.OFPFC_DELETE_STRICT):
+                if self._filter_matches(flowmod, table_flowmod):
+                    self._del_flow(flow_key)
+            else:
+                self._add_flow(flow_key, valve_of.flowmod(
+                    table_flowmod.cookie, ofp.OFPFC_ADD, table_flowmod.table_id,
+                    table_flowmod.priority, 0, 0, table_flowmod.match,
+                    flowmod.instructions, table_flowmod.hard_timeout,
+                    table_flowmod.idle_timeout, table_flowmod.flags))
+
+    def flow_removed(self, table_id, priority, match):
+        """Forget a flow the datapath has removed, such as on a timeout.
+
+        Args:
+            table_id (int): table of removed flow.
+            priority (int): priority of removed flow.
+            match (ryu.ofproto.ofproto_v1_3_parser.OFPMatch): match of removed flow.
+        """
+        self._del_flow((table_id, priority, tuple(match.items())))
+
+    def _apply_groupmod(self, groupmod):
+        if groupmod.command == ofp.OFPGC_DELETE:
+            if groupmod.group_id == ofp.OFPG_ALL:
+                group_ids = list(self.groups.keys())
+            else:
+                group_ids = [groupmod.group_id]
+            for group_id in group_ids:
+                self.groups.pop(group_id, None)
+                # Deleting a group also deletes flows that output to it.
+                for flow_key in list(self.flow_keys_by_group.pop(group_id, set())):
+                    self._del_flow(flow_key)
+        elif groupmod.command == ofp.OFPGC_ADD:
+            if groupmod.group_id not in self.groups:
+                self.groups[groupmod.group_id] = groupmod
+        elif groupmod.command == ofp.OFPGC_MODIFY:
+            if groupmod.group_id in self.groups:
+                self.groups[groupmod.group_id] = groupmod
+
+    def _apply_metermod(self, metermod):
+        if metermod.command == ofp.OFPMC_DELETE:
+            if metermod.meter_id == ofp.OFPM_ALL:
+                self.meters = {}
+            else:
+                self.meters.pop(metermod.meter_id, None)
+        else:
+            self.meters[metermod.meter_id] = metermod
+
+    def apply_ofmsgs(self, ofmsgs):
+        """Update with messages sent to the datapath.
+
+        Args:
+            ofmsgs (list): ryu.ofproto.ofproto_v1_3_parser messages, in send order.
+        """
+        if not self.enabled:
+            return
+        for ofmsg in ofmsgs:
+            if valve_of.is_flowmod(ofmsg):
+                self._apply_flowmod(ofmsg)
+            elif valve_of.is_groupmod(ofmsg):
+                self._apply_groupmod(ofmsg)
+            elif isinstance(ofmsg, parser.OFPMeterMod):
+                self._apply_metermod(ofmsg)
+
+    @staticmethod
+    def _flow_content(flowmod):
+        return (flowmod.cookie, flowmod.hard_timeout, flowmod.idle_timeout,
+                flowmod.flags, valve_of.serialized(flowmod.instructions))
+
+    @staticmethod
+    def _group_content(groupmod):
+        return (groupmod.type, valve_of.serialized(groupmod.buckets))
+
+    @staticmethod
+    def _meter_content(metermod):
+        return (metermod.flags, valve_of.serialized(metermod.bands))
+
+    def _meters_changed(self, desired):
+        if set(self.meters.keys()) != set(desired.meters.keys()):
+            return True
+        for meter_id, metermod in list(desired.meters.items()):
+            if self._meter_content(metermod) != self._meter_content(
+                    self.meters[meter_id]):
+                return True
+        return False
+
+    def _group_diff(self, desired):
+        ofmsgs = []
+        for group_id in list(self.groups.keys()):
+            if group_id not in desired.groups:
+                ofmsgs.append(valve_of.groupdel(group_id=group_id))
+        for group_id, groupmod in list(desired.groups.items()):
+            if group_id not in self.groups:
+                ofmsgs.append(valve_of.groupadd(
+                    type_=groupmod.type, group_id=group_id,
+                    buckets=groupmod.buckets))
+            elif self._group_content(groupmod) != self._group_content(
+                    self.groups[group_id]):
+                ofmsgs.append(valve_of.groupmod(
+                    type_=groupmod.type, group_id=group_id,
+                    buckets=groupmod.buckets))
+        return ofmsgs
+
+    def _flow_diff(self, desired):
+        ofmsgs = []
+        flows = self.flows()
+        desired_flows = desired.flows()
+        for flow_key, flowmod in list(flows.items()):
+            if flow_key not in desired_flows:
+                ofmsgs.append(valve_of.flowmod(
+                    flowmod.cookie, ofp.OFPFC_DELETE_STRICT, flowmod.table_id,
+                    flowmod.priority, ofp.OFPP_ANY, ofp.OFPG_ANY,
+                    flowmod.match, [], 0, 0))
+        for flow_key, flowmod in list(desired_flows.items()):
+            command = ofp.OFPFC_ADD
+            if flow_key in flows:
+                content = self._flow_content(flowmod)
+                installed_content = self._flow_content(flows[flow_key])
+                if content == installed_content:
+                    continue
+                # The flow is known to exist, so can be modified in place
+                # without resetting counters, if only instructions differ.
+                if content[:-1] == installed_content[:-1]:
+                    command = ofp.OFPFC_MODIFY_STRICT
+            ofmsgs.append(valve_of.flowmod(
+                flowmod.cookie, command, flowmod.table_id, flowmod.priority,
+                0, 0, flowmod.match, flowmod.instructions,
+                flowmod.hard_timeout, flowmod.idle_timeout, flowmod.flags))
+        return ofmsgs
+
+    def diff_ofmsgs(self, ofmsgs):
+        """Return minimal messages to get the same datapath state as ofmsgs.
+
+        Args:
+            ofmsgs (list): ryu.ofproto.ofproto_v1_3_parser messages.
+        Returns:
+            list: messages that change only flows and groups that differ,
+                or ofmsgs unchanged if datapath state is not known.
+        """
+        if not self.synced:
+            return ofmsgs
+        desired = self.copy()
+        desired.apply_ofmsgs(ofmsgs)
+        # Deleting a meter deletes flows using it, so send everything.
+        if self._meters_changed(desired):
+            return ofmsgs
+        diff_ofmsgs = [
+            ofmsg for ofmsg in ofmsgs
+            if not (valve_of.is_flowmod(ofmsg) or valve_of.is_groupmod(ofmsg) or
+                    isinstance(ofmsg, parser.OFPMeterMod))]
+        diff_ofmsgs.extend(self._group_diff(desired))
+        diff_ofmsgs.extend(self._flow_diff(desired))
+        return diff_ofmsgs
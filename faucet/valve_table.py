@@ -16,9 +16,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import hashlib
-import struct
-
 from ryu.ofproto import ofproto_v1_3 as ofp
 
 try:
@@ -31,7 +28,7 @@ class ValveTable(object):
     """Wrapper for an OpenFlow table."""
 
     def __init__(self, table_id, name, restricted_match_types,
-                 flow_cookie, notify_flow_removed=False):
+                 flow_cookie, notify_flow_removed=False, notify_timeouts=False):
         self.table_id = table_id
         self.name = name
         self.restricted_match_types = None
@@ -39,6 +36,10 @@ class ValveTable(object):
             self.restricted_match_types = set(restricted_match_types)
         self.flow_cookie = flow_cookie
         self.notify_flow_removed = notify_flow_removed
+        # Also report flows removed by a timeout, to maintain a shadow table.
+        self.notify_timeouts = notify_timeouts
+        # Validated match types in OpenFlow order, by match types used.
+        self._match_templates = {}
 
     def match(self, in_port=None, vlan=None,
               eth_type=None, eth_src=None,
@@ -50,12 +51,20 @@ class ValveTable(object):
             in_port, vlan, eth_type, eth_src,
             eth_dst, eth_dst_mask, ipv6_nd_target, icmpv6_type,
             nw_proto, nw_src, nw_dst)
-        match = valve_of.match(match_dict)
-        if self.restricted_match_types is not None:
-            for match_type in match_dict:
-                assert match_type in self.restricted_match_types, '%s match in table %s' % (
-                    match_type, self.name)
-        return match
+        return valve_of.match_from_template(
+            self._match_template(tuple(match_dict)), match_dict)
+
+    def _match_template(self, match_types):
+        """Return match types in OpenFlow order, validated once for this table."""
+        template = self._match_templates.get(match_types, None)
+        if template is None:
+            if self.restricted_match_types is not None:
+                for match_type in match_types:
+                    assert match_type in self.restricted_match_types, '%s match in table %s' % (
+                        match_type, self.name)
+            template = valve_of.match_order(match_types)
+            self._match_templates[match_types] = template
+        return template
 
     def flowmod(self, match=None, priority=None,
                 inst=None, command=ofp.OFPFC_ADD, out_port=0,
@@ -68,7 +77,8 @@ class ValveTable(object):
         if inst is None:
             inst = []
         flags = 0
-        if self.notify_flow_removed:
+        if self.notify_flow_removed or (
+                self.notify_timeouts and (hard_timeout or idle_timeout)):
             flags = ofp.OFPFF_SEND_FLOW_REM
         return valve_of.flowmod(
             self.flow_cookie,
@@ -117,9 +127,10 @@ class ValveTable(object):
 
 class ValveGroupEntry(object):
 
-    def __init__(self, table, group_id, buckets):
+    def __init__(self, table, group_id, buckets, group_type=ofp.OFPGT_ALL):
         self.table = table
         self.group_id = group_id
+        self.group_type = group_type
         self.update_buckets(buckets)
 
     def update_buckets(self, buckets):
@@ -129,14 +140,15 @@ class ValveGroupEntry(object):
         ofmsgs = []
         ofmsgs.append(self.delete())
         ofmsgs.append(valve_of.groupadd(
-            group_id=self.group_id, buckets=self.buckets))
+            type_=self.group_type, group_id=self.group_id, buckets=self.buckets))
         self.table.entries[self.group_id] = self
         return ofmsgs
 
     def modify(self):
         assert self.group_id in self.table.entries
         self.table.entries[self.group_id] = self
-        return valve_of.groupmod(group_id=self.group_id, buckets=self.buckets)
+        return valve_of.groupmod(
+            type_=self.group_type, group_id=self.group_id, buckets=self.buckets)
 
     def delete(self):
         if self.group_id in self.table.entries:
@@ -147,24 +159,90 @@ class ValveGroupEntry(object):
 class ValveGroupTable(object):
     """Wrap access to group table."""
 
-    entries = {}
-
-    @staticmethod
-    def group_id_from_str(key_str):
-        """Return a group ID based on a string key."""
-        # TODO: does not handle collisions
-        digest = hashlib.sha256(key_str.encode('utf-8')).digest()
-        return struct.unpack('<L', digest[:4])[0]
+    def __init__(self, max_group_id=valve_of.ROUTE_GROUP_MAX):
+        self.entries = {}
+        # Allocated group IDs by key, and number of users of each.
+        self._group_ids = {}
+        self._group_refs = {}
+        self._free_group_ids = []
+        self._next_group_id = valve_of.ROUTE_GROUP_OFFSET
+        self._max_group_id = max_group_id
+
+    def find_group_id(self, key):
+        """Return the group ID allocated for a key, or None if none allocated."""
+        return self._group_ids.get(key, None)
+
+    def group_id(self, key):
+        """Return the group ID for a key, allocating one if needed.
+
+        Freed group IDs are reused first. IDs are allocated from
+        ROUTE_GROUP_OFFSET, above the fixed IDs of flooding groups.
+
+        Args:
+            key (hashable): identifies the group, e.g. (VLAN VID, nexthop IP).
+        Returns:
+            int: group ID, or None if all group IDs are in use.
+        """
+        group_id = self._group_ids.get(key, None)
+        if group_id is None:
+            if self._free_group_ids:
+                group_id = self._free_group_ids.pop()
+            elif self._next_group_id > self._max_group_id:
+                return None
+            else:
+                group_id = self._next_group_id
+                self._next_group_id += 1
+            self._group_ids[key] = group_id
+            self._group_refs[group_id] = 0
+        return group_id
+
+    def ref(self, key):
+        """Add a user of a key's group, allocating a group ID if needed.
+
+        Args:
+            key (hashable): identifies the group.
+        Returns:
+            int: group ID, or None if all group IDs are in use.
+        """
+        group_id = self.group_id(key)
+        if group_id is not None:
+            self._group_refs[group_id] += 1
+        return group_id
+
+    def unref(self, key):
+        """Remove a user of a key's group, deleting the group if it has no users left.
+
+        Args:
+            key (hashable): identifies the group.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        group_id = self._group_ids.get(key, None)
+        if group_id is None:
+            return []
+        self._group_refs[group_id] -= 1
+        if self._group_refs[group_id] > 0:
+            return []
+        del self._group_ids[key]
+        del self._group_refs[group_id]
+        self._free_group_ids.append(group_id)
+        if group_id in self.entries:
+            return [self.entries[group_id].delete()]
+        return []
 
-    def get_entry(self, group_id, buckets):
+    def get_entry(self, group_id, buckets, group_type=ofp.OFPGT_ALL):
         if group_id in self.entries:
             self.entries[group_id].update_buckets(buckets)
         else:
             self.entries[group_id] = ValveGroupEntry(
-                self, group_id, buckets)
+                self, group_id, buckets, group_type)
         return self.entries[group_id]
 
     def delete_all(self):
         """Delete all groups."""
         self.entries = {}
+        self._group_ids = {}
+        self._group_refs = {}
+        self._free_group_ids = []
+        self._next_group_id = valve_of.ROUTE_GROUP_OFFSET
         return valve_of.groupdel()
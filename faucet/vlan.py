@@ -17,14 +17,18 @@
 # limitations under the License.
 
 import collections
+import heapq
 import ipaddress
+import itertools
 
 try:
     from conf import Conf
+    from valve_rib import RouteTable
     from valve_util import btos
     import valve_of
 except ImportError:
     from faucet.conf import Conf
+    from faucet.valve_rib import RouteTable
     from faucet.valve_util import btos
     from faucet import valve_of
 
@@ -57,6 +61,9 @@ class VLAN(Conf):
     # Define dynamic variables with prefix dyn_ to distinguish from variables set
     # configuration
     dyn_host_cache = None
+    dyn_host_cache_by_port = None
+    dyn_host_cache_expiry = None
+    dyn_host_cache_expiry_seq = None
     dyn_faucet_vips_by_ipv = None
     dyn_routes_by_ipv = None
     dyn_neigh_cache_by_ipv = None
@@ -116,8 +123,11 @@ class VLAN(Conf):
         self.tagged = []
         self.untagged = []
         self.dyn_host_cache = {}
+        self.dyn_host_cache_by_port = {}
+        self.dyn_host_cache_expiry = []
+        self.dyn_host_cache_expiry_seq = itertools.count()
         self.dyn_faucet_vips_by_ipv = collections.defaultdict(list)
-        self.dyn_routes_by_ipv = collections.defaultdict(dict)
+        self.dyn_routes_by_ipv = collections.defaultdict(RouteTable)
         self.dyn_neigh_cache_by_ipv = collections.defaultdict(dict)
         self.dyn_ipvs = []
 
@@ -142,7 +152,7 @@ class VLAN(Conf):
                 ip_gw = ipaddress.ip_address(btos(route['ip_gw']))
                 ip_dst = ipaddress.ip_network(btos(route['ip_dst']))
                 assert ip_gw.version == ip_dst.version
-                self.dyn_routes_by_ipv[ip_gw.version][ip_dst] = ip_gw
+                self.dyn_routes_by_ipv[ip_gw.version].add_ip_gw(ip_dst, ip_gw)
 
     def add_tagged(self, port):
         self.tagged.append(port)
@@ -174,6 +184,80 @@ class VLAN(Conf):
     @host_cache.setter
     def host_cache(self, value):
         self.dyn_host_cache = value
+        self.dyn_host_cache_by_port = {}
+        for eth_src, host_cache_entry in list(value.items()):
+            self._index_cache_host(eth_src, host_cache_entry.port.number)
+
+    def _index_cache_host(self, eth_src, port_num):
+        if port_num not in self.dyn_host_cache_by_port:
+            self.dyn_host_cache_by_port[port_num] = set()
+        self.dyn_host_cache_by_port[port_num].add(eth_src)
+
+    def _unindex_cache_host(self, eth_src, port_num):
+        port_eth_srcs = self.dyn_host_cache_by_port.get(port_num, None)
+        if port_eth_srcs is not None:
+            port_eth_srcs.discard(eth_src)
+            if not port_eth_srcs:
+                del self.dyn_host_cache_by_port[port_num]
+
+    def add_cache_host(self, eth_src, host_cache_entry):
+        """Add/replace a host (L2) cache entry, keeping the port index current."""
+        old_host_cache_entry = self.dyn_host_cache.get(eth_src, None)
+        if old_host_cache_entry is not None:
+            self._unindex_cache_host(eth_src, old_host_cache_entry.port.number)
+        self.dyn_host_cache[eth_src] = host_cache_entry
+        self._index_cache_host(eth_src, host_cache_entry.port.number)
+
+    def expire_cache_host(self, eth_src):
+        """Remove a host from the host (L2) cache, if present."""
+        host_cache_entry = self.dyn_host_cache.pop(eth_src, None)
+        if host_cache_entry is not None:
+            self._unindex_cache_host(eth_src, host_cache_entry.port.number)
+        return host_cache_entry
+
+    def schedule_cache_host_expiry(self, eth_src, host_cache_entry, expiry_time):
+        """Schedule a host cache entry to be checked for expiry.
+
+        Args:
+            eth_src (str): MAC address of host.
+            host_cache_entry (HostCacheEntry): entry to check.
+            expiry_time (float): time after which the entry is due.
+        """
+        heapq.heappush(
+            self.dyn_host_cache_expiry,
+            (expiry_time, next(self.dyn_host_cache_expiry_seq),
+             eth_src, host_cache_entry))
+
+    def cache_hosts_due(self, now):
+        """Return host cache entries due for expiry check, oldest first.
+
+        Only hosts scheduled for a time before now are visited. Schedules for
+        entries since replaced (eg. relearned) or removed are discarded.
+
+        Args:
+            now (float): seconds since epoch.
+        Returns:
+            list: tuples of MAC address and host cache entry.
+        """
+        due_hosts = []
+        due_eth_srcs = set()
+        expiry = self.dyn_host_cache_expiry
+        while expiry and expiry[0][0] < now:
+            _, _, eth_src, host_cache_entry = heapq.heappop(expiry)
+            if eth_src in due_eth_srcs:
+                continue
+            if self.dyn_host_cache.get(eth_src, None) is host_cache_entry:
+                due_hosts.append((eth_src, host_cache_entry))
+                due_eth_srcs.add(eth_src)
+        return due_hosts
+
+    def cached_hosts_on_port(self, port_num):
+        """Return set of MACs in the host (L2) cache learned on a port."""
+        return self.dyn_host_cache_by_port.get(port_num, set())
+
+    def cached_hosts_count_on_port(self, port_num):
+        """Return count of hosts in the host (L2) cache learned on a port."""
+        return len(self.cached_hosts_on_port(port_num))
 
     def set_defaults(self):
         super(VLAN, self).set_defaults()
@@ -207,7 +291,7 @@ class VLAN(Conf):
     def flood_ports(self, configured_ports, exclude_unicast):
         ports = []
         for port in configured_ports:
-            if not port.running:
+            if not port.running():
                 continue
             if exclude_unicast:
                 if not port.unicast_flood:
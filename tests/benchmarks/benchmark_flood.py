@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""VLAN flood rule rebuild benchmark, run as PYTHONPATH=../.. ./benchmark_flood.py."""
+
+# Copyright (C) 2015 Research and Innovation Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2017 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import timeit
+
+from faucet.config_parser import dp_parser
+from faucet.valve_flood import ValveFloodManager
+from faucet.valve_table import ValveGroupTable
+
+
+PORT_COUNTS = (48, 128, 512)
+
+
+def flood_config(ports):
+    """Return config for a DP with half its ports tagged and half untagged on one VLAN."""
+    interfaces = []
+    for port in range(1, ports + 1):
+        if port % 2:
+            interfaces.append('            %u:\n                native_vlan: v100\n' % port)
+        else:
+            interfaces.append('            %u:\n                tagged_vlans: [v100]\n' % port)
+    return """
+version: 2
+dps:
+    s1:
+        hardware: 'Open vSwitch'
+        dp_id: 1
+        interfaces:
+%s
+vlans:
+    v100:
+        vid: 0x100
+""" % ''.join(interfaces)
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for ports in PORT_COUNTS:
+            config_file = os.path.join(tmpdir, 'flood_%u.yaml' % ports)
+            with open(config_file, 'w') as config:
+                config.write(flood_config(ports))
+            _, dps = dp_parser(config_file, 'benchmark_flood')
+            dp = dps[0]
+            for port in list(dp.ports.values()):
+                port.phys_up = True
+            vlan = dp.vlans[0x100]
+            for use_group_table in (False, True):
+                groups = ValveGroupTable()
+                groups.delete_all()
+                flood_manager = ValveFloodManager(
+                    dp.tables['flood'], dp.low_priority, dp.stack, dp.ports,
+                    dp.shortest_path_to_root, use_group_table, groups)
+                secs = timeit.timeit(
+                    lambda: flood_manager.build_flood_rules(vlan), number=3) / 3
+                print('%u ports, %s: %.3f sec per VLAN flood rebuild' % (
+                    ports, 'groups' if use_group_table else 'multiout', secs))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""Packet in header parsing benchmark, run as PYTHONPATH=../.. ./benchmark_packet_in.py."""
+
+# Copyright (C) 2015 Research and Innovation Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2017 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import timeit
+
+from faucet import valve_packet
+
+
+PACKETS = 100000
+
+
+def ryu_header(data):
+    """Parse header as packet_in_handler did, with a ryu packet."""
+    pkt, vlan_vid = valve_packet.parse_packet_in_pkt(
+        data, valve_packet.ETH_VLAN_HEADER_SIZE)
+    eth_pkt = valve_packet.parse_pkt(pkt)
+    return (eth_pkt.dst, eth_pkt.src, vlan_vid)
+
+
+def struct_header(data):
+    """Parse header with struct, without a ryu packet."""
+    return valve_packet.parse_eth_header(data)[:3]
+
+
+def main():
+    data = valve_packet.arp_request(
+        0x100, '0e:00:00:00:00:99', '10.0.0.1', '10.0.0.254').data
+    assert ryu_header(data) == struct_header(data)
+    for name, parser in (('ryu', ryu_header), ('struct', struct_header)):
+        secs = timeit.timeit(lambda: parser(data), number=PACKETS)
+        print('%s: %.0f packets/sec' % (name, PACKETS / secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -120,6 +120,37 @@ dps:
 """
         self.check_config_failure(unknown_hardware_config)
 
+    def test_ecmp_without_group_routing(self):
+        ecmp_config = """
+vlans:
+    100:
+        name: "100"
+dps:
+    switch1:
+        dp_id: 0xcafef00d
+        hardware: 'Open vSwitch'
+        ecmp_routing: True
+"""
+        self.check_config_failure(ecmp_config)
+        self.check_config_success(ecmp_config.replace(
+            'ecmp_routing: True', 'ecmp_routing: True\n        group_table_routing: True'))
+
+    def test_reconcile_without_shadow_table(self):
+        reconcile_config = """
+vlans:
+    100:
+        name: "100"
+dps:
+    switch1:
+        dp_id: 0xcafef00d
+        hardware: 'Open vSwitch'
+        reconcile_on_connect: True
+"""
+        self.check_config_failure(reconcile_config)
+        self.check_config_success(reconcile_config.replace(
+            'reconcile_on_connect: True',
+            'reconcile_on_connect: True\n        use_shadow_table: True'))
+
 
 if __name__ == "__main__":
     unittest.main()
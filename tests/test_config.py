@@ -21,6 +21,8 @@ import logging
 import sys
 import os
 import ipaddress
+import shutil
+import tempfile
 
 testdir = os.path.dirname(__file__)
 srcdir = '../'
@@ -28,6 +30,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
 
 import unittest
 from faucet.config_parser import dp_parser, watcher_parser
+from faucet import config_parser_util
 
 
 class DistConfigTestCase(unittest.TestCase):
@@ -104,6 +107,12 @@ class DistConfigTestCase(unittest.TestCase):
             [], switch1.shortest_path_to_root())
         self.assertEqual(
             ['switch2', 'switch1'], switch2.shortest_path_to_root())
+        self.assertEqual(
+            switch1.ports[7], switch1.shortest_path_port('switch2'))
+        self.assertEqual(
+            switch2.ports[1], switch2.shortest_path_port('switch1'))
+        self.assertIsNone(switch1.shortest_path_port('switch1'))
+        switch1.invalidate_stack_paths()
         self.assertEqual(
             switch1.ports[7], switch1.shortest_path_port('switch2'))
         edges = [edge for edge in switch1.stack['graph'].adjacency_iter()]
@@ -229,6 +238,21 @@ class DistConfigTestCase(unittest.TestCase):
                 dp.acls[dp.vlans[41].acl_in].rules[0]['nw_dst'],
                 '172.0.0.0/8')
 
+    def test_conf_fingerprint(self):
+        port = self.v2_dp.ports[1]
+        fingerprint = port.conf_fingerprint()
+        no_acl_fingerprint = port.conf_fingerprint(exclude=('acl_in',))
+        self.assertIs(fingerprint, port.conf_fingerprint())
+        port.acl_in = None
+        self.assertNotEqual(fingerprint, port.conf_fingerprint())
+        self.assertEqual(
+            no_acl_fingerprint, port.conf_fingerprint(exclude=('acl_in',)))
+
+    def test_only_referenced_objects(self):
+        dp = self.v2_dps_by_id[0xdeadbeef]
+        self.assertEqual({}, dp.vlans)
+        self.assertEqual({}, dp.acls)
+
     def test_gauge_port_stats(self):
         for watcher in self.v2_watchers:
             if watcher.type == 'port_stats':
@@ -262,5 +286,116 @@ class DistConfigTestCase(unittest.TestCase):
             self.assertEqual(watcher.interval, 40)
             self.assertEqual(watcher.file, 'flow_table.JSON')
 
+
+class ConfigFileCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.conf_file_name = os.path.join(self.tmpdir, 'faucet.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_config(self, config, mtime):
+        with open(self.conf_file_name, 'w') as conf_file:
+            conf_file.write(config)
+        os.utime(self.conf_file_name, (mtime, mtime))
+
+    def test_reparse_only_changed(self):
+        self._write_config('vlans: {100: {}}\n', 1000)
+        conf = config_parser_util.read_config(self.conf_file_name, 'test_config')
+        self.assertEqual({'vlans': {100: {}}}, conf)
+        config_hashes = {
+            self.conf_file_name: config_parser_util.config_file_hash(
+                self.conf_file_name)}
+        # Callers get their own copy of the cached config.
+        conf.pop('vlans')
+        self.assertEqual(
+            {'vlans': {100: {}}},
+            config_parser_util.read_config(self.conf_file_name, 'test_config'))
+        self.assertFalse(config_parser_util.config_changed(
+            self.conf_file_name, self.conf_file_name, config_hashes))
+        self._write_config('vlans: {200: {}}\n', 2000)
+        self.assertTrue(config_parser_util.config_changed(
+            self.conf_file_name, self.conf_file_name, config_hashes))
+        self.assertEqual(
+            {'vlans': {200: {}}},
+            config_parser_util.read_config(self.conf_file_name, 'test_config'))
+
+    def test_same_size_and_mtime_edit(self):
+        self._write_config('vlans: {100: {}}\n', 1000)
+        config_hashes = {
+            self.conf_file_name: config_parser_util.config_file_hash(
+                self.conf_file_name)}
+        # An edit keeping size and modification time (e.g. cp -p) is seen.
+        self._write_config('vlans: {200: {}}\n', 1000)
+        self.assertTrue(config_parser_util.config_changed(
+            self.conf_file_name, self.conf_file_name, config_hashes))
+        self.assertEqual(
+            {'vlans': {200: {}}},
+            config_parser_util.read_config(self.conf_file_name, 'test_config'))
+
+
+class ConfigParseProcessesTestCase(unittest.TestCase):
+
+    CONFIG = """
+acls:
+    acl1:
+        - rule:
+            dl_type: 0x800
+            actions:
+                allow: 0
+        - rule:
+            actions:
+                allow: 1
+vlans:
+    100:
+        acl_in: acl1
+dps:
+    s1:
+        dp_id: 1
+        interfaces:
+            1:
+                native_vlan: 100
+                acl_in: acl1
+    s2:
+        dp_id: 2
+        interfaces:
+            1:
+                native_vlan: 100
+    s3:
+        dp_id: 3
+        interfaces:
+            1:
+                acl_in: acl1
+"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.conf_file_name = os.path.join(self.tmpdir, 'faucet.yaml')
+        with open(self.conf_file_name, 'w') as conf_file:
+            conf_file.write(self.CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_in_processes(self):
+        for config_file in (self.conf_file_name, 'config/testconfigv2.yaml'):
+            _, serial_dps = dp_parser(config_file, 'test_config')
+            _, process_dps = dp_parser(config_file, 'test_config', processes=2)
+            self.assertEqual(
+                [str(dp.to_conf()) for dp in serial_dps],
+                [str(dp.to_conf()) for dp in process_dps])
+
+    def test_share_acls_between_dps(self):
+        _, serial_dps = dp_parser(self.conf_file_name, 'test_config')
+        _, process_dps = dp_parser(self.conf_file_name, 'test_config', processes=2)
+        for dps in (serial_dps, process_dps):
+            acl1s = [dp.acls['acl1'] for dp in dps]
+            self.assertEqual(3, len(acl1s))
+            for acl in acl1s:
+                self.assertIs(acl1s[0], acl)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -17,24 +17,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import ipaddress
+import logging
 import os
+import re
 import unittest
 import tempfile
 import shutil
 from fakeoftable import FakeOFTable
 
+from ryu.ofproto import ether
 from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+from ryu.lib import hub
 from ryu.lib.packet import ethernet, arp, vlan, ipv4, ipv6, packet
 
 from faucet.valve import valve_factory
 from faucet.config_parser import dp_parser
+from faucet.faucet_bgp import FaucetBgp
+from faucet.faucet_output import FaucetFlowBatches, FaucetOutputQueue
+from faucet.valve_host import EdgeHostIndex
+from faucet.valve_shadow import ValveShadowTable
+from faucet.valve_table import ValveGroupTable, ValveTable
+from faucet.vlan import VLAN
+from faucet import valve_flood
+from faucet import valve_of
+from faucet import valve_packet
+
+
+FakePathChange = collections.namedtuple(
+    'FakePathChange', ('prefix', 'nexthop', 'is_withdraw'))
 
 
 def build_pkt(pkt):
     layers = []
     if 'arp_target_ip' in pkt:
         ethertype = 0x806
-        layers.append(arp.arp(dst_ip=pkt['arp_target_ip']))
+        layers.append(arp.arp(
+            opcode=pkt.get('arp_code', arp.ARP_REQUEST),
+            src_mac=pkt['eth_src'] if 'arp_code' in pkt else 'ff:ff:ff:ff:ff:ff',
+            src_ip=pkt.get('arp_source_ip', '0.0.0.0'),
+            dst_ip=pkt['arp_target_ip']))
     elif 'ipv6_src' in pkt:
         ethertype = 0x86DD
         layers.append(ipv6.ipv6(src=pkt['ipv6_src'], dst=pkt['ipv6_src']))
@@ -61,6 +85,261 @@ def build_pkt(pkt):
     return result
 
 
+class FakeGauge(object):
+    """Record values set on a Prometheus gauge, by label."""
+
+    def __init__(self):
+        self.values = {}
+        self._labels = None
+
+    def labels(self, **kwargs):
+        self._labels = tuple(sorted(
+            [(key, str(value)) for key, value in list(kwargs.items())]))
+        return self
+
+    def set(self, value):
+        self.values[self._labels] = value
+
+
+class FakeMetrics(object):
+    """Stand in for FaucetMetrics, without a Prometheus registry."""
+
+    def __init__(self):
+        for gauge in (
+                'bgp_route_batch_size', 'bgp_route_queue_latency',
+                'learned_macs', 'port_learn_bans', 'vlan_hosts_learned',
+                'vlan_learn_bans', 'vlan_neighbors'):
+            setattr(self, gauge, FakeGauge())
+
+    def learned_macs_on_port(self, vid, port_num):
+        return sorted([
+            value for labels, value in list(self.learned_macs.values.items())
+            if ('port', str(port_num)) in labels and
+            ('vlan', str(vid)) in labels and value])
+
+
+class ValvePacketTestCase(unittest.TestCase):
+
+    ETH_SRC = '0e:00:00:00:00:01'
+    ETH_DST = '00:00:00:01:00:02'
+
+    def test_reply_templates(self):
+        """Test packets built from templates match those built by ryu."""
+        ipv4_vip = ipaddress.ip_address(u'10.0.0.254')
+        ipv6_vip = ipaddress.ip_address(u'fc00::1:254')
+        link_local_vip = ipaddress.ip_address(u'fe80::1')
+        ra_vips = [ipaddress.ip_interface(u'fc00::1:254/112')]
+        for vid in (None, 0x100):
+            for ipv4_dst in (u'10.0.0.1', u'10.0.0.2'):
+                ipv4_dst = ipaddress.ip_address(ipv4_dst)
+                for builder, args in (
+                        ('arp_request', (vid, self.ETH_SRC, ipv4_vip, ipv4_dst)),
+                        ('arp_reply', (
+                            vid, self.ETH_SRC, self.ETH_DST, ipv4_vip, ipv4_dst))):
+                    self.assertEqual(
+                        getattr(valve_packet, '_build_%s' % builder)(*args).data,
+                        getattr(valve_packet, builder)(*args).data)
+            for ipv6_dst in (u'fc00::1:1', u'fc00::1:2'):
+                ipv6_dst = ipaddress.ip_address(ipv6_dst)
+                for builder, args in (
+                        ('nd_request', (vid, self.ETH_SRC, ipv6_vip, ipv6_dst)),
+                        ('nd_advert', (
+                            vid, self.ETH_SRC, self.ETH_DST, ipv6_vip, ipv6_dst)),
+                        ('router_advert', (
+                            None, vid, self.ETH_SRC, self.ETH_DST,
+                            link_local_vip, ipv6_dst, ra_vips))):
+                    self.assertEqual(
+                        getattr(valve_packet, '_build_%s' % builder)(*args).data,
+                        getattr(valve_packet, builder)(*args).data)
+
+    def test_template_cache_size(self):
+        """Test packets are still built correctly once their template is evicted."""
+        ipv4_dst = ipaddress.ip_address(u'10.0.0.1')
+        first_vip = ipaddress.ip_address(u'10.0.0.254')
+        valve_packet.arp_request(None, self.ETH_SRC, first_vip, ipv4_dst)
+        for i in range(valve_packet._PKT_TEMPLATES_MAX):
+            valve_packet.arp_request(
+                None, self.ETH_SRC, ipaddress.ip_address(u'10.1.0.0') + i, ipv4_dst)
+        self.assertEqual(
+            valve_packet._build_arp_request(None, self.ETH_SRC, first_vip, ipv4_dst).data,
+            valve_packet.arp_request(None, self.ETH_SRC, first_vip, ipv4_dst).data)
+
+
+class ValveFlowReorderTestCase(unittest.TestCase):
+
+    @staticmethod
+    def _flowmod(command, table_id, priority, match, out_port=ofp.OFPP_ANY):
+        return valve_of.flowmod(
+            0, command, table_id, priority, out_port, ofp.OFPG_ANY,
+            valve_of.match({'eth_dst': match}), [], 0, 0)
+
+    def test_flowreorder(self):
+        """Test deletes first, groups deduplicated and redundant adds removed."""
+        add_a = self._flowmod(ofp.OFPFC_ADD, 1, 10, '00:00:00:00:00:0a')
+        add_a_again = self._flowmod(ofp.OFPFC_ADD, 1, 10, '00:00:00:00:00:0a')
+        add_b = self._flowmod(ofp.OFPFC_ADD, 2, 20, '00:00:00:00:00:0b')
+        del_b = self._flowmod(ofp.OFPFC_DELETE_STRICT, 2, 20, '00:00:00:00:00:0b')
+        add_c = self._flowmod(ofp.OFPFC_ADD, 3, 30, '00:00:00:00:00:0c')
+        del_c_port = self._flowmod(
+            ofp.OFPFC_DELETE, 3, 0, '00:00:00:00:00:0c', out_port=1)
+        group_1 = valve_of.groupadd(group_id=1)
+        group_1_again = valve_of.groupadd(group_id=1)
+        group_2 = valve_of.groupadd(group_id=2)
+        ofmsgs = valve_of.valve_flowreorder([
+            add_a, group_1, add_b, group_2, del_b, add_c, del_c_port,
+            group_1_again, add_a_again])
+        self.assertEqual(
+            [del_b, del_c_port, group_1_again, group_2, add_c, add_a_again],
+            [ofmsg for ofmsg in ofmsgs
+             if not isinstance(ofmsg, parser.OFPBarrierRequest)])
+        self.assertEqual(8, len(ofmsgs))
+
+    def test_flowcoalesce(self):
+        """Test delete/add pairs and repeated deletes are coalesced."""
+        del_a = self._flowmod(ofp.OFPFC_DELETE_STRICT, 1, 10, '00:00:00:00:00:0a')
+        add_a = self._flowmod(ofp.OFPFC_ADD, 1, 10, '00:00:00:00:00:0a')
+        del_b = self._flowmod(ofp.OFPFC_DELETE, 2, 0, '00:00:00:00:00:0b')
+        del_b_again = self._flowmod(ofp.OFPFC_DELETE, 2, 0, '00:00:00:00:00:0b')
+        add_b = self._flowmod(ofp.OFPFC_ADD, 2, 20, '00:00:00:00:00:0b')
+        group_del = valve_of.groupdel(group_id=1)
+        group_del_again = valve_of.groupdel(group_id=1)
+        self.assertEqual(
+            [add_a, del_b_again, group_del_again, add_b],
+            valve_of.valve_flowcoalesce([
+                del_a, add_a, del_b, del_b_again, group_del,
+                group_del_again, add_b]))
+        self.assertEqual(
+            [del_a], valve_of.valve_flowcoalesce([add_a, del_a]))
+
+    def test_flowreorder_sort_adds(self):
+        """Test adds sorted by table and priority."""
+        add_low = self._flowmod(ofp.OFPFC_ADD, 1, 10, '00:00:00:00:00:0a')
+        add_high = self._flowmod(ofp.OFPFC_ADD, 1, 20, '00:00:00:00:00:0b')
+        add_later_table = self._flowmod(ofp.OFPFC_ADD, 2, 10, '00:00:00:00:00:0c')
+        ofmsgs = [add_low, add_high, add_later_table]
+        self.assertEqual(ofmsgs, valve_of.valve_flowreorder(ofmsgs))
+        self.assertEqual(
+            [add_later_table, add_high, add_low],
+            valve_of.valve_flowreorder(ofmsgs, sort_adds=True))
+
+    def test_bundle_ofmsgs(self):
+        """Test flow and group messages are sent in one ordered bundle."""
+        add_a = self._flowmod(ofp.OFPFC_ADD, 1, 10, '00:00:00:00:00:0a')
+        group_1 = valve_of.groupadd(group_id=1)
+        packet_out = valve_of.packetout(1, b'')
+        meter_del = valve_of.meterdel()
+        ofmsgs = valve_of.bundle_ofmsgs(
+            [packet_out, group_1, valve_of.barrier(), add_a, meter_del], 99)
+        self.assertEqual(meter_del, ofmsgs[0])
+        self.assertEqual(ofp.ONF_BCT_OPEN_REQUEST, ofmsgs[1].type)
+        self.assertEqual(
+            [group_1, add_a], [ofmsg.message for ofmsg in ofmsgs[2:4]])
+        self.assertEqual(ofp.ONF_BCT_COMMIT_REQUEST, ofmsgs[4].type)
+        self.assertEqual(packet_out, ofmsgs[5])
+        for ofmsg in ofmsgs[1:5]:
+            self.assertEqual(99, ofmsg.bundle_id)
+        self.assertEqual(
+            [packet_out], valve_of.bundle_ofmsgs([packet_out], 99))
+
+    def test_barrier_ofmsgs(self):
+        """Test barriers added at an interval and at the end of a batch."""
+        adds = [
+            self._flowmod(ofp.OFPFC_ADD, 1, priority, '00:00:00:00:00:0a')
+            for priority in range(5)]
+        ofmsgs = valve_of.barrier_ofmsgs(adds, 2)
+        self.assertEqual(
+            [False, False, True, False, False, True, False, True],
+            [valve_of.is_barrier(ofmsg) for ofmsg in ofmsgs])
+
+
+class ValveTableTestCase(unittest.TestCase):
+
+    def test_match_template(self):
+        """Test templated matches are the same as matches built from scratch."""
+        table = ValveTable(1, 'eth_dst', ('in_port', 'vlan_vid', 'eth_dst'), 0)
+        table_vlan = VLAN(100, 1, {})
+        for _ in range(2):
+            self.assertEqual(
+                str(valve_of.match({
+                    'in_port': 1, 'vlan_vid': valve_of.vid_present(100),
+                    'eth_dst': '0E:00:00:00:00:01'})),
+                str(table.match(in_port=1, vlan=table_vlan, eth_dst='0E:00:00:00:00:01')))
+        with self.assertRaises(AssertionError):
+            table.match(eth_src='0e:00:00:00:00:01')
+
+    def test_group_id_allocation(self):
+        """Test group IDs are allocated per table, reference counted and reused."""
+        groups = ValveGroupTable()
+        other_groups = ValveGroupTable()
+        groups.get_entry(1, [])
+        self.assertEqual({}, other_groups.entries)
+        first_id = groups.ref('first')
+        self.assertEqual(first_id, groups.ref('first'))
+        second_id = groups.ref('second')
+        self.assertNotEqual(first_id, second_id)
+        self.assertEqual(first_id, groups.find_group_id('first'))
+        groups.get_entry(first_id, [])
+        self.assertEqual([], groups.unref('first'))
+        ofmsgs = groups.unref('first')
+        self.assertEqual(1, len(ofmsgs))
+        self.assertTrue(valve_of.is_groupdel(ofmsgs[0]))
+        self.assertEqual(first_id, ofmsgs[0].group_id)
+        self.assertEqual(None, groups.find_group_id('first'))
+        self.assertFalse(first_id in groups.entries)
+        self.assertEqual([], groups.unref('first'))
+        self.assertEqual(first_id, groups.ref('third'))
+        self.assertEqual(second_id, groups.find_group_id('second'))
+
+    def test_group_id_range(self):
+        """Test allocated group IDs are never reserved flood group IDs, and run out cleanly."""
+        groups = ValveGroupTable()
+        flood_group_ids = set()
+        for vid in range(valve_of.VLAN_GROUP_OFFSET):
+            for offset in (0, valve_of.VLAN_GROUP_OFFSET, valve_of.STACK_GROUP_OFFSET):
+                flood_group_ids.add(vid + offset)
+        group_ids = set([groups.ref(key) for key in range(2 * valve_of.VLAN_GROUP_OFFSET)])
+        self.assertEqual(2 * valve_of.VLAN_GROUP_OFFSET, len(group_ids))
+        self.assertFalse(group_ids.intersection(flood_group_ids))
+        small_groups = ValveGroupTable(max_group_id=valve_of.ROUTE_GROUP_OFFSET + 1)
+        self.assertEqual(valve_of.ROUTE_GROUP_OFFSET, small_groups.ref('first'))
+        self.assertEqual(valve_of.ROUTE_GROUP_OFFSET + 1, small_groups.ref('second'))
+        self.assertEqual(None, small_groups.ref('third'))
+        self.assertEqual(None, small_groups.find_group_id('third'))
+        small_groups.unref('first')
+        self.assertEqual(valve_of.ROUTE_GROUP_OFFSET, small_groups.ref('third'))
+
+
+class ValveShadowTableTestCase(unittest.TestCase):
+
+    def test_non_strict_delete(self):
+        """Test a non strict delete removes only the flows it covers."""
+        table = ValveTable(1, 'eth_dst', None, 0)
+        vlan_100 = VLAN(100, 1, {})
+        vlan_200 = VLAN(200, 1, {})
+        shadow = ValveShadowTable()
+        shadow.apply_ofmsgs([
+            table.flowmod(table.match(vlan=vlan_100, eth_dst='0e:00:00:00:00:01')),
+            table.flowmod(table.match(vlan=vlan_200, eth_dst='0e:00:00:00:00:01')),
+            table.flowmod(table.match(vlan=vlan_100, eth_dst='0e:00:00:00:00:02')),
+            table.flowmod(table.match(
+                vlan=vlan_100, eth_dst='0e:00:00:00:00:00', eth_dst_mask='ff:00:00:00:00:00')),
+            table.flowmod(table.match(in_port=1))])
+        shadow.apply_ofmsgs(table.flowdel(
+            table.match(vlan=vlan_100, eth_dst='0e:00:00:00:00:01')))
+        self.assertEqual(
+            [(valve_of.vid_present(100), '0e:00:00:00:00:02'),
+             (valve_of.vid_present(200), '0e:00:00:00:00:01')],
+            sorted([(match['vlan_vid'], match['eth_dst']) for match in [
+                dict(flow_key[2]) for flow_key in list(shadow.flows().keys())]
+                    if 'vlan_vid' in match]))
+        shadow.apply_ofmsgs(table.flowdel(table.match(vlan=vlan_200)))
+        shadow.apply_ofmsgs(table.flowdel(table.match(in_port=1)))
+        self.assertEqual(1, len(shadow.flows()))
+        shadow.apply_ofmsgs(table.flowdel())
+        self.assertEqual({}, shadow.flows())
+        self.assertEqual({}, shadow.flow_keys_by_match[table.table_id])
+
+
 class ValveTestBase(unittest.TestCase):
 
     CONFIG = """
@@ -105,27 +384,39 @@ vlans:
     V100 = 0x100|ofp.OFPVID_PRESENT
     V200 = 0x200|ofp.OFPVID_PRESENT
 
-    def setup_valve(self, config):
+    def setup_config_file(self):
         self.tmpdir = tempfile.mkdtemp()
         self.config_file = os.path.join(self.tmpdir, 'valve_unit.yaml')
+
+    def setup_valve(self, config):
+        self.setup_config_file()
         self.table = FakeOFTable(self.NUM_TABLES)
         dp = self.update_config(config)
         self.valve = valve_factory(dp)(dp, 'test_valve')
 
-    def update_config(self, config):
+    def parse_config(self, config):
+        """Return all DPs parsed from config."""
         with open(self.config_file, 'w') as config_file:
             config_file.write(config)
         _, dps = dp_parser(self.config_file, 'test_valve')
-        return dps[0]
+        return dps
+
+    def update_config(self, config):
+        return self.parse_config(config)[0]
+
+    def apply_ofmsgs(self, ofmsgs):
+        """Apply OpenFlow messages as if sent to the datapath."""
+        self.valve.shadow_table.apply_ofmsgs(ofmsgs)
+        self.table.apply_ofmsgs(ofmsgs)
 
     def connect_dp(self):
-        self.table.apply_ofmsgs(self.valve.datapath_connect(
+        self.apply_ofmsgs(self.valve.datapath_connect(
             self.DP_ID, range(1, self.NUM_PORTS + 1)))
 
     def apply_new_config(self, config):
         new_dp = self.update_config(config)
         _, ofmsgs = self.valve.reload_config(new_dp)
-        self.table.apply_ofmsgs(ofmsgs)
+        self.apply_ofmsgs(ofmsgs)
 
     def learn_hosts(self):
         """Learn some hosts."""
@@ -153,7 +444,29 @@ vlans:
             port, vid, pkt.data, pkt)
         rcv_packet_ofmsgs = self.valve.rcv_packet(
             dp_id=self.DP_ID, valves={}, pkt_meta=pkt_meta)
-        self.table.apply_ofmsgs(rcv_packet_ofmsgs)
+        self.apply_ofmsgs(rcv_packet_ofmsgs)
+        return rcv_packet_ofmsgs
+
+    def resolve_nexthop(self, port, vid, eth_src, ip_gw):
+        """Return OpenFlow messages from an ARP reply resolving a nexthop."""
+        vlan = self.valve.dp.vlans[vid]
+        match = {
+            'eth_src': eth_src,
+            'eth_dst': vlan.faucet_mac,
+            'arp_code': arp.ARP_REPLY,
+            'arp_source_ip': str(ip_gw),
+            'arp_target_ip': str(vlan.faucet_vips_by_ipv(4)[0].ip)}
+        if self.valve.dp.ports[port].native_vlan != vlan:
+            match['vid'] = vid
+        return self.rcv_packet(port, vid, match)
+
+    def fib_flowmods(self, ofmsgs):
+        """Return IPv4 FIB flow adds and modifies in OpenFlow messages."""
+        fib_table_id = self.valve.dp.tables['ipv4_fib'].table_id
+        return [
+            ofmsg for ofmsg in ofmsgs
+            if valve_of.is_flowmod(ofmsg) and ofmsg.table_id == fib_table_id and
+            not valve_of.is_flowdel(ofmsg)]
 
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
@@ -395,7 +708,7 @@ class ValveTestCase(ValveTestBase):
 
         valve_vlan = self.valve.dp.vlans[match['vlan_vid'] & ~ofp.OFPVID_PRESENT]
         ofmsgs = self.valve.port_delete(dp_id=self.DP_ID, port_num=1)
-        self.table.apply_ofmsgs(ofmsgs)
+        self.apply_ofmsgs(ofmsgs)
 
         # Check packets are output to each port on vlan
         for port in valve_vlan.get_ports():
@@ -415,8 +728,8 @@ class ValveTestCase(ValveTestBase):
         addresses are deleted."""
 
         match = {'in_port': 1, 'vlan_vid': 0, 'eth_src': self.P1_V100_MAC}
-        self.table.apply_ofmsgs(self.valve.port_delete(dp_id=self.DP_ID, port_num=1))
-        self.table.apply_ofmsgs(self.valve.port_add(dp_id=self.DP_ID, port_num=1))
+        self.apply_ofmsgs(self.valve.port_delete(dp_id=self.DP_ID, port_num=1))
+        self.apply_ofmsgs(self.valve.port_add(dp_id=self.DP_ID, port_num=1))
         self.assertTrue(
             self.table.is_output(match, port=ofp.OFPP_CONTROLLER),
             msg='Packet not output to controller after port bounce')
@@ -425,18 +738,58 @@ class ValveTestCase(ValveTestBase):
         """Test that when a port is enabled packets are input correctly."""
 
         match = {'in_port': 1, 'vlan_vid': 0}
-        self.table.apply_ofmsgs(
+        self.apply_ofmsgs(
             self.valve.port_delete(dp_id=self.DP_ID, port_num=1))
         self.assertFalse(
             self.table.is_output(match, port=2, vid=self.V100),
             msg='Packet output after port delete')
 
-        self.table.apply_ofmsgs(
+        self.apply_ofmsgs(
             self.valve.port_add(dp_id=self.DP_ID, port_num=1))
         self.assertTrue(
             self.table.is_output(match, port=2, vid=self.V100),
             msg='Packet not output after port add')
 
+    def test_cold_start_flood_after_ports(self):
+        """Test flooding is installed on cold start after ports are up."""
+        ofmsgs = self.valve.datapath_connect(
+            self.DP_ID, range(1, self.NUM_PORTS + 1))
+        flood_table_id = self.valve.dp.tables['flood'].table_id
+        vlan_table_id = self.valve.dp.tables['vlan'].table_id
+        vlan_flowmod_table_ids = [
+            ofmsg.table_id for ofmsg in ofmsgs
+            if valve_of.is_flowmod(ofmsg) and ofmsg.command == ofp.OFPFC_ADD
+            and 'vlan_vid' in dict(ofmsg.match.items())]
+        self.assertIn(flood_table_id, vlan_flowmod_table_ids)
+        self.assertLess(
+            max([i for i, table_id in enumerate(vlan_flowmod_table_ids)
+                 if table_id == vlan_table_id]),
+            min([i for i, table_id in enumerate(vlan_flowmod_table_ids)
+                 if table_id == flood_table_id]))
+
+    def test_port_down_not_flooded(self):
+        """Test that broadcasts are not flooded to a port that is down."""
+        match = {'in_port': 1, 'vlan_vid': 0, 'eth_dst': 'ff:ff:ff:ff:ff:ff'}
+        self.assertTrue(
+            self.table.is_output(match, port=3, vid=self.V100),
+            msg='Broadcast not flooded to port that is up')
+        self.apply_ofmsgs(self.valve.port_delete(dp_id=self.DP_ID, port_num=3))
+        self.assertFalse(
+            self.table.is_output(match, port=3, vid=self.V100),
+            msg='Broadcast flooded to port that is down')
+        self.apply_ofmsgs(self.valve.port_add(dp_id=self.DP_ID, port_num=3))
+        self.assertTrue(
+            self.table.is_output(match, port=3, vid=self.V100),
+            msg='Broadcast not flooded to port that came up')
+
+    def test_reload_keeps_port_state(self):
+        """Test that unchanged ports are still running after a reload."""
+        self.apply_new_config(self.CONFIG.replace(
+            '                number: 4\n',
+            '                number: 4\n                permanent_learn: True\n'))
+        for port in list(self.valve.dp.ports.values()):
+            self.assertTrue(port.running(), msg=port)
+
     def test_port_acl_deny(self):
         acl_config = """
 version: 2
@@ -504,6 +857,716 @@ acls:
             self.table.is_output(accept_match, port=3, vid=self.V200),
             msg='packet not allowed by acl')
 
+    def test_host_cache_by_port(self):
+        """Test hosts are indexed by port, and flushed when the port goes down."""
+        vlan = self.valve.dp.vlans[0x100]
+        self.assertEqual(
+            set([self.P1_V100_MAC]), vlan.cached_hosts_on_port(1))
+        self.rcv_packet(2, 0x100, {
+            'eth_src': self.P1_V100_MAC, 'eth_dst': self.UNKNOWN_MAC})
+        self.assertEqual(set(), vlan.cached_hosts_on_port(1))
+        self.assertEqual(
+            set([self.P1_V100_MAC]), vlan.cached_hosts_on_port(2))
+        self.apply_ofmsgs(
+            self.valve.port_delete(dp_id=self.DP_ID, port_num=2))
+        self.assertEqual(set(), vlan.cached_hosts_on_port(2))
+        self.assertFalse(self.P1_V100_MAC in vlan.host_cache)
+
+    def test_host_metrics(self):
+        """Test that learned host metrics are updated incrementally."""
+        metrics = FakeMetrics()
+        self.valve.update_metrics(metrics)
+        p1_mac = int(self.P1_V100_MAC.replace(':', ''), 16)
+        self.assertEqual([p1_mac], metrics.learned_macs_on_port(0x100, 1))
+        self.assertFalse(self.valve.host_manager.changed_vlan_ports)
+
+        # Move host on port 1 to port 2; only those ports should change.
+        self.rcv_packet(2, 0x100, {
+            'eth_src': self.P1_V100_MAC, 'eth_dst': self.UNKNOWN_MAC})
+        self.assertEqual(
+            set([(0x100, 1), (0x100, 2)]),
+            self.valve.host_manager.changed_vlan_ports)
+        self.valve.update_changed_metrics(metrics)
+        self.assertEqual([], metrics.learned_macs_on_port(0x100, 1))
+        self.assertEqual([p1_mac], metrics.learned_macs_on_port(0x100, 2))
+        self.assertFalse(self.valve.host_manager.changed_vlan_ports)
+
+    def test_host_expiry(self):
+        """Test that hosts are expired only once their learn timeout passes."""
+        vlan = self.valve.dp.vlans[0x100]
+        host_manager = self.valve.host_manager
+        cache_time = vlan.host_cache[self.P1_V100_MAC].cache_time
+        host_manager.expire_hosts_from_vlan(
+            vlan, cache_time + host_manager.learn_timeout - 1)
+        self.assertTrue(self.P1_V100_MAC in vlan.host_cache)
+
+        # Relearning the host reschedules its expiry, and the stale
+        # schedule for the old entry is discarded.
+        self.rcv_packet(2, 0x100, {
+            'eth_src': self.P1_V100_MAC, 'eth_dst': self.UNKNOWN_MAC})
+        relearn_time = vlan.host_cache[self.P1_V100_MAC].cache_time
+        host_manager.expire_hosts_from_vlan(
+            vlan, cache_time + host_manager.learn_timeout)
+        self.assertTrue(self.P1_V100_MAC in vlan.host_cache)
+        host_manager.expire_hosts_from_vlan(
+            vlan, relearn_time + host_manager.learn_timeout + 1)
+        self.assertFalse(self.P1_V100_MAC in vlan.host_cache)
+        self.assertEqual([], vlan.cache_hosts_due(float('inf')))
+
+    def test_packet_in_header_only(self):
+        """Test packet ins are parsed from the header, without a ryu packet."""
+        arp_req = valve_packet.arp_request(
+            0x100, self.P1_V100_MAC, '10.0.0.1', '10.0.0.254')
+        eth_dst, eth_src, vlan_vid, eth_type = valve_packet.parse_eth_header(
+            arp_req.data)
+        self.assertEqual('ff:ff:ff:ff:ff:ff', eth_dst)
+        self.assertEqual(self.P1_V100_MAC, eth_src)
+        self.assertEqual(0x100, vlan_vid)
+        self.assertEqual(ether.ETH_TYPE_ARP, eth_type)
+        self.assertEqual(
+            (None, None, None, None), valve_packet.parse_eth_header(b'\x00'))
+        pkt_meta = self.valve.parse_rcv_packet(1, 0x100, arp_req.data)
+        self.assertEqual(ether.ETH_TYPE_ARP, pkt_meta.eth_type)
+        self.assertEqual(0, pkt_meta.reparses)
+        self.assertEqual(self.P1_V100_MAC, pkt_meta.eth_pkt.src)
+        ofmsgs = self.valve.rcv_packet(
+            dp_id=self.DP_ID, valves={}, pkt_meta=pkt_meta)
+        self.assertTrue([
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPPacketOut)])
+        # The ARP handler's reparse reused the control plane parse.
+        self.assertEqual(1, pkt_meta.reparses_avoided)
+        reparses = pkt_meta.reparses
+        pkt_meta.reparse_ip(ether.ETH_TYPE_ARP)
+        self.assertEqual(reparses, pkt_meta.reparses)
+        pkt_meta.reparse_all()
+        pkt_meta.reparse_all()
+        self.assertEqual(reparses, pkt_meta.reparses)
+
+    def test_packet_in_not_ip(self):
+        """Test a packet in that is not for a route manager is not parsed."""
+        arp_reply = valve_packet.arp_reply(
+            None, self.P1_V100_MAC, self.UNKNOWN_MAC, '10.0.0.1', '10.0.0.2')
+        pkt_meta = self.valve.parse_rcv_packet(1, 0x100, arp_reply.data)
+        self.valve.rcv_packet(dp_id=self.DP_ID, valves={}, pkt_meta=pkt_meta)
+        self.assertEqual(0, pkt_meta.reparses)
+
+    def test_routes_by_nexthop(self):
+        """Test routes are indexed by nexthop."""
+        vlan = self.valve.dp.vlans[0x100]
+        route_manager = self.valve.route_manager_by_ipv[4]
+        routes = vlan.routes_by_ipv(4)
+        ip_gw = ipaddress.ip_address(u'10.0.0.3')
+        host_ip = ipaddress.ip_address(u'10.0.0.4')
+        host_dst = ipaddress.ip_network(host_ip)
+        wide_dst = ipaddress.ip_network(u'10.99.0.0/16')
+        narrow_dst = ipaddress.ip_network(u'10.99.99.0/24')
+        for ip_dst in (wide_dst, narrow_dst):
+            route_manager.add_route(vlan, ip_gw, ip_dst)
+        # A host resolving the VIP gets a host FIB route.
+        self.rcv_packet(1, 0x100, {
+            'eth_src': self.P1_V100_MAC,
+            'eth_dst': 'ff:ff:ff:ff:ff:ff',
+            'arp_code': arp.ARP_REQUEST,
+            'arp_source_ip': str(host_ip),
+            'arp_target_ip': '10.0.0.254'})
+        self.assertEqual(set([wide_dst, narrow_dst]), routes.routes_via(ip_gw))
+        self.assertEqual(set([host_dst]), routes.routes_via(host_ip))
+
+        # Nexthop resolution updates only routes via that nexthop.
+        ofmsgs = self.resolve_nexthop(1, 0x100, self.UNKNOWN_MAC, ip_gw)
+        self.assertEqual(
+            set([wide_dst, narrow_dst]),
+            set([ipaddress.ip_network(ofmsg.match['ipv4_dst'])
+                 for ofmsg in self.fib_flowmods(ofmsgs)]))
+
+        route_manager.del_route(vlan, narrow_dst)
+        self.assertEqual(set([wide_dst]), routes.routes_via(ip_gw))
+        route_manager.del_route(vlan, host_dst)
+        self.assertEqual(set(), routes.routes_via(host_ip))
+        self.assertTrue(ip_gw in routes.ip_gws())
+        self.assertFalse(host_ip in routes.ip_gws())
+
+    def test_no_shadow_table(self):
+        """Test flows are not shadowed, nor timeouts reported, by default."""
+        self.assertEqual({}, self.valve.shadow_table.flows())
+        eth_src_table = self.valve.dp.tables['eth_src']
+        ofmsgs = self.valve.host_manager.learn_host_on_vlan_port(
+            self.valve.dp.ports[4], self.valve.dp.vlans[0x200], self.UNKNOWN_MAC)
+        host_flowmods = [
+            ofmsg for ofmsg in ofmsgs
+            if valve_of.is_flowmod(ofmsg) and ofmsg.table_id == eth_src_table.table_id and
+            ofmsg.hard_timeout]
+        self.assertTrue(host_flowmods)
+        self.assertEqual([0] * len(host_flowmods), [ofmsg.flags for ofmsg in host_flowmods])
+        self.assertEqual(ofmsgs, self.valve.shadow_table.diff_ofmsgs(ofmsgs))
+
+
+class ValveShadowTestCase(ValveTestBase):
+
+    CONFIG = ValveTestBase.CONFIG.replace(
+        'dp_id: 1\n', 'dp_id: 1\n        use_shadow_table: True\n')
+
+    @staticmethod
+    def _table_flows(table):
+        # Ignore length fields, which ryu sets only when serializing.
+        return [
+            sorted([re.sub(r'len=\d+,', '', str(flow)) for flow in flows])
+            for flows in table.tables]
+
+    def test_reload_shadow_diff(self):
+        """Test cold start reload sends only flows not already on the datapath."""
+        self.assertTrue(self.valve.shadow_table.synced)
+        new_config = self.CONFIG.replace(
+            'number:', 'description: reloaded\n                number:')
+        cold_start, ofmsgs = self.valve.reload_config(
+            self.update_config(new_config))
+        self.assertTrue(cold_start)
+        self.assertFalse([
+            ofmsg for ofmsg in ofmsgs
+            if valve_of.is_flowdel(ofmsg) and ofmsg.table_id == ofp.OFPTT_ALL])
+        # Only learned host flows, not in a cold start, differ.
+        self.assertFalse([
+            ofmsg for ofmsg in ofmsgs
+            if valve_of.is_flowmod(ofmsg) and not valve_of.is_flowdel(ofmsg)])
+        self.apply_ofmsgs(ofmsgs)
+        cold_start_table = FakeOFTable(self.NUM_TABLES)
+        cold_start_table.apply_ofmsgs(self.valve.datapath_connect(
+            self.DP_ID, range(1, self.NUM_PORTS + 1)))
+        self.assertEqual(
+            self._table_flows(cold_start_table), self._table_flows(self.table))
+
+    def test_expired_flow_readded(self):
+        """Test a host flow that timed out on the datapath is sent again."""
+        eth_dst_table = self.valve.dp.tables['eth_dst']
+        host_flowmods = [
+            flowmod for flowmod in list(self.valve.shadow_table.flows().values())
+            if flowmod.table_id == eth_dst_table.table_id and flowmod.idle_timeout]
+        self.assertTrue(host_flowmods)
+        for flowmod in host_flowmods:
+            self.assertTrue(flowmod.flags & ofp.OFPFF_SEND_FLOW_REM)
+        expired_flowmod = host_flowmods[0]
+        self.assertEqual([], self.valve.shadow_table.diff_ofmsgs([expired_flowmod]))
+        self.assertEqual([], self.valve.flow_removed(
+            expired_flowmod.table_id, expired_flowmod.priority,
+            expired_flowmod.match, ofp.OFPRR_IDLE_TIMEOUT))
+        ofmsgs = self.valve.shadow_table.diff_ofmsgs([expired_flowmod])
+        self.assertEqual(
+            [(ofp.OFPFC_ADD, expired_flowmod.match.items())],
+            [(ofmsg.command, ofmsg.match.items()) for ofmsg in ofmsgs])
+
+    def test_reconcile_on_connect(self):
+        """Test connecting to a provisioned datapath sends only differences."""
+        shadow_table = self.valve.shadow_table
+        flow_stats = [
+            parser.OFPFlowStats(
+                table_id=flowmod.table_id, duration_sec=1, duration_nsec=0,
+                priority=flowmod.priority, idle_timeout=flowmod.idle_timeout,
+                hard_timeout=flowmod.hard_timeout, flags=flowmod.flags,
+                cookie=flowmod.cookie, packet_count=0, byte_count=0,
+                match=flowmod.match, instructions=flowmod.instructions)
+            for flowmod in list(shadow_table.flows().values())]
+        stale_flowmod = self.valve.dp.tables['eth_dst'].flowmod(
+            self.valve.dp.tables['eth_dst'].match(eth_dst=self.UNKNOWN_MAC),
+            priority=1)
+        flow_stats.append(parser.OFPFlowStats(
+            table_id=stale_flowmod.table_id, duration_sec=1, duration_nsec=0,
+            priority=stale_flowmod.priority, idle_timeout=0, hard_timeout=0,
+            flags=0, cookie=stale_flowmod.cookie, packet_count=0, byte_count=0,
+            match=stale_flowmod.match, instructions=[]))
+        group_descs = [
+            parser.OFPGroupDescStats(
+                type_=groupmod.type, group_id=groupmod.group_id,
+                buckets=groupmod.buckets)
+            for groupmod in list(shadow_table.groups.values())]
+        # Restart the controller, with no state about the datapath.
+        dp = self.update_config(self.CONFIG)
+        self.valve = valve_factory(dp)(dp, 'test_valve')
+        ofmsgs = self.valve.datapath_reconcile(
+            self.DP_ID, range(1, self.NUM_PORTS + 1), flow_stats, group_descs, [])
+        # Only flows not in the pipeline are deleted (the stale flow, and
+        # host FIB routes, which are relearned), and nothing is added.
+        flowmods = [ofmsg for ofmsg in ofmsgs if valve_of.is_flowmod(ofmsg)]
+        self.assertEqual(
+            [ofp.OFPFC_DELETE_STRICT] * len(flowmods),
+            [flowmod.command for flowmod in flowmods])
+        self.assertEqual(
+            [stale_flowmod.match.items()],
+            [flowmod.match.items() for flowmod in flowmods
+             if flowmod.table_id == stale_flowmod.table_id])
+        self.assertEqual(
+            1, self.valve.dp.vlans[0x100].host_cache[self.P1_V100_MAC].port.number)
+        self.assertEqual(
+            3, self.valve.dp.vlans[0x200].host_cache[self.P3_V200_MAC].port.number)
+
+    def test_reconcile_expired_host_flow(self):
+        """Test reconciling resends host flows that expired from the datapath."""
+        eth_dst_table = self.valve.dp.tables['eth_dst']
+        expired_match = eth_dst_table.match(
+            vlan=self.valve.dp.vlans[0x100], eth_dst=self.P1_V100_MAC)
+        flow_stats = [
+            parser.OFPFlowStats(
+                table_id=flowmod.table_id, duration_sec=1, duration_nsec=0,
+                priority=flowmod.priority, idle_timeout=flowmod.idle_timeout,
+                hard_timeout=flowmod.hard_timeout, flags=flowmod.flags,
+                cookie=flowmod.cookie, packet_count=0, byte_count=0,
+                match=flowmod.match, instructions=flowmod.instructions)
+            for flowmod in list(self.valve.shadow_table.flows().values())
+            if not (flowmod.table_id == eth_dst_table.table_id and
+                    flowmod.match.items() == expired_match.items())]
+        self.valve.datapath_disconnect(self.DP_ID)
+        ofmsgs = self.valve.datapath_reconcile(
+            self.DP_ID, range(1, self.NUM_PORTS + 1), flow_stats, [], [])
+        self.assertEqual(
+            [expired_match.items()],
+            [ofmsg.match.items() for ofmsg in ofmsgs
+             if valve_of.is_flowmod(ofmsg) and ofmsg.command == ofp.OFPFC_ADD and
+             ofmsg.table_id == eth_dst_table.table_id])
+        self.assertEqual(
+            1, self.valve.dp.vlans[0x100].host_cache[self.P1_V100_MAC].port.number)
+
+
+class ValveStackTestCase(ValveTestBase):
+
+    CONFIG = """
+version: 2
+dps:
+    s1:
+        hardware: 'Open vSwitch'
+        dp_id: 1
+        stack:
+            priority: 1
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                stack:
+                    dp: s2
+                    port: 2
+    s2:
+        hardware: 'Open vSwitch'
+        dp_id: 2
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                stack:
+                    dp: s1
+                    port: 2
+vlans:
+    v100:
+        vid: 0x100
+"""
+
+    NUM_PORTS = 2
+
+    def setUp(self):
+        self.setup_config_file()
+        self.edge_hosts = EdgeHostIndex()
+        self.valves = {}
+        for dp in self.parse_config(self.CONFIG):
+            valve = valve_factory(dp)(dp, 'test_valve', self.edge_hosts)
+            valve.datapath_connect(dp.dp_id, range(1, self.NUM_PORTS + 1))
+            self.valves[dp.dp_id] = valve
+
+    def rcv_stack_packet(self, dp_id, port, vid, match):
+        valve = self.valves[dp_id]
+        pkt = build_pkt(match)
+        pkt.serialize()
+        pkt_meta = valve.parse_rcv_packet(port, vid, pkt.data, pkt)
+        return valve.rcv_packet(
+            dp_id=dp_id, valves=self.valves, pkt_meta=pkt_meta)
+
+    def test_edge_host_index(self):
+        """Test hosts are learned via the stack port toward their edge DP."""
+        self.rcv_stack_packet(2, 1, 0x100, {
+            'eth_src': self.P1_V100_MAC, 'eth_dst': self.UNKNOWN_MAC})
+        self.assertEqual([2], self.edge_hosts.dp_ids(0x100, self.P1_V100_MAC))
+        self.rcv_stack_packet(1, 2, 0x100, {
+            'eth_src': self.P1_V100_MAC, 'eth_dst': self.UNKNOWN_MAC,
+            'vid': 0x100})
+        s1_host = self.valves[1].dp.vlans[0x100].host_cache[self.P1_V100_MAC]
+        self.assertEqual(2, s1_host.port.number)
+        self.assertFalse(s1_host.edge)
+        self.assertEqual([2], self.edge_hosts.dp_ids(0x100, self.P1_V100_MAC))
+
+        # Expiring the host at the edge removes it from the index.
+        s2_valve = self.valves[2]
+        s2_vlan = s2_valve.dp.vlans[0x100]
+        s2_valve.host_manager.expire_hosts_from_vlan(
+            s2_vlan, float('inf'))
+        self.assertEqual([], self.edge_hosts.dp_ids(0x100, self.P1_V100_MAC))
+
+
+class ValveFloodGroupTestCase(ValveTestBase):
+
+    CONFIG = """
+version: 2
+dps:
+    s1:
+        hardware: 'Open vSwitch'
+        dp_id: 1
+        stack:
+            priority: 1
+        interfaces:
+            1:
+                native_vlan: v100
+                hairpin: True
+            2:
+                tagged_vlans: [v100]
+            3:
+                stack:
+                    dp: s2
+                    port: 3
+    s2:
+        hardware: 'Open vSwitch'
+        dp_id: 2
+        interfaces:
+            1:
+                native_vlan: v100
+            2:
+                native_vlan: v100
+                hairpin: True
+            3:
+                stack:
+                    dp: s1
+                    port: 3
+            4:
+                stack:
+                    dp: s3
+                    port: 3
+    s3:
+        hardware: 'Open vSwitch'
+        dp_id: 3
+        interfaces:
+            1:
+                native_vlan: v100
+            3:
+                stack:
+                    dp: s2
+                    port: 4
+    s4:
+        hardware: 'Open vSwitch'
+        dp_id: 4
+        interfaces:
+            1:
+                native_vlan: v100
+                hairpin: True
+            2:
+                tagged_vlans: [v100]
+vlans:
+    v100:
+        vid: 0x100
+"""
+
+    ETH_DSTS = (
+        '0e:00:00:00:00:99', 'ff:ff:ff:ff:ff:ff', '01:00:5e:00:00:01',
+        '33:33:00:00:00:01', '01:80:c2:00:00:00')
+
+    def setUp(self):
+        self.setup_config_file()
+        self.dps = self.parse_config(self.CONFIG)
+        for dp in self.dps:
+            for port in list(dp.ports.values()):
+                port.phys_up = True
+
+    @staticmethod
+    def _eth_dst_matches(match_eth_dst, eth_dst):
+        mask = 'ff:ff:ff:ff:ff:ff'
+        if match_eth_dst is None:
+            return True
+        if isinstance(match_eth_dst, tuple):
+            match_eth_dst, mask = match_eth_dst
+        mac_int = lambda mac_str: int(mac_str.replace(':', ''), 16)
+        return (mac_int(match_eth_dst) & mac_int(mask)) == (mac_int(eth_dst) & mac_int(mask))
+
+    def _flood_outputs(self, ofmsgs, vid, in_port, eth_dst):
+        """Return (port, tagged) outputs of flooding a packet, as a switch would."""
+        groups = dict([
+            (ofmsg.group_id, ofmsg.buckets) for ofmsg in ofmsgs
+            if valve_of.is_groupadd(ofmsg)])
+        flows = []
+        for ofmsg in ofmsgs:
+            if not valve_of.is_flowmod(ofmsg) or ofmsg.command != ofp.OFPFC_ADD:
+                continue
+            match = dict(ofmsg.match.items())
+            if (match['vlan_vid'] == valve_of.vid_present(vid) and
+                    match.get('in_port', in_port) == in_port and
+                    self._eth_dst_matches(match.get('eth_dst', None), eth_dst)):
+                flows.append(ofmsg)
+        flow = max(flows, key=lambda flow: flow.priority)
+        outputs = set()
+
+        def apply_actions(actions, tagged):
+            for action in actions:
+                if action.type == ofp.OFPAT_POP_VLAN:
+                    tagged = False
+                elif action.type == ofp.OFPAT_OUTPUT:
+                    if action.port == ofp.OFPP_IN_PORT:
+                        outputs.add((in_port, tagged))
+                    elif action.port != in_port:
+                        outputs.add((action.port, tagged))
+                elif action.type == ofp.OFPAT_GROUP:
+                    for bucket in groups[action.group_id]:
+                        apply_actions(bucket.actions, tagged)
+
+        for inst in flow.instructions:
+            apply_actions(inst.actions, True)
+        return outputs
+
+    def test_group_flood_same_as_multiout(self):
+        """Test group flooding floods the same as flooding with flows."""
+        for dp in self.dps:
+            vlan = dp.vlans[0x100]
+            mode_ofmsgs = []
+            for use_group_table in (False, True):
+                groups = ValveGroupTable()
+                groups.delete_all()
+                flood_manager = valve_flood.ValveFloodManager(
+                    dp.tables['flood'], dp.low_priority, dp.stack, dp.ports,
+                    dp.shortest_path_to_root, use_group_table, groups)
+                mode_ofmsgs.append(flood_manager.build_flood_rules(vlan))
+            multiout_ofmsgs, group_ofmsgs = mode_ofmsgs
+            self.assertLessEqual(
+                len([ofmsg for ofmsg in group_ofmsgs if valve_of.is_flowmod(ofmsg)]),
+                len(multiout_ofmsgs))
+            for in_port in list(dp.ports.keys()):
+                for eth_dst in self.ETH_DSTS:
+                    self.assertEqual(
+                        self._flood_outputs(multiout_ofmsgs, 0x100, in_port, eth_dst),
+                        self._flood_outputs(group_ofmsgs, 0x100, in_port, eth_dst),
+                        msg='%s port %u %s' % (dp.name, in_port, eth_dst))
+
+    def test_port_down_flood_update(self):
+        """Test only flooding that changed is updated when a port goes down and up."""
+        dp = [dp for dp in self.dps if dp.name == 's1'][0]
+        vlan = dp.vlans[0x100]
+        port = dp.ports[2]
+        for use_group_table in (False, True):
+            groups = ValveGroupTable()
+            groups.delete_all()
+            flood_manager = valve_flood.ValveFloodManager(
+                dp.tables['flood'], dp.low_priority, dp.stack, dp.ports,
+                dp.shortest_path_to_root, use_group_table, groups)
+            add_ofmsgs = flood_manager.build_flood_rules(vlan)
+            self.assertEqual([], flood_manager.update_flood_rules(vlan))
+            port.phys_up = False
+            down_ofmsgs = flood_manager.update_flood_rules(vlan)
+            port.phys_up = True
+            up_ofmsgs = flood_manager.update_flood_rules(vlan)
+            if use_group_table:
+                # One modify each for the broadcast and unicast flood groups.
+                for ofmsgs in (down_ofmsgs, up_ofmsgs):
+                    self.assertEqual(2, len(ofmsgs))
+                    for ofmsg in ofmsgs:
+                        self.assertEqual(ofp.OFPGC_MODIFY, ofmsg.command)
+                        self.assertEqual(
+                            ofmsgs is up_ofmsgs,
+                            str(valve_of.output_port(port.number)) in str(ofmsg.buckets))
+            else:
+                self.assertEqual(len(add_ofmsgs), len(down_ofmsgs))
+                for ofmsg in down_ofmsgs:
+                    if dict(ofmsg.match.items()).get('in_port', None) == port.number:
+                        self.assertEqual(ofp.OFPFC_DELETE_STRICT, ofmsg.command)
+                    else:
+                        self.assertEqual(ofp.OFPFC_MODIFY_STRICT, ofmsg.command)
+                        self.assertFalse(str(valve_of.output_port(port.number)) in str(
+                            ofmsg.instructions))
+                readded_in_port_ofmsgs = [
+                    ofmsg for ofmsg in up_ofmsgs if ofmsg.command == ofp.OFPFC_ADD]
+                self.assertEqual(
+                    len([ofmsg for ofmsg in down_ofmsgs
+                         if ofmsg.command == ofp.OFPFC_DELETE_STRICT]),
+                    len(readded_in_port_ofmsgs))
+            self.assertEqual([], flood_manager.update_flood_rules(vlan))
+
+
+class FaucetBgpTestCase(ValveTestBase):
+
+    def test_bgp_route_batch(self):
+        """Test BGP route changes are coalesced and sent in one batch."""
+        sent_flowmods = []
+        bgp = FaucetBgp(
+            logging.getLogger('test_valve'),
+            lambda dp_id, flowmods: sent_flowmods.append((dp_id, flowmods)))
+        metrics = FakeMetrics()
+        bgp.reset({self.DP_ID: self.valve}, metrics)
+        vlan = self.valve.dp.vlans[0x100]
+        for prefix, is_withdraw in (
+                ('10.99.0.0/16', False),
+                ('10.98.0.0/16', False),
+                ('10.98.0.0/16', True)):
+            bgp._bgp_route_handler(
+                FakePathChange(prefix, '10.0.0.1', is_withdraw), vlan)
+        self.assertEqual([], sent_flowmods)
+        bgp.update_routes()
+        self.assertEqual(1, len(sent_flowmods))
+        dp_id, flowmods = sent_flowmods[0]
+        self.assertEqual(self.DP_ID, dp_id)
+        self.assertTrue(flowmods)
+        routes = vlan.routes_by_ipv(4)
+        self.assertTrue(ipaddress.ip_network(u'10.99.0.0/16') in routes)
+        self.assertFalse(ipaddress.ip_network(u'10.98.0.0/16') in routes)
+        self.assertEqual(
+            2, metrics.bgp_route_batch_size.values[(('dp_id', hex(dp_id)),)])
+        bgp.update_routes()
+        self.assertEqual(1, len(sent_flowmods))
+
+
+class FaucetOutputQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stalled = hub.Event()
+        self.sent_batches = []
+        self.output_queues = []
+
+    def tearDown(self):
+        for output_queue in self.output_queues:
+            output_queue.stop()
+
+    def _output_queue(self, stall):
+
+        def send_batch(valve, ryu_dp, flow_msgs, use_bundles, queued_time):
+            self.sent_batches.append((valve, ryu_dp, flow_msgs))
+            if stall:
+                self.stalled.wait()
+
+        output_queue = FaucetOutputQueue(send_batch, 1)
+        self.output_queues.append(output_queue)
+        return output_queue
+
+    def test_full_queue_does_not_block(self):
+        """Test a DP with a full output queue does not stall another DP, and is resynced."""
+        stalled_queue = self._output_queue(True)
+        output_queue = self._output_queue(False)
+        with hub.Timeout(5):
+            # First batch is taken by the stalled thread, second fills the queue.
+            self.assertTrue(stalled_queue.put('dp1', 'conn1', ['a'], True))
+            hub.sleep(0)
+            self.assertTrue(stalled_queue.put('dp1', 'conn1', ['b'], True))
+            # Queue is full, so queued batches are discarded for a resync.
+            self.assertFalse(stalled_queue.put('dp1', 'conn1', ['c'], True))
+            self.assertTrue(stalled_queue.put('dp1', 'conn1', ['resync'], True))
+            self.assertEqual(1, stalled_queue.qsize())
+            self.assertTrue(output_queue.put('dp2', 'conn2', ['d'], True))
+            hub.sleep(0)
+            self.assertEqual(
+                [('dp1', 'conn1', ['a']), ('dp2', 'conn2', ['d'])], self.sent_batches)
+            self.stalled.set()
+            hub.sleep(0)
+            self.assertEqual(
+                [('dp1', 'conn1', ['resync'])], self.sent_batches[2:])
+
+    def test_reconnect_discards_batches(self):
+        """Test batches queued for a previous connection are not sent to a new one."""
+        output_queue = self._output_queue(False)
+        with hub.Timeout(5):
+            self.assertTrue(output_queue.put('dp1', 'conn1', ['a'], True))
+            self.assertTrue(output_queue.put('dp1', 'conn2', ['b'], True))
+            hub.sleep(0)
+            self.assertEqual([('dp1', 'conn2', ['b'])], self.sent_batches)
+
+
+class ValveECMPTestCase(ValveTestBase):
+
+    CONFIG = """
+version: 2
+dps:
+    s1:
+        hardware: 'Open vSwitch'
+        dp_id: 1
+        group_table_routing: True
+        ecmp_routing: True
+        interfaces:
+            p1:
+                number: 1
+                native_vlan: v100
+            p2:
+                number: 2
+                native_vlan: v100
+vlans:
+    v100:
+        vid: 0x100
+        faucet_vips: ['10.0.0.254/24']
+        routes:
+            - route:
+                ip_dst: '10.99.0.0/16'
+                ip_gw: '10.0.0.1'
+            - route:
+                ip_dst: '10.99.0.0/16'
+                ip_gw: '10.0.0.2'
+"""
+
+    NUM_PORTS = 2
+
+    def learn_hosts(self):
+        pass
+
+    def test_nexthop_group_deleted_with_routes(self):
+        """Test a nexthop group is deleted when the last route using it is."""
+        vlan = self.valve.dp.vlans[0x100]
+        route_manager = self.valve.route_manager_by_ipv[4]
+        ip_gw = ipaddress.ip_address(u'10.0.0.3')
+        ip_dsts = (
+            ipaddress.ip_network(u'10.98.0.0/16'),
+            ipaddress.ip_network(u'10.97.0.0/16'))
+        for ip_dst in ip_dsts:
+            route_manager.add_route(vlan, ip_gw, ip_dst)
+        ofmsgs = self.resolve_nexthop(1, 0x100, self.P1_V100_MAC, ip_gw)
+        group_ids = [ofmsg.group_id for ofmsg in ofmsgs if valve_of.is_groupadd(ofmsg)]
+        self.assertEqual(1, len(group_ids))
+        self.assertFalse([
+            ofmsg for ofmsg in route_manager.del_route(vlan, ip_dsts[0])
+            if valve_of.is_groupmod(ofmsg)])
+        self.assertEqual(
+            group_ids,
+            [ofmsg.group_id for ofmsg in route_manager.del_route(vlan, ip_dsts[1])
+             if valve_of.is_groupdel(ofmsg)])
+        # The nexthop is resolved again to rebuild its group for a new route.
+        self.assertFalse(route_manager.add_route(vlan, ip_gw, ip_dsts[0]))
+        ofmsgs = self.resolve_nexthop(1, 0x100, self.P1_V100_MAC, ip_gw)
+        self.assertEqual(
+            group_ids, [ofmsg.group_id for ofmsg in ofmsgs if valve_of.is_groupadd(ofmsg)])
+
+    def test_ecmp_route(self):
+        """Test a route with two gateways uses a select group over both, deleted with the route."""
+        vlan = self.valve.dp.vlans[0x100]
+        route_manager = self.valve.route_manager_by_ipv[4]
+        ip_dst = ipaddress.ip_network(u'10.99.0.0/16')
+        ip_gws = (ipaddress.ip_address(u'10.0.0.1'), ipaddress.ip_address(u'10.0.0.2'))
+        self.assertEqual(ip_gws, vlan.routes_by_ipv(4).route_ip_gws(ip_dst))
+        route_flow_group_ids = []
+        nexthop_group_ids = []
+        for port_num, ip_gw, eth_src in (
+                (1, ip_gws[0], self.P1_V100_MAC), (2, ip_gws[1], self.P2_V200_MAC)):
+            ofmsgs = self.resolve_nexthop(port_num, 0x100, eth_src, ip_gw)
+            groupadds = [ofmsg for ofmsg in ofmsgs if valve_of.is_groupadd(ofmsg)]
+            nexthop_group_ids.append(groupadds[0].group_id)
+            self.assertEqual(ofp.OFPGT_ALL, groupadds[0].type)
+            route_flows = self.fib_flowmods(ofmsgs)
+            self.assertEqual(1, len(route_flows))
+            route_flow_group_ids.append(
+                route_flows[0].instructions[0].actions[0].group_id)
+        # The first gateway's route outputs to its nexthop group, then to
+        # a select group over both nexthop groups.
+        self.assertEqual(nexthop_group_ids[0], route_flow_group_ids[0])
+        self.assertEqual(2, len(groupadds))
+        select_group = groupadds[-1]
+        self.assertEqual(ofp.OFPGT_SELECT, select_group.type)
+        self.assertEqual(select_group.group_id, route_flow_group_ids[1])
+        self.assertEqual(
+            nexthop_group_ids,
+            [bucket.actions[0].group_id for bucket in select_group.buckets])
+        # The select group is deleted before the groups it chains to.
+        self.assertEqual(
+            [select_group.group_id] + list(reversed(nexthop_group_ids)),
+            [ofmsg.group_id for ofmsg in route_manager.del_route(vlan, ip_dst)
+             if valve_of.is_groupdel(ofmsg)])
+
 
 class ValveACLTestCase(ValveTestBase):
 
@@ -618,5 +1681,69 @@ vlans:
         self.learn_hosts()
 
 
+
+class FakeRyuDp(object):
+    """Fake ryu.controller.controller.Datapath, assigning xids."""
+
+    def __init__(self, dp_id):
+        self.id = dp_id
+        self.xid = 0
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+
+
+class FaucetFlowBatchesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ryu_dp = FakeRyuDp(1)
+        self.flow_batches = FaucetFlowBatches()
+        self.flowmods = [
+            valve_of.flowmod(
+                0, ofp.OFPFC_ADD, 0, priority, ofp.OFPP_ANY, ofp.OFPG_ANY,
+                valve_of.match({}), [], 0, 0)
+            for priority in range(3)]
+
+    def test_bundle_complete(self):
+        """Test a bundled batch is complete on its commit reply."""
+        ofmsgs = self.flow_batches.prepare(self.ryu_dp, self.flowmods, 99, 0)
+        self.assertEqual(len(self.flowmods) + 2, len(ofmsgs))
+        for ofmsg in ofmsgs[:-1]:
+            self.assertEqual(None, self.flow_batches.complete(1, ofmsg.xid))
+        batch = self.flow_batches.complete(1, ofmsgs[-1].xid)
+        self.assertEqual(ofmsgs, batch.ofmsgs)
+        self.assertEqual(None, self.flow_batches.complete(1, ofmsgs[-1].xid))
+
+    def test_failed_bundle_resent(self):
+        """Test a failed bundle is resent with new xids, and tracked as a new batch."""
+        bundle_ofmsgs = self.flow_batches.prepare(
+            self.ryu_dp, self.flowmods, 99, 0)
+        bundle_xids = set([ofmsg.xid for ofmsg in bundle_ofmsgs])
+        self.assertEqual(None, self.flow_batches.failed_bundle(2, bundle_ofmsgs[1].xid))
+        unbundled_ofmsgs = self.flow_batches.failed_bundle(1, bundle_ofmsgs[1].xid)
+        self.assertEqual(self.flowmods, unbundled_ofmsgs[:-1])
+        self.assertTrue(valve_of.is_barrier(unbundled_ofmsgs[-1]))
+        # Only one failure of the bundle is handled.
+        self.assertEqual(None, self.flow_batches.failed_bundle(1, bundle_ofmsgs[2].xid))
+        ofmsgs = self.flow_batches.prepare(self.ryu_dp, unbundled_ofmsgs, None, 0)
+        self.assertEqual(unbundled_ofmsgs, ofmsgs)
+        xids = set([ofmsg.xid for ofmsg in ofmsgs])
+        self.assertEqual(len(ofmsgs), len(xids))
+        self.assertFalse(bundle_xids.intersection(xids))
+        # Replies to the bundle no longer complete any batch.
+        self.assertEqual(None, self.flow_batches.complete(1, bundle_ofmsgs[-1].xid))
+        self.assertEqual(None, self.flow_batches.failed_bundle(1, ofmsgs[0].xid))
+        batch = self.flow_batches.complete(1, ofmsgs[-1].xid)
+        self.assertFalse(batch.bundled)
+        self.assertEqual(ofmsgs, batch.ofmsgs)
+
+    def test_clear(self):
+        """Test batches are no longer tracked when a DP disconnects."""
+        ofmsgs = self.flow_batches.prepare(self.ryu_dp, self.flowmods, None, 2)
+        self.flow_batches.clear(1)
+        self.assertEqual(None, self.flow_batches.complete(1, ofmsgs[-1].xid))
+
+
 if __name__ == "__main__":
     unittest.main()